@@ -0,0 +1,246 @@
+import os
+import re
+import json
+import hashlib
+import logging
+from urllib.parse import urlparse, unquote
+from platform_ops import get_platform_ops
+
+logger = logging.getLogger(__name__)
+
+STOP_TIMEOUT = 5
+# S3 key prefixes of app state that keeps its directory layout; the VM agent maps them back
+VSCODE_PREFIX = "vscode/"
+CHROME_PREFIX = "chrome/"
+APP_STATE_PREFIXES = (VSCODE_PREFIX, CHROME_PREFIX)
+
+
+class AppStateAdapter:
+    """
+    How one app's state is located, captured and restored.
+
+    The migration engine drives every adapter through the same steps:
+      capture(emit, timer)          - before the app is stopped; call emit(path, key)
+                                      for each file as soon as it is identified
+      stop()                        - shut the local app down
+      capture_after_stop(emit, timer) - for state the app only writes on exit
+      restore_spec()                - app-specific hints sent to the VM's /run_task
+      on_migrated(vm_ip)            - follow-up work once the VM has the app
+    Files emitted are uploaded on the engine's shared transfer pool, so adapters
+    never do their own I/O to S3.
+    """
+
+    process_name = None
+
+    def __init__(self, platform=None):
+        self.platform = platform or get_platform_ops()
+
+    def locate_state(self):
+        """Where this app keeps the state we migrate; None if there is none"""
+        return None
+
+    def key_for(self, file_path):
+        return os.path.basename(file_path)
+
+    def capture(self, emit, timer):
+        pass
+
+    def stop(self):
+        """Ask every process of this app to exit, and kill whatever is left after STOP_TIMEOUT"""
+        self.platform.kill(self.process_name, force=False)
+        if not self.platform.wait_for_exit(self.process_name, timeout=STOP_TIMEOUT):
+            logger.warning(f"{self.process_name} did not exit in {STOP_TIMEOUT}s, killing it")
+            self.platform.kill(self.process_name, force=True)
+            self.platform.wait_for_exit(self.process_name, timeout=STOP_TIMEOUT)
+
+    def capture_after_stop(self, emit, timer):
+        pass
+
+    def restore_spec(self):
+        return {}
+
+    def on_migrated(self, vm_ip):
+        pass
+
+
+class PlainAppAdapter(AppStateAdapter):
+    """Apps without migratable state: stopped locally, launched empty on the VM."""
+
+    def __init__(self, process_name, platform=None):
+        super().__init__(platform)
+        self.process_name = process_name
+
+
+class NotepadPlusPlusAdapter(AppStateAdapter):
+    """Open files and unsaved buffers, captured through the ProcessManager helpers."""
+
+    process_name = "notepad++.exe"
+
+    def __init__(self, manager):
+        super().__init__(manager.platform)
+        self.manager = manager
+
+    def locate_state(self):
+        return {"session": self.manager.session_path, "backup_dir": self.manager.backup_dir}
+
+    def capture(self, emit, timer):
+        with timer.stage("session_save"):
+            self.manager.force_notepad_session_save()
+        # Start streaming open files while the rest of the capture runs
+        with timer.stage("open_files"):
+            open_files = self.manager.get_current_open_files()
+            for file_path in open_files:
+                emit(file_path, self.key_for(file_path))
+        with timer.stage("unsaved_backups"):
+            unsaved_files = self.manager.get_unsaved_backup_files()
+        for file_path in self.manager.track_captured_notepad_files(open_files, unsaved_files):
+            emit(file_path, self.key_for(file_path))
+
+    def stop(self):
+        # The session was saved during capture, so there is nothing to lose by force-killing
+        self.platform.kill(self.process_name, force=True)
+        self.platform.wait_for_exit(self.process_name, timeout=STOP_TIMEOUT)
+
+    def on_migrated(self, vm_ip):
+        self.manager.start_notepad_auto_sync(vm_ip)
+        self.manager.start_periodic_sync(interval_seconds=30)
+
+
+def _file_uri_to_path(uri):
+    path = unquote(urlparse(uri).path)
+    # file:///c%3A/Users/... -> c:/Users/...
+    if re.match(r"^/[a-zA-Z]:", path):
+        path = path[1:]
+    return os.path.normpath(path)
+
+
+class VSCodeAdapter(AppStateAdapter):
+    """Folders of the open VS Code windows, taken from its global storage.json."""
+
+    process_name = "Code.exe"
+    SKIP_DIRS = {".git", "node_modules", "__pycache__", ".venv", "venv", ".tox"}
+    MAX_FILE_BYTES = 5 * 1024 * 1024
+    MAX_FILES = 5000
+
+    def __init__(self, storage_path=None, platform=None):
+        super().__init__(platform)
+        self.storage_path = storage_path or os.path.join(
+            os.getenv("APPDATA", ""), "Code", "User", "globalStorage", "storage.json"
+        )
+        self.workspaces = {}  # workspace name -> local folder
+
+    @staticmethod
+    def workspace_name(folder):
+        """Folder name plus a stable hash of the full path, so two "api" folders do not share keys"""
+        folder = os.path.normcase(os.path.abspath(folder.rstrip(os.sep) or folder))
+        digest = hashlib.sha1(folder.encode("utf-8")).hexdigest()[:8]
+        return f"{os.path.basename(folder) or 'workspace'}-{digest}"
+
+    def locate_state(self):
+        try:
+            with open(self.storage_path, "r", encoding="utf-8") as f:
+                windows_state = json.load(f).get("windowsState", {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read VS Code window state: {e}")
+            return None
+        windows = [windows_state.get("lastActiveWindow", {})] + windows_state.get("openedWindows", [])
+        folders = []
+        for window in windows:
+            uri = window.get("folder") or window.get("folderUri")
+            if uri and uri.startswith("file:"):
+                folder = _file_uri_to_path(uri)
+                if os.path.isdir(folder) and folder not in folders:
+                    folders.append(folder)
+        return {"folders": folders}
+
+    def key_for(self, file_path):
+        for name, folder in self.workspaces.items():
+            if file_path.startswith(folder + os.sep):
+                relative = os.path.relpath(file_path, folder).replace(os.sep, "/")
+                return f"{VSCODE_PREFIX}{name}/{relative}"
+        return super().key_for(file_path)
+
+    def capture(self, emit, timer):
+        with timer.stage("locate_workspaces"):
+            state = self.locate_state() or {"folders": []}
+            for folder in state["folders"]:
+                self.workspaces[self.workspace_name(folder)] = folder
+        # Every file is listed so a fresh VM can pull it; the engine only uploads those changed since the last migration
+        with timer.stage("workspace_files"):
+            emitted = 0
+            for folder in self.workspaces.values():
+                for root, dirs, files in os.walk(folder):
+                    dirs[:] = [d for d in dirs if d not in self.SKIP_DIRS]
+                    for name in files:
+                        file_path = os.path.join(root, name)
+                        try:
+                            if os.path.getsize(file_path) > self.MAX_FILE_BYTES:
+                                continue
+                        except OSError:
+                            continue
+                        emit(file_path, self.key_for(file_path))
+                        emitted += 1
+                        if emitted >= self.MAX_FILES:
+                            logger.warning(f"VS Code capture stopped at {self.MAX_FILES} files")
+                            return
+
+    def restore_spec(self):
+        return {"workspaces": sorted(self.workspaces)}
+
+
+class ChromeAdapter(AppStateAdapter):
+    """Session, tabs, bookmarks and preferences of the default Chrome profile."""
+
+    process_name = "chrome.exe"
+    PROFILE_FILES = ("Bookmarks", "Preferences", "Current Session", "Current Tabs", "Last Session", "Last Tabs")
+    PROFILE_DIRS = ("Sessions",)
+
+    def __init__(self, user_data_dir=None, profile="Default", platform=None):
+        super().__init__(platform)
+        self.user_data_dir = user_data_dir or os.path.join(
+            os.getenv("LOCALAPPDATA", ""), "Google", "Chrome", "User Data"
+        )
+        self.profile = profile
+
+    def locate_state(self):
+        profile_dir = os.path.join(self.user_data_dir, self.profile)
+        return {"profile_dir": profile_dir} if os.path.isdir(profile_dir) else None
+
+    def key_for(self, file_path):
+        relative = os.path.relpath(file_path, self.user_data_dir).replace(os.sep, "/")
+        return f"{CHROME_PREFIX}{relative}"
+
+    def capture_after_stop(self, emit, timer):
+        # Chrome only flushes its session files on exit
+        state = self.locate_state()
+        if not state:
+            logger.warning("No Chrome profile found to migrate")
+            return
+        with timer.stage("profile_files"):
+            local_state = os.path.join(self.user_data_dir, "Local State")
+            if os.path.isfile(local_state):
+                emit(local_state, self.key_for(local_state))
+            for name in self.PROFILE_FILES:
+                file_path = os.path.join(state["profile_dir"], name)
+                if os.path.isfile(file_path):
+                    emit(file_path, self.key_for(file_path))
+            for name in self.PROFILE_DIRS:
+                for root, _, files in os.walk(os.path.join(state["profile_dir"], name)):
+                    for file_name in files:
+                        file_path = os.path.join(root, file_name)
+                        emit(file_path, self.key_for(file_path))
+
+    def restore_spec(self):
+        return {"profile": self.profile}
+
+
+def adapter_for(task_name, manager):
+    """A fresh adapter for one migration of task_name"""
+    name = task_name.lower()
+    if name == "notepad++.exe":
+        return NotepadPlusPlusAdapter(manager)
+    if name == "code.exe":
+        return VSCodeAdapter(platform=manager.platform)
+    if name == "chrome.exe":
+        return ChromeAdapter(platform=manager.platform)
+    return PlainAppAdapter(task_name, platform=manager.platform)
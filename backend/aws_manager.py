@@ -1,22 +1,60 @@
-import boto3
 import time
 import os
 import requests
-from requests.adapters import HTTPAdapter
-try:
-    from urllib3.util.retry import Retry
-except ImportError:
-    print("⚠️ urllib3.util.retry not found. Installing urllib3 explicitly might be required.")
-    Retry = None
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, WaiterError
+from vm_client import VMClient, CircuitBreaker, get_vm_client
+from instance_catalog import InstanceCatalog, NoMatchingInstanceType
+from rate_governor import governed_client, governed_resource
+from metrics import histogram, counter
+import tracing
+
+# Files the VM agent runs from; they are uploaded flat and land next to vm_server.py on the VM
+VM_AGENT_FILES = [
+    os.path.join("vm_scripts", "vm_server.py"),
+    os.path.join("vm_scripts", "app_launcher.py"),
+    "process_snapshot.py",
+    "metrics.py",
+    "tracing.py",
+]
+
+# VM platforms: Windows Server, or Ubuntu with the agent under Xvfb/x11vnc (boots in well under a minute)
+PLATFORMS = ("windows", "linux")
+
+# Every instance we launch carries these tags, so lookups never hand out someone else's VM
+MANAGED_TAG = "CloudRAM"
+USER_TAG = "CloudRAMUser"
+# Extra VMs of a user's placement pool; never handed out as the user's own VM
+POOL_TAG = "CloudRAMPool"
+PROVISION_STAGES = histogram(
+    "cloud_ram_provision_stage_seconds", "Duration of VM provisioning stages", labels=("platform", "stage")
+)
+PROVISIONS = counter(
+    "cloud_ram_provisions_total", "VM creations and resumes by outcome", labels=("kind", "platform", "outcome")
+)
+
+# Threads tagging the instances of a bulk launch
+BULK_WORKERS = 32
+
+
+@contextmanager
+def provision_stage(platform, stage, **attributes):
+    """Time a provisioning stage in metrics and, inside a trace, as a span"""
+    with tracing.child_span(f"provision.{stage}", platform=platform, **attributes) as span, \
+            PROVISION_STAGES.time(platform=platform, stage=stage):
+        yield span
 
 class AWSManager:
     def __init__(self):
         """Initialize AWS EC2 client and resource manager."""
-        self.ec2 = boto3.client("ec2")
-        self.ec2_resource = boto3.resource("ec2")
-        self.s3 = boto3.client("s3")
+        # Shared token buckets per API family and adaptive retries (rate_governor)
+        self.ec2 = governed_client("ec2")
+        self.ec2_resource = governed_resource("ec2")
+        self.s3 = governed_client("s3")
         self.active_vm_id = None
         self.bucket_name = "cloud-ram-scripts"
+        self.catalog = InstanceCatalog(self.ec2)
 
     def create_key_pair(self):
         """Dynamically creates an EC2 key pair and saves it locally in the same directory as the running script."""
@@ -98,39 +136,49 @@ class AWSManager:
             print(f"❌ Error fetching Windows AMI: {str(e)}")
             return None
 
-    def upload_script_to_s3(self):
-        script_path = os.path.join("vm_scripts", "vm_server.py")
-        script_key = "vm_server.py"
-
-        if not os.path.exists(script_path):
-            print(f"❌ Flask Server script not found at {script_path}")
-            return None
-
+    def get_latest_linux_ami(self, architecture="x86_64"):
+        """Finds the latest Ubuntu 22.04 LTS AMI published by Canonical."""
+        ubuntu_arch = "arm64" if architecture == "arm64" else "amd64"
         try:
-            self.s3.upload_file(script_path, self.bucket_name, script_key)
-            print(f"📤 Uploaded {script_path} to s3://{self.bucket_name}/{script_key}")
+            response = self.ec2.describe_images(
+                Filters=[
+                    {"Name": "name", "Values": [f"ubuntu/images/hvm-ssd/ubuntu-jammy-22.04-{ubuntu_arch}-server-*"]},
+                    {"Name": "state", "Values": ["available"]}
+                ],
+                Owners=["099720109477"]
+            )
+            if not response["Images"]:
+                print("❌ No Ubuntu AMI found.")
+                return None
+            ami_id = sorted(response["Images"], key=lambda x: x["CreationDate"], reverse=True)[0]["ImageId"]
+            print(f"📦 Latest Ubuntu AMI Found: {ami_id}")
+            return ami_id
         except Exception as e:
-            print(f"❌ Error uploading script to S3: {str(e)}")
+            print(f"❌ Error fetching Ubuntu AMI: {str(e)}")
             return None
 
-    def create_vm(self, ram_size):
-        self.upload_script_to_s3()
-        """Dynamically launches an EC2 instance with readiness check and key upload."""
-        existing_vm_id, existing_ip = self.get_existing_vm()
-        if existing_vm_id:
-            print(f"✅ Returning existing VM: {existing_vm_id} (IP: {existing_ip})")
-            return existing_vm_id, existing_ip
+    def upload_script_to_s3(self):
+        """Uploads the VM agent and the shared modules it imports."""
+        for script_path in VM_AGENT_FILES:
+            script_key = os.path.basename(script_path)
 
-        key_name, key_path = self.create_key_pair()
-        if not key_name or not key_path:
-            print("❌ Failed to create or retrieve key pair.")
-            return None, None
+            if not os.path.exists(script_path):
+                print(f"❌ Agent script not found at {script_path}")
+                return None
 
-        instance_type = {1: "t3.micro", 2: "t3.small", 4: "t3.medium"}.get(ram_size, "t3.medium")
+            try:
+                self.s3.upload_file(script_path, self.bucket_name, script_key)
+                print(f"📤 Uploaded {script_path} to s3://{self.bucket_name}/{script_key}")
+            except Exception as e:
+                print(f"❌ Error uploading script to S3: {str(e)}")
+                return None
+
+    def _windows_user_data(self, key_path):
+        """PowerShell startup script, followed by the key file it installs into C:\\CloudRAM."""
         startup_script_path = os.path.join("vm_scripts", "vm_startup_script.ps1")
         if not os.path.exists(startup_script_path):
             print(f"❌ Startup script not found at {startup_script_path}")
-            return None, None
+            return None
 
         with open(startup_script_path, "r") as script_file:
             startup_script = script_file.read()
@@ -138,62 +186,394 @@ class AWSManager:
         with open(key_path, "r") as key_file:
             key_content = key_file.read()
 
-        user_data = f"{startup_script}\n\n" + \
-                    f"$keyContent = @'\n{key_content}\n'@\n" + \
-                    "New-Item -ItemType Directory -Path 'C:\\CloudRAM' -Force\n" + \
-                    "Set-Content -Path 'C:\\CloudRAM\\cloud-ram-key.pem' -Value $keyContent -Force\n" + \
-                    "icacls 'C:\\CloudRAM\\cloud-ram-key.pem' /inheritance:r /grant:r 'Administrators:F'"
+        return f"{startup_script}\n\n" + \
+               f"$keyContent = @'\n{key_content}\n'@\n" + \
+               "New-Item -ItemType Directory -Path 'C:\\CloudRAM' -Force\n" + \
+               "Set-Content -Path 'C:\\CloudRAM\\cloud-ram-key.pem' -Value $keyContent -Force\n" + \
+               "icacls 'C:\\CloudRAM\\cloud-ram-key.pem' /inheritance:r /grant:r 'Administrators:F'"
+
+    def _linux_user_data(self):
+        """cloud-init config; the key pair is installed for SSH by EC2 itself."""
+        cloud_init_path = os.path.join("vm_scripts", "vm_cloud_init.yaml")
+        if not os.path.exists(cloud_init_path):
+            print(f"❌ cloud-init config not found at {cloud_init_path}")
+            return None
+        with open(cloud_init_path, "r") as config_file:
+            return config_file.read()
+
+    def select_instance_type(self, ram_size, platform="windows", min_vcpus=0, architecture="x86_64"):
+        """Cheapest catalog type with at least ram_size GB; raises NoMatchingInstanceType."""
+        if platform == "windows" and architecture != "x86_64":
+            raise NoMatchingInstanceType("Windows VMs are only available on x86_64")
+        return self.catalog.select(ram_size, min_vcpus=min_vcpus, architecture=architecture, platform=platform)
+
+    def _launch_config(self, platform, architecture="x86_64"):
+        """What every VM of a platform/architecture is launched with, or None if any of it is unavailable."""
+        key_name, key_path = self.create_key_pair()
+        if not key_name or not key_path:
+            print("❌ Failed to create or retrieve key pair.")
+            return None
+        if platform == "linux":
+            image_id = self.get_latest_linux_ami(architecture)
+            user_data = self._linux_user_data()
+            # Linux comes up in tens of seconds, so poll the agent more tightly
+            poll_interval = 3
+        else:
+            image_id = self.get_latest_windows_ami()
+            user_data = self._windows_user_data(key_path)
+            poll_interval = 10
+        if not image_id or not user_data:
+            return None
+        return {
+            "platform": platform,
+            "key_name": key_name,
+            "image_id": image_id,
+            "user_data": user_data,
+            "security_group": self.create_security_group(),
+            "poll_interval": poll_interval,
+        }
+
+    def _run_instances(self, config, instance_type, count=1, user_id=None, pool=False):
+        """Launch up to count instances in one call; EC2 may start fewer when capacity is short."""
+        tags = [
+            {"Key": MANAGED_TAG, "Value": "true"},
+            {"Key": USER_TAG, "Value": user_id or "unassigned"},
+            {"Key": "Name", "Value": f"cloud-ram-{config['platform']}"},
+        ]
+        if pool:
+            tags.append({"Key": POOL_TAG, "Value": "true"})
+        response = self.ec2.run_instances(
+            ImageId=config["image_id"],
+            InstanceType=instance_type,
+            MinCount=1,
+            MaxCount=count,
+            KeyName=config["key_name"],
+            SecurityGroupIds=[config["security_group"]],
+            UserData=config["user_data"],
+            IamInstanceProfile={
+                'Name': 'CloudRAMEC2Role'
+            },
+            TagSpecifications=[{"ResourceType": "instance", "Tags": tags}]
+        )
+        return [instance["InstanceId"] for instance in response["Instances"]]
+
+    def _public_ips(self, vm_ids):
+        """vm_id -> public IP for those of vm_ids that are running."""
+        ips = {}
+        paginator = self.ec2.get_paginator("describe_instances")
+        for page in paginator.paginate(InstanceIds=vm_ids):
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    if instance["State"]["Name"] == "running":
+                        ips[instance["InstanceId"]] = instance.get("PublicIpAddress", "Pending")
+        return ips
+
+    def create_vm(self, ram_size, on_launched=None, platform="windows", user_id=None,
+                  instance_type=None, architecture="x86_64", reuse_existing=True, pool=False):
+        """Dynamically launches an EC2 instance with readiness check and key upload.
+
+        on_launched, if given, is called with the instance ID as soon as the launch
+        is accepted, so callers can overlap their own work with the boot.
+        platform is "windows" or "linux"; both run the same agent API on port 5000.
+        The instance is tagged with user_id, and that user's running VM is returned
+        instead unless reuse_existing is False. pool=True marks an extra VM of the
+        user's placement pool, which is never reused as their own VM.
+        instance_type defaults to the cheapest catalog type with at least ram_size GB.
+        """
+        if platform not in PLATFORMS:
+            print(f"❌ Unsupported platform: {platform}")
+            return None, None
+        self.upload_script_to_s3()
+        if reuse_existing:
+            existing_vm_id, existing_ip = self.get_existing_vm(user_id)
+            if existing_vm_id:
+                print(f"✅ Returning existing VM: {existing_vm_id} (IP: {existing_ip})")
+                return existing_vm_id, existing_ip
+
+        if instance_type is None:
+            try:
+                instance_type = self.select_instance_type(ram_size, platform, architecture=architecture)
+            except NoMatchingInstanceType as e:
+                print(f"❌ {str(e)}")
+                return None, None
+        config = self._launch_config(platform, architecture)
+        if not config:
+            return None, None
+        max_attempts = 1800 // config["poll_interval"]
 
         try:
-            print(f"🚀 Creating EC2 instance with {ram_size}GB RAM ({instance_type})")
-            response = self.ec2.run_instances(
-                ImageId=self.get_latest_windows_ami(),
-                InstanceType=instance_type,
-                MinCount=1,
-                MaxCount=1,
-                KeyName=key_name,
-                SecurityGroupIds=[self.create_security_group()],
-                UserData=user_data,
-                IamInstanceProfile={
-                    'Name': 'CloudRAMEC2Role'
-                }
-            )
-            instance = response["Instances"][0]
-            self.active_vm_id = instance["InstanceId"]
+            print(f"🚀 Creating {platform} EC2 instance with {ram_size}GB RAM ({instance_type})")
+            with provision_stage(platform, "launch", instance_type=instance_type):
+                self.active_vm_id = self._run_instances(config, instance_type, user_id=user_id, pool=pool)[0]
+            if on_launched:
+                try:
+                    on_launched(self.active_vm_id)
+                except Exception as e:
+                    print(f"⚠️ on_launched callback failed: {str(e)}")
             print("⏳ Waiting for instance to start...")
-            waiter = self.ec2.get_waiter("instance_running")
-            waiter.wait(InstanceIds=[self.active_vm_id])
-
-            vm_info = self.ec2.describe_instances(InstanceIds=[self.active_vm_id])
-            ip_address = vm_info["Reservations"][0]["Instances"][0].get("PublicIpAddress", "Pending")
+            with provision_stage(platform, "instance_running"):
+                waiter = self.ec2.get_waiter("instance_running")
+                waiter.wait(InstanceIds=[self.active_vm_id])
+                ip_address = self._public_ips([self.active_vm_id])[self.active_vm_id]
             print(f"✅ Instance running at {ip_address}. Waiting for services...")
 
-            session = requests.Session()
-            if Retry:
-                retry_strategy = Retry(total=10, backoff_factor=5, status_forcelist=[500, 502, 503, 504])
-                adapter = HTTPAdapter(max_retries=retry_strategy)
-                session.mount("http://", adapter)
-            print(f"⏳ Waiting for Flask server at {ip_address}:5000...")
-            for attempt in range(180):
-                try:
-                    response = session.get(f"http://{ip_address}:5000/", timeout=20)
-                    if response.status_code == 200:
-                        print(f"✅ Flask server ready at {ip_address}:5000 after {attempt + 1} attempts")
-                        break
-                except requests.RequestException as e:
-                    print(f"⏳ Attempt {attempt + 1}/180: Waiting for Flask... ({str(e)})")
-                    time.sleep(10)
-            else:
-                print(f"❌ Flask server not ready after 30 minutes at {ip_address}:5000")
+            with provision_stage(platform, "agent_ready", vm_ip=ip_address):
+                ready = self.wait_for_agent(ip_address, config["poll_interval"], max_attempts)
+            if not ready:
                 self.terminate_vm(self.active_vm_id)
+                PROVISIONS.inc(kind="create", platform=platform, outcome="failed")
                 return None, None
 
             print(f"✅ VM Created: ID={self.active_vm_id}, IP={ip_address}")
+            PROVISIONS.inc(kind="create", platform=platform, outcome="ok")
             return self.active_vm_id, ip_address
         except Exception as e:
             print(f"❌ Error creating VM: {str(e)}")
+            PROVISIONS.inc(kind="create", platform=platform, outcome="failed")
             return None, None
 
+    def create_vms(self, seats):
+        """Launch VMs for many users at once.
+
+        seats are dicts with user_id, platform, architecture and instance_type.
+        The agent upload, key pair, security group and AMI lookups happen once,
+        seats of the same kind share one run_instances call, one waiter covers
+        every instance, and the agents are polled in parallel. Returns
+        user_id -> (vm_id, ip) for the VMs that came up; the others are terminated.
+        """
+        self.upload_script_to_s3()
+        groups = {}
+        for seat in seats:
+            key = (seat["platform"], seat.get("architecture", "x86_64"), seat["instance_type"])
+            groups.setdefault(key, []).append(seat["user_id"])
+
+        assigned = {}  # vm_id -> user_id
+        poll_intervals = {}
+        platforms = {}
+        configs = {}
+        for (platform, architecture, instance_type), user_ids in groups.items():
+            if (platform, architecture) not in configs:
+                configs[platform, architecture] = self._launch_config(platform, architecture)
+            config = configs[platform, architecture]
+            if not config:
+                continue
+            pending = list(user_ids)
+            while pending:
+                try:
+                    print(f"🚀 Creating {len(pending)} {platform} EC2 instances ({instance_type})")
+                    with provision_stage(platform, "launch", instance_type=instance_type, count=len(pending)):
+                        vm_ids = self._run_instances(config, instance_type, count=len(pending))
+                except ClientError as e:
+                    print(f"❌ Could not launch {len(pending)} {instance_type} instances: {str(e)}")
+                    break
+                for vm_id in vm_ids:
+                    assigned[vm_id] = pending.pop(0)
+                    poll_intervals[vm_id] = config["poll_interval"]
+                    platforms[vm_id] = platform
+        if not assigned:
+            return {}
+
+        # Launched as "unassigned"; each instance now gets its user's tag
+        with ThreadPoolExecutor(max_workers=min(BULK_WORKERS, len(assigned))) as pool:
+            list(pool.map(tracing.wrap(lambda item: self.ec2.create_tags(
+                Resources=[item[0]], Tags=[{"Key": USER_TAG, "Value": item[1]}]
+            )), assigned.items()))
+
+        print(f"⏳ Waiting for {len(assigned)} instances to start...")
+        vm_ids = list(assigned)
+        started = time.perf_counter()
+        try:
+            with tracing.child_span("provision.instance_running", instances=len(vm_ids)):
+                self.ec2.get_waiter("instance_running").wait(InstanceIds=vm_ids)
+            for platform in set(platforms.values()):
+                PROVISION_STAGES.observe(time.perf_counter() - started, platform=platform, stage="instance_running")
+        except WaiterError as e:
+            # One instance failing to start fails the waiter; keep the ones that did start
+            print(f"⚠️ Not every instance started: {str(e)}")
+        try:
+            ips = self._public_ips(vm_ids)
+        except ClientError as e:
+            print(f"❌ Error describing instances: {str(e)}")
+            ips = {}
+        for vm_id in vm_ids:
+            if vm_id not in ips:
+                self.terminate_vm(vm_id)
+        vm_ids = [vm_id for vm_id in vm_ids if vm_id in ips]
+        if not vm_ids:
+            return {}
+
+        def ready(vm_id):
+            with provision_stage(platforms[vm_id], "agent_ready", vm_id=vm_id, vm_ip=ips[vm_id]):
+                return self.wait_for_agent(ips[vm_id], poll_intervals[vm_id], 1800 // poll_intervals[vm_id])
+
+        # One poller per instance: they mostly sleep, and a shared few would serialize the boots
+        with ThreadPoolExecutor(max_workers=len(vm_ids)) as pool:
+            readiness = dict(zip(vm_ids, pool.map(tracing.wrap(ready), vm_ids)))
+        created = {}
+        for vm_id, is_ready in readiness.items():
+            PROVISIONS.inc(kind="bulk_create", platform=platforms[vm_id], outcome="ok" if is_ready else "failed")
+            if is_ready:
+                created[assigned[vm_id]] = (vm_id, ips[vm_id])
+            else:
+                self.terminate_vm(vm_id)
+        print(f"✅ {len(created)}/{len(seats)} VMs created")
+        return created
+
+    def wait_for_agent(self, ip_address, poll_interval, max_attempts):
+        """Poll the VM agent until it answers; False if it never does."""
+        # Failures are expected while the VM boots, so this client's circuit never opens
+        boot_client = VMClient(
+            ip_address, retries=0, breaker=CircuitBreaker(failure_threshold=float("inf")), traced=False
+        )
+        print(f"⏳ Waiting for Flask server at {ip_address}:5000...")
+        for attempt in range(max_attempts):
+            try:
+                response = boot_client.get("", timeout=20)
+                if response.status_code == 200:
+                    print(f"✅ Flask server ready at {ip_address}:5000 after {attempt + 1} attempts")
+                    return True
+            except requests.RequestException as e:
+                print(f"⏳ Attempt {attempt + 1}/{max_attempts}: Waiting for Flask... ({str(e)})")
+                time.sleep(poll_interval)
+        print(f"❌ Flask server not ready after {max_attempts * poll_interval // 60} minutes at {ip_address}:5000")
+        return False
+
+    def get_vm_state(self, vm_id):
+        """EC2 state name of the instance ("running", "stopped", ...), or None if it is gone."""
+        try:
+            reservations = self.ec2.describe_instances(InstanceIds=[vm_id])["Reservations"]
+        except ClientError as e:
+            print(f"❌ Error describing VM {vm_id}: {str(e)}")
+            return None
+        for reservation in reservations:
+            for instance in reservation["Instances"]:
+                return instance["State"]["Name"]
+        return None
+
+    def stop_vm(self, vm_id):
+        """Stops the instance but keeps it (and its disk) for a later resume_vm().
+
+        A plain stop: hibernation would need instances launched with it configured
+        and an encrypted root volume sized for their memory, which ours are not.
+        """
+        try:
+            self.ec2.stop_instances(InstanceIds=[vm_id])
+            print(f"💤 VM {vm_id} stopping.")
+            if self.active_vm_id == vm_id:
+                self.active_vm_id = None
+            return True
+        except Exception as e:
+            print(f"❌ Error stopping VM: {str(e)}")
+            return False
+
+    def resume_vm(self, vm_id, platform="windows"):
+        """Starts a stopped instance and waits for its agent; returns (vm_id, ip) or (None, None).
+
+        The public IP changes across a stop, so callers must use the one returned.
+        """
+        state = self.get_vm_state(vm_id)
+        if state in (None, "shutting-down", "terminated"):
+            print(f"❌ VM {vm_id} cannot be resumed (state: {state})")
+            return None, None
+        try:
+            if state == "stopping":
+                print(f"⏳ VM {vm_id} is still stopping...")
+                self.ec2.get_waiter("instance_stopped").wait(InstanceIds=[vm_id])
+                state = "stopped"
+            with provision_stage(platform, "resume_running"):
+                if state == "stopped":
+                    print(f"▶️ Resuming VM {vm_id}")
+                    self.ec2.start_instances(InstanceIds=[vm_id])
+                self.ec2.get_waiter("instance_running").wait(InstanceIds=[vm_id])
+                vm_info = self.ec2.describe_instances(InstanceIds=[vm_id])
+                ip_address = vm_info["Reservations"][0]["Instances"][0].get("PublicIpAddress", "Pending")
+        except Exception as e:
+            print(f"❌ Error resuming VM {vm_id}: {str(e)}")
+            PROVISIONS.inc(kind="resume", platform=platform, outcome="failed")
+            return None, None
+
+        # Everything is installed already, so the agent is up as soon as the OS is
+        poll_interval = 3 if platform == "linux" else 5
+        with provision_stage(platform, "resume_agent_ready"):
+            ready = self.wait_for_agent(ip_address, poll_interval, 600 // poll_interval)
+        if not ready:
+            PROVISIONS.inc(kind="resume", platform=platform, outcome="failed")
+            return None, None
+        self.active_vm_id = vm_id
+        print(f"✅ VM Resumed: ID={vm_id}, IP={ip_address}")
+        PROVISIONS.inc(kind="resume", platform=platform, outcome="ok")
+        return vm_id, ip_address
+
+    def list_managed_vms(self, states=("pending", "running", "stopping", "stopped")):
+        """All instances launched by Cloud RAM, as dicts with id, state, ip, user and launch time."""
+        vms = []
+        paginator = self.ec2.get_paginator("describe_instances")
+        filters = [
+            {"Name": f"tag:{MANAGED_TAG}", "Values": ["true"]},
+            {"Name": "instance-state-name", "Values": list(states)},
+        ]
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    vms.append(self._managed_vm(instance))
+        return vms
+
+    @staticmethod
+    def _managed_vm(instance):
+        tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])}
+        return {
+            "vm_id": instance["InstanceId"],
+            "state": instance["State"]["Name"],
+            "ip": instance.get("PublicIpAddress"),
+            "user_id": tags.get(USER_TAG),
+            "launched_at": instance["LaunchTime"].timestamp(),
+        }
+
+    def adopt_vm(self, vm_id, user_id):
+        """Find a mapped instance that list_managed_vms() missed and tag it as ours.
+
+        Instances launched before the CloudRAM tag existed are not listed. Returns
+        the instance as list_managed_vms() would, or None if EC2 no longer has it.
+        Other errors are raised: a failed lookup does not mean the VM is gone.
+        """
+        try:
+            reservations = self.ec2.describe_instances(InstanceIds=[vm_id])["Reservations"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "InvalidInstanceID.NotFound":
+                return None
+            raise
+        for reservation in reservations:
+            for instance in reservation["Instances"]:
+                if instance["State"]["Name"] in ("shutting-down", "terminated"):
+                    return None
+                tags = [{"Key": MANAGED_TAG, "Value": "true"}, {"Key": USER_TAG, "Value": user_id}]
+                self.ec2.create_tags(Resources=[vm_id], Tags=tags)
+                print(f"🏷️ Tagged {vm_id} of {user_id}, launched before Cloud RAM tagged its instances")
+                return self._managed_vm(instance)
+        return None
+
+    def resize_vm(self, vm_id, instance_type, platform="windows"):
+        """Stops the instance, changes its type and starts it again.
+
+        Returns (vm_id, ip, resized); if the type change fails the VM is started
+        at its old size and resized is False. The disk survives, so synced files
+        and app state are still there; apps that were running have to be
+        relaunched by the caller.
+        """
+        resized = False
+        try:
+            print(f"📐 Resizing VM {vm_id} to {instance_type}")
+            # The type can only be changed while the instance is stopped
+            self.ec2.stop_instances(InstanceIds=[vm_id])
+            self.ec2.get_waiter("instance_stopped").wait(InstanceIds=[vm_id])
+            self.ec2.modify_instance_attribute(InstanceId=vm_id, InstanceType={"Value": instance_type})
+            resized = True
+        except Exception as e:
+            print(f"❌ Error resizing VM {vm_id}: {str(e)}")
+        # Started either way, so the user is never left without a VM
+        vm_id, ip_address = self.resume_vm(vm_id, platform)
+        return vm_id, ip_address, resized
+
     def terminate_vm(self, vm_id):
         """Terminates the EC2 instance."""
         try:
@@ -206,23 +586,39 @@ class AWSManager:
     def get_vm_status(self, vm_ip):
         """Check VM's running processes and resource usage."""
         try:
-            url = f"http://{vm_ip}:5000/ram_usage"
-            response = requests.get(url, timeout=10)
-            if response.status_code != 200:
-                return {"error": f"Failed to fetch status, status code: {response.status_code}"}
-            return response.json()
+            response = get_vm_client(vm_ip).get("ram_usage")
+        except requests.RequestException as e:
+            print(f"❌ Error fetching VM status: {str(e)}")
+            return {"error": str(e)}
+        return self._vm_status(response)
+
+    async def get_vm_status_async(self, vm_ip):
+        """get_vm_status() without blocking the event loop."""
+        try:
+            response = await get_vm_client(vm_ip).aget("ram_usage")
         except requests.RequestException as e:
             print(f"❌ Error fetching VM status: {str(e)}")
             return {"error": str(e)}
+        return self._vm_status(response)
 
-    def get_existing_vm(self):
-        """Check if an active VM already exists."""
+    def _vm_status(self, response):
+        if response.status_code != 200:
+            return {"error": f"Failed to fetch status, status code: {response.status_code}"}
+        return response.json()
+
+    def get_existing_vm(self, user_id=None):
+        """Check if an active VM already exists for this user (pool VMs do not count)."""
         try:
             instances = self.ec2.describe_instances(
-                Filters=[{"Name": "instance-state-name", "Values": ["pending", "running"]}]
+                Filters=[
+                    {"Name": "instance-state-name", "Values": ["pending", "running"]},
+                    {"Name": f"tag:{USER_TAG}", "Values": [user_id or "unassigned"]},
+                ]
             )
             for reservation in instances["Reservations"]:
                 for instance in reservation["Instances"]:
+                    if any(tag["Key"] == POOL_TAG for tag in instance.get("Tags", [])):
+                        continue
                     if "InstanceId" in instance:
                         vm_id = instance["InstanceId"]
                         ip_address = instance.get("PublicIpAddress", "Pending")
@@ -236,20 +632,17 @@ class AWSManager:
     def install_application_on_vm(self, vm_ip, app_name):
         """Dynamically install an application on the VM if not present."""
         try:
-            response = requests.get(f"http://{vm_ip}:5000/list_tasks", timeout=10)
+            client = get_vm_client(vm_ip)
+            response = client.get("list_tasks")
             if response.status_code == 200:
                 tasks = response.json().get("tasks", [])
                 if any(task["name"].lower() == app_name.lower() for task in tasks):
                     print(f"✅ {app_name} already running on VM {vm_ip}")
                     return True
-            session = requests.Session()
-            if Retry:
-                retry_strategy = Retry(total=3, backoff_factor=2, status_forcelist=[500, 502, 503, 504])
-                adapter = HTTPAdapter(max_retries=retry_strategy)
-                session.mount("http://", adapter)
             install_payload = {"app_name": app_name}
             print(f"⏳ Attempting to install {app_name} on VM {vm_ip}")
-            response = session.post(f"http://{vm_ip}:5000/install_app", json=install_payload, timeout=120)
+            # Installing an app that is already there is a no-op, so this may be retried
+            response = client.post("install_app", install_payload, timeout=120, idempotent=True)
             if response.status_code == 200:
                 print(f"✅ Successfully installed {app_name} on VM {vm_ip}")
                 return True
@@ -274,9 +667,9 @@ class AWSManager:
                 return None
             
             print(f"⏳ Migrating {task_name} with UI streaming to VM {vm_ip}")
-            response = requests.post(
-                f"http://{vm_ip}:5000/migrate_task_with_ui",
-                json={"task_name": task_name, "task_data": {"state": "auto_migrated"}},
+            response = get_vm_client(vm_ip).post(
+                "migrate_task_with_ui",
+                {"task_name": task_name, "task_data": {"state": "auto_migrated"}},
                 timeout=60
             )
         
@@ -0,0 +1,145 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Linux ioctl for copy-on-write clones (btrfs, xfs with reflink=1, ...)
+FICLONE = 0x40049409
+
+
+def _sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _try_reflink(src, dest):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, "rb") as s, open(dest, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dest)
+        return True
+    except OSError:
+        return False
+
+
+class BackupSnapshotter:
+    """
+    Keeps an incremental mirror of Notepad++'s backup directory.
+
+    A (size, mtime, sha256) index of the source is stored next to the snapshots.
+    Buffers whose size and mtime are unchanged are skipped without reading them;
+    the hash is only computed when those differ, and a copy is only made when
+    the content really changed. Snapshots whose buffer disappeared from the
+    backup dir are garbage-collected on every run.
+
+    link_mode:
+      "auto"     - reflink where the filesystem supports it, else copy
+      "hardlink" - hardlink, else copy. Only safe if the app replaces backup
+                   files rather than rewriting them in place
+      "copy"     - always copy
+    """
+
+    INDEX_FILE = ".snapshot_index.json"
+
+    def __init__(self, source_dir, snapshot_dir, link_mode="auto"):
+        self.source_dir = source_dir
+        self.snapshot_dir = snapshot_dir
+        self.link_mode = link_mode
+        self.index_path = os.path.join(snapshot_dir, self.INDEX_FILE)
+        self.last_stats = {}
+        os.makedirs(snapshot_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _materialize(self, src, dest):
+        """Place a point-in-time copy of src at dest without a partially written window"""
+        tmp_path = dest + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if self.link_mode == "hardlink":
+            try:
+                os.link(src, tmp_path)
+                os.replace(tmp_path, dest)
+                return "hardlink"
+            except OSError:
+                pass
+        elif self.link_mode == "auto" and _try_reflink(src, tmp_path):
+            os.replace(tmp_path, dest)
+            return "reflink"
+        shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, dest)
+        return "copy"
+
+    def snapshot(self):
+        """Bring the snapshot dir in line with the backup dir; returns the snapshot paths"""
+        stats = {"unchanged": 0, "copied": 0, "removed": 0}
+        current = {}
+        snapshots = []
+
+        if os.path.isdir(self.source_dir):
+            for entry in os.scandir(self.source_dir):
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                dest = os.path.join(self.snapshot_dir, entry.name)
+                known = self.index.get(entry.name)
+                if known and known["size"] == st.st_size and known["mtime_ns"] == st.st_mtime_ns and os.path.exists(dest):
+                    current[entry.name] = known
+                    stats["unchanged"] += 1
+                else:
+                    digest = _sha256(entry.path)
+                    if not (known and known["sha256"] == digest and os.path.exists(dest)):
+                        method = self._materialize(entry.path, dest)
+                        stats["copied"] += 1
+                        logger.info(f"Snapshotted unsaved buffer {entry.name} ({method})")
+                    else:
+                        stats["unchanged"] += 1
+                    current[entry.name] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+                snapshots.append(dest)
+        else:
+            logger.warning(f"Backup directory {self.source_dir} does not exist")
+
+        # Garbage-collect snapshots of buffers that were saved or closed since
+        for name in os.listdir(self.snapshot_dir):
+            if name == self.INDEX_FILE or name in current:
+                continue
+            path = os.path.join(self.snapshot_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+                stats["removed"] += 1
+
+        self.index = current
+        self._save_index()
+        self.last_stats = stats
+        logger.info(f"Backup snapshot: {stats}")
+        return snapshots
+
+    def clear(self):
+        """Drop every snapshot and the index"""
+        for name in os.listdir(self.snapshot_dir):
+            path = os.path.join(self.snapshot_dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+        self.index = {}
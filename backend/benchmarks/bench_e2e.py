@@ -0,0 +1,221 @@
+"""
+End-to-end benchmark of the backend and the VM agent against local stand-ins
+(see local_stack.py), runnable offline:
+
+- allocate: POST /allocate/ for a new user, through launch, boot and agent readiness
+- migrate: POST /migrate_tasks/ for VS Code and Chrome, to the agent
+- sync: sync_notepad_files() of changed tracked files, until the VM has them
+- sync_unchanged: the same round when nothing changed
+
+Each scenario reports latency percentiles and the AWS requests it made per
+iteration (both sides, by service and operation). Results are compared with a
+baseline file and the exit status is 1 on a regression: latency or throughput
+worse than the tolerance allows, or any operation making more requests than
+before. --record writes the baseline instead.
+
+    python benchmarks/bench_e2e.py --iterations 5 --files 200
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+from local_stack import LocalStack
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "e2e.json")
+QUIET_PERIOD = 0.5  # no AWS requests for this long means the agent's background work is done
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def latency_summary(samples):
+    return {
+        "p50": round(percentile(samples, 0.5), 4),
+        "p95": round(percentile(samples, 0.95), 4),
+        "mean": round(statistics.mean(samples), 4),
+        "min": round(min(samples), 4),
+        "max": round(max(samples), 4),
+    }
+
+
+def wait_quiet(aws, timeout=30):
+    """Wait until the stand-in has seen no requests for QUIET_PERIOD"""
+    deadline = time.monotonic() + timeout
+    last = aws.snapshot_counts()
+    while time.monotonic() < deadline:
+        time.sleep(QUIET_PERIOD)
+        now = aws.snapshot_counts()
+        if now == last:
+            return
+        last = now
+
+
+def run_scenario(stack, name, iterations, setup, action):
+    """Time action() over iterations (setup() runs untimed before each); AWS requests per iteration"""
+    wait_quiet(stack.aws)
+    stack.aws.reset_counts()
+    samples = []
+    for n in range(iterations):
+        if setup:
+            setup(n)
+        started = time.perf_counter()
+        action(n)
+        samples.append(time.perf_counter() - started)
+        print(f"  {name} {n + 1}/{iterations}: {samples[-1] * 1000:.1f} ms", file=sys.stderr)
+    wait_quiet(stack.aws)
+    counts = stack.aws.snapshot_counts()
+    return {
+        "iterations": iterations,
+        "latency": latency_summary(samples),
+        "requests": {op: round(count / iterations, 2) for op, count in sorted(counts.items())},
+        "requests_total": round(sum(counts.values()) / iterations, 2),
+    }
+
+
+def checked(response):
+    response.raise_for_status()
+    return response.json()
+
+
+def run(args):
+    with LocalStack(workdir=args.workdir, aws_latency=args.aws_latency_ms / 1000, verbose=args.verbose) as stack:
+        results = {}
+        vm_ips = {}
+
+        def allocate(n):
+            session = stack.session(f"bench-user-{n}")
+            vm_ips[n] = checked(session.post(f"{stack.api_url}/allocate/", json={"ram_size": 4, "platform": "linux"}))["ip"]
+
+        print("allocate", file=sys.stderr)
+        results["allocate"] = run_scenario(stack, "allocate", args.iterations, None, allocate)
+        vm_ip = vm_ips[0]
+        session = stack.session("bench-user-0")
+
+        def migrate(n):
+            response = checked(session.post(
+                f"{stack.api_url}/migrate_tasks/", json={"task_names": ["Code.exe", "chrome.exe"], "vm_ip": vm_ip}
+            ))
+            failed = [r["task"] for r in response["results"] if not r["success"]]
+            if failed:
+                raise RuntimeError(f"Migration of {failed} failed")
+
+        print("migrate", file=sys.stderr)
+        results["migrate"] = run_scenario(
+            stack, "migrate", args.iterations, lambda n: stack.start_apps("Code.exe", "chrome.exe"), migrate
+        )
+
+        notes_dir = stack.path("client", "notes")
+        os.makedirs(notes_dir, exist_ok=True)
+        tracked = [os.path.join(notes_dir, f"note_{n:05d}.txt") for n in range(args.files)]
+        file_bytes = args.file_kb * 1024
+
+        def edit_all(n):
+            # S3 keeps whole seconds and sync compares mtimes with it: edits made on a fresh
+            # whole second are newer than the last upload and never newer than the next one
+            time.sleep(1 - time.time() % 1)
+            edited_at = int(time.time())
+            for file_path in tracked:
+                with open(file_path, "wb") as f:
+                    f.write(os.urandom(file_bytes))
+                os.utime(file_path, (edited_at, edited_at))
+            stack.main.process_manager.tracked_files = set(tracked)
+
+        def sync(n):
+            stack.main.process_manager.sync_notepad_files(vm_ip)
+
+        print("sync", file=sys.stderr)
+        results["sync"] = run_scenario(stack, "sync", args.iterations, edit_all, sync)
+        p50 = results["sync"]["latency"]["p50"]
+        results["sync"].update({
+            "files": args.files,
+            "bytes": args.files * file_bytes,
+            "files_per_second": round(args.files / p50, 1),
+            "mb_per_second": round(args.files * file_bytes / p50 / 1e6, 2),
+        })
+        print("sync_unchanged", file=sys.stderr)
+        results["sync_unchanged"] = run_scenario(stack, "sync_unchanged", args.iterations, None, sync)
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """Regressions of results against baseline, as messages"""
+    regressions = []
+    for scenario, result in results.items():
+        base = baseline.get(scenario)
+        if not base:
+            continue
+        p50, base_p50 = result["latency"]["p50"], base["latency"]["p50"]
+        if p50 > base_p50 * (1 + tolerance) and p50 - base_p50 > min_delta:
+            regressions.append(f"{scenario}: p50 {p50 * 1000:.1f} ms, baseline {base_p50 * 1000:.1f} ms")
+        if "mb_per_second" in base and result["mb_per_second"] < base["mb_per_second"] / (1 + tolerance):
+            regressions.append(f"{scenario}: {result['mb_per_second']} MB/s, baseline {base['mb_per_second']} MB/s")
+        for op, count in result["requests"].items():
+            if count > base["requests"].get(op, 0):
+                regressions.append(f"{scenario}: {count} {op} per iteration, baseline {base['requests'].get(op, 0)}")
+    return regressions
+
+
+def print_report(results):
+    for scenario, result in results.items():
+        latency = result["latency"]
+        line = f"{scenario:<16} p50 {latency['p50'] * 1000:8.1f} ms  p95 {latency['p95'] * 1000:8.1f} ms"
+        if "mb_per_second" in result:
+            line += f"  {result['files_per_second']} files/s  {result['mb_per_second']} MB/s"
+        print(line)
+        for op, count in result["requests"].items():
+            print(f"{'':<16} {count:8} {op}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--files", type=int, default=200, help="tracked files changed in each sync round")
+    parser.add_argument("--file-kb", type=int, default=4)
+    parser.add_argument("--aws-latency-ms", type=float, default=0, help="delay added to every AWS request")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--record", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative slowdown")
+    parser.add_argument("--min-delta-ms", type=float, default=20, help="slowdowns smaller than this are noise")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--workdir", help="keep the stack's files here instead of a temporary directory")
+    parser.add_argument("--verbose", action="store_true", help="show backend output and logs")
+    args = parser.parse_args()
+
+    settings = {"iterations": args.iterations, "files": args.files, "file_kb": args.file_kb,
+                "aws_latency_ms": args.aws_latency_ms}
+    results = run(args)
+    print_report(results)
+    report = {"settings": settings, "scenarios": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.record:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --record to create one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != settings:
+        # Latencies and per-iteration request counts both depend on them
+        print(f"Baseline was recorded with {baseline.get('settings')}, not comparing")
+        return 0
+    regressions = compare(results, baseline["scenarios"], args.tolerance, args.min_delta_ms / 1000)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print("No regressions" if not regressions else f"{len(regressions)} regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,341 @@
+"""
+Stress benchmark of file sync with a large working set, against the local
+stand-ins (see local_stack.py):
+
+- track: add_tracked_file() for every file
+- initial_sync: sync_notepad_files() of all of them, until the VM has fetched each one
+- vm_full_sync: the agent's full-bucket /sync_notepad_files
+- bursts: edits to many tracked files at once with the watcher running, each
+  timed from the write until S3 has that content (edit_to_s3) and until the VM
+  fetched it (edit_to_vm); edits whose content never reaches the VM are lost
+
+Every phase reports the CPU time and peak memory of the local side (this
+process, which runs the backend) and of the VM agent, and the AWS requests
+made per file or per edit. Results are compared with a baseline as in
+bench_e2e.py: slower, hungrier, more requests, more lost edits or fewer files
+synced than the tolerance allows exits with 1.
+
+    python benchmarks/bench_sync.py --files 10000 --bursts 3 --burst 2000
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+
+import psutil
+import requests
+
+from local_stack import LocalStack
+from bench_e2e import percentile, checked
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "sync.json")
+QUIET_PERIOD = 3  # longer than the watcher's 2 s debounce
+WATCHER_METRIC = re.compile(r'^cloud_ram_watcher_events_total\{side="(\w+)",outcome="(\w+)"\} (\S+)$')
+
+
+def latency_summary(samples):
+    if not samples:
+        return None
+    return {
+        "p50": round(percentile(samples, 0.5), 4),
+        "p95": round(percentile(samples, 0.95), 4),
+        "p99": round(percentile(samples, 0.99), 4),
+        "max": round(max(samples), 4),
+    }
+
+
+class ResourceMonitor:
+    """CPU time and peak resident memory of each process, per phase"""
+
+    def __init__(self, pids, interval=0.05):
+        self.processes = {side: psutil.Process(pid) for side, pid in pids.items()}
+        self.interval = interval
+        self.phases = {}
+        self._peaks = {side: 0 for side in self.processes}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._sample, daemon=True, name="resource-monitor").start()
+
+    def _sample(self):
+        while True:
+            for side, process in self.processes.items():
+                try:
+                    rss = process.memory_info().rss
+                except psutil.Error:
+                    continue
+                with self._lock:
+                    self._peaks[side] = max(self._peaks[side], rss)
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _cpu(process):
+        times = process.cpu_times()
+        return times.user + times.system
+
+    @contextmanager
+    def phase(self, name):
+        with self._lock:
+            self._peaks = {side: process.memory_info().rss for side, process in self.processes.items()}
+        cpu = {side: self._cpu(process) for side, process in self.processes.items()}
+        yield
+        with self._lock:
+            peaks = dict(self._peaks)
+        self.phases[name] = {
+            side: {
+                "cpu_seconds": round(self._cpu(process) - cpu[side], 2),
+                "peak_rss_mb": round(peaks[side] / 2 ** 20, 1),
+            }
+            for side, process in self.processes.items()
+        }
+
+
+def wait_quiet(aws, timeout, quiet=QUIET_PERIOD):
+    """Wait until the stand-in has seen no requests for quiet seconds; False on timeout"""
+    deadline = time.monotonic() + timeout
+    last = aws.snapshot_counts()
+    while time.monotonic() < deadline:
+        time.sleep(quiet)
+        now = aws.snapshot_counts()
+        if now == last:
+            return True
+        last = now
+    return False
+
+
+def per_item(counts, items):
+    return {op: round(count / items, 3) for op, count in sorted(counts.items())}
+
+
+def watcher_events(url):
+    """{"side.outcome": events} from a /metrics endpoint"""
+    events = {}
+    for line in requests.get(f"{url}/metrics", timeout=10).text.splitlines():
+        match = WATCHER_METRIC.match(line)
+        if match:
+            events[f"{match.group(1)}.{match.group(2)}"] = float(match.group(3))
+    return events
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    file_bytes = args.file_kb * 1024
+    with LocalStack(workdir=args.workdir, workspace_files=0, record_events=True, verbose=args.verbose) as stack:
+        manager = stack.main.process_manager
+        vm_ip = checked(stack.session("stress-user").post(
+            f"{stack.api_url}/allocate/", json={"ram_size": 4, "platform": "linux"}
+        ))["ip"]
+        agent_url = f"http://{vm_ip}:{stack.agent_port}"
+        monitor = ResourceMonitor({"local": os.getpid(), "vm": stack.agent.pid})
+        results = {}
+
+        notes_dir = stack.path("client", "notes")
+        os.makedirs(notes_dir, exist_ok=True)
+        files = [os.path.join(notes_dir, f"note_{n:05d}.txt") for n in range(args.files)]
+        for file_path in files:
+            with open(file_path, "wb") as f:
+                f.write(os.urandom(file_bytes))
+
+        print(f"track {args.files} files", file=sys.stderr)
+        with monitor.phase("track"):
+            started = time.perf_counter()
+            for file_path in files:
+                manager.add_tracked_file(file_path)
+            results["track"] = {"seconds": round(time.perf_counter() - started, 3)}
+
+        print("initial_sync", file=sys.stderr)
+        wait_quiet(stack.aws, args.drain_timeout)
+        stack.aws.reset_counts()
+        with monitor.phase("initial_sync"):
+            started = time.time()
+            manager.sync_notepad_files(vm_ip)
+            uploaded = time.time()
+            wait_quiet(stack.aws, args.drain_timeout)
+        fetched = {}
+        for at, op, key, _ in stack.aws.events():
+            if op == "s3.GetObject":
+                fetched.setdefault(key, at)
+        synced = [fetched[os.path.basename(f)] for f in files if os.path.basename(f) in fetched]
+        results["initial_sync"] = {
+            "upload_seconds": round(uploaded - started, 3),
+            "vm_seconds": round(max(synced) - started, 3) if synced else None,
+            "files_missing_on_vm": args.files - len(synced),
+            "requests_per_file": per_item(stack.aws.snapshot_counts(), args.files),
+        }
+
+        print("vm_full_sync", file=sys.stderr)
+        stack.aws.reset_counts()
+        with monitor.phase("vm_full_sync"):
+            started = time.perf_counter()
+            checked(requests.post(f"{agent_url}/sync_notepad_files", json={}, timeout=args.drain_timeout))
+            seconds = time.perf_counter() - started
+        counts = stack.aws.snapshot_counts()
+        results["vm_full_sync"] = {
+            "seconds": round(seconds, 3),
+            "files_missing": args.files - counts.get("s3.GetObject", 0),
+            "requests_per_file": per_item(counts, args.files),
+        }
+
+        # The watcher also watches the Notepad++ directory, which has to exist
+        manager.notepad_dir = stack.path("client", "AppData", "Roaming", "Notepad++")
+        os.makedirs(manager.notepad_dir, exist_ok=True)
+        manager.start_notepad_auto_sync(vm_ip)
+        deadline = time.monotonic() + 30
+        while not manager.sync_running:
+            if time.monotonic() > deadline:
+                raise RuntimeError("The file watcher did not start")
+            time.sleep(0.1)
+
+        print(f"bursts: {args.bursts} x {args.burst} edits", file=sys.stderr)
+        wait_quiet(stack.aws, args.drain_timeout)
+        stack.aws.reset_counts()
+        watched_before = watcher_events(stack.api_url)
+        edits = []  # (burst, key, edited at, md5 of the content written)
+        with monitor.phase("bursts"):
+            for burst in range(args.bursts):
+                for file_path in rng.sample(files, args.burst):
+                    content = os.urandom(file_bytes)
+                    edited_at = time.time()
+                    with open(file_path, "wb") as f:
+                        f.write(content)
+                    edits.append((burst, os.path.basename(file_path), edited_at, hashlib.md5(content).hexdigest()))
+                drained = wait_quiet(stack.aws, args.drain_timeout)
+                print(f"  burst {burst + 1}/{args.bursts} {'drained' if drained else 'timed out'}", file=sys.stderr)
+        watched = watcher_events(stack.api_url)
+
+        first = {}  # (op, key, etag) -> first time
+        for at, op, key, etag in stack.aws.events():
+            first.setdefault((op, key, etag), at)
+        to_s3, to_vm, drain = [], [], {}
+        for burst, key, edited_at, digest in edits:
+            at_s3 = first.get(("s3.PutObject", key, digest))
+            at_vm = first.get(("s3.GetObject", key, digest))
+            if at_s3 is not None:
+                to_s3.append(at_s3 - edited_at)
+            if at_vm is not None:
+                to_vm.append(at_vm - edited_at)
+                drain.setdefault(burst, [edited_at, at_vm])
+                drain[burst][1] = max(drain[burst][1], at_vm)
+        results["bursts"] = {
+            "edits": len(edits),
+            "lost": len(edits) - len(to_vm),
+            "edit_to_s3": latency_summary(to_s3),
+            "edit_to_vm": latency_summary(to_vm),
+            "drain_seconds": [round(end - start, 3) for start, end in drain.values()],
+            "requests_per_edit": per_item(stack.aws.snapshot_counts(), len(edits)),
+            "watcher_events": {
+                name: count - watched_before.get(name, 0) for name, count in sorted(watched.items())
+                if count - watched_before.get(name, 0)
+            },
+        }
+        results["resources"] = monitor.phases
+    return results
+
+
+# (path in the results, kind): "time" and "memory" may grow by the tolerance, "count" may not grow at all
+CHECKS = [
+    ("track.seconds", "time"),
+    ("initial_sync.upload_seconds", "time"),
+    ("initial_sync.vm_seconds", "time"),
+    ("initial_sync.files_missing_on_vm", "count"),
+    ("initial_sync.requests_per_file", "count"),
+    ("vm_full_sync.seconds", "time"),
+    ("vm_full_sync.files_missing", "count"),
+    ("vm_full_sync.requests_per_file", "count"),
+    ("bursts.lost", "count"),
+    ("bursts.edit_to_s3.p95", "time"),
+    ("bursts.edit_to_vm.p95", "time"),
+    ("bursts.requests_per_edit", "count"),
+] + [
+    (f"resources.{phase}.{side}.{measure}", kind)
+    for phase in ("track", "initial_sync", "vm_full_sync", "bursts")
+    for side in ("local", "vm")
+    for measure, kind in (("cpu_seconds", "time"), ("peak_rss_mb", "memory"))
+]
+
+
+def lookup(results, path):
+    for part in path.split("."):
+        if not isinstance(results, dict):
+            return None
+        results = results.get(part)
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta, min_memory_delta):
+    """Regressions of results against baseline, as messages"""
+    regressions = []
+    for path, kind in CHECKS:
+        current, base = lookup(results, path), lookup(baseline, path)
+        if current is None or base is None:
+            continue
+        if isinstance(current, dict):
+            regressions += [
+                f"{path}: {count} {op}, baseline {base.get(op, 0)}"
+                for op, count in current.items() if count > base.get(op, 0)
+            ]
+        elif kind == "count" and current > base:
+            regressions.append(f"{path}: {current}, baseline {base}")
+        elif kind == "time" and current > base * (1 + tolerance) and current - base > min_delta:
+            regressions.append(f"{path}: {current} s, baseline {base} s")
+        elif kind == "memory" and current > base * (1 + tolerance) and current - base > min_memory_delta:
+            regressions.append(f"{path}: {current} MB, baseline {base} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=10000, help="tracked files")
+    parser.add_argument("--bursts", type=int, default=3)
+    parser.add_argument("--burst", type=int, default=2000, help="files edited in each burst")
+    parser.add_argument("--file-kb", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1, help="which files each burst edits")
+    parser.add_argument("--drain-timeout", type=float, default=900, help="longest wait for a phase to finish syncing")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--record", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative slowdown or memory growth")
+    parser.add_argument("--min-delta-s", type=float, default=1.0, help="slowdowns smaller than this are noise")
+    parser.add_argument("--min-memory-delta-mb", type=float, default=32)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--workdir", help="keep the stack's files here instead of a temporary directory")
+    parser.add_argument("--verbose", action="store_true", help="show backend output and logs")
+    args = parser.parse_args()
+    if args.burst > args.files:
+        parser.error("--burst cannot be larger than --files")
+
+    settings = {"files": args.files, "bursts": args.bursts, "burst": args.burst, "file_kb": args.file_kb,
+                "seed": args.seed}
+    results = run(args)
+    report = {"settings": settings, "results": results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.record:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --record to create one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != settings:
+        print(f"Baseline was recorded with {baseline.get('settings')}, not comparing")
+        return 0
+    regressions = compare(results, baseline["results"], args.tolerance, args.min_delta_s, args.min_memory_delta_mb)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print("No regressions" if not regressions else f"{len(regressions)} regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""
+The backend and the VM agent wired to local stand-ins, so they can be driven
+end to end without AWS, Cognito, Windows or a VM:
+
+- EC2, S3 and DynamoDB are a FakeAWS server in its own process, reached
+  through AWS_ENDPOINT_URL
+- Cognito is a locally generated RSA key whose JWKS is served over HTTP
+- the "VM" is vm_server.py on localhost with the stub launcher; every instance
+  FakeAWS launches reports 127.0.0.1 as its public IP
+- the apps on this side are FakePlatformOps, with VS Code and Chrome state
+  generated on disk
+
+Everything either side writes (logs, tracked_files.db, downloaded files) goes
+to a temporary working directory.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+from jose import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from fake_aws import FakeAWSProcess  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+APP_CLIENT_ID = "local-benchmark"
+KEY_ID = "local-benchmark-key"
+READY_TIMEOUT = 30
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+class LocalIdentityProvider:
+    """Signs Cognito-shaped access tokens and serves the JWKS that verifies them"""
+
+    def __init__(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        numbers = key.public_key().public_numbers()
+        self.jwks = {"keys": [{
+            "kty": "RSA", "kid": KEY_ID, "use": "sig", "alg": "RS256", "n": _b64(numbers.n), "e": _b64(numbers.e)
+        }]}
+        self._server = None
+
+    def start(self):
+        jwks = json.dumps(self.jwks).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200 if self.path == "/.well-known/jwks.json" else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(jwks)))
+                self.end_headers()
+                self.wfile.write(jwks)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="local-jwks").start()
+        return self.issuer
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def issuer(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def token(self, user_id, groups=(), ttl=3600):
+        now = int(time.time())
+        claims = {
+            "sub": user_id, "aud": APP_CLIENT_ID, "iss": self.issuer, "iat": now, "exp": now + ttl,
+            "token_use": "id", "cognito:groups": list(groups),
+        }
+        return jwt.encode(claims, self.private_pem.decode(), algorithm="RS256", headers={"kid": KEY_ID})
+
+
+class LocalStack:
+    """
+    Start with `with LocalStack() as stack:`; stack.main is the imported backend
+    (main.py), stack.session(user_id) an authenticated requests session for
+    stack.api_url, stack.aws the FakeAWSProcess holding the request counts and
+    stack.agent the agent's process.
+
+    The backend is imported into this process once its environment is set, so
+    only one LocalStack can run per process.
+    """
+
+    def __init__(self, workdir=None, aws_latency=0.0, boot_seconds=0.0, workspace_files=100,
+                 file_bytes=8 * 1024, record_events=False, verbose=False):
+        self.keep_workdir = workdir is not None
+        self.workdir = os.path.abspath(workdir) if workdir else tempfile.mkdtemp(prefix="cloud-ram-bench-")
+        self.workspace_files = workspace_files
+        self.file_bytes = file_bytes
+        self.verbose = verbose
+        self.aws = FakeAWSProcess(boot_seconds=boot_seconds, latency=aws_latency, record_events=record_events)
+        self.identity = LocalIdentityProvider()
+        self.agent_port = _free_port()
+        self.api_port = _free_port()
+        self.api_url = f"http://127.0.0.1:{self.api_port}"
+        self.main = None
+        self.agent = None
+        self._server = None
+        self._saved = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def path(self, *parts):
+        return os.path.join(self.workdir, *parts)
+
+    def start(self):
+        self._saved = (dict(os.environ), os.getcwd(), sys.stdout)
+        self.aws.start()
+        self.identity.start()
+        for name in ("AWS_PROFILE", "AWS_SESSION_TOKEN", "AWS_SECURITY_TOKEN"):
+            os.environ.pop(name, None)
+        os.environ.update({
+            "AWS_ENDPOINT_URL": self.aws.url,
+            "AWS_ACCESS_KEY_ID": "local-benchmark",
+            "AWS_SECRET_ACCESS_KEY": "local-benchmark",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "AWS_EC2_METADATA_DISABLED": "true",
+            "CLOUD_RAM_COGNITO_ISSUER": self.identity.issuer,
+            "CLOUD_RAM_COGNITO_APP_CLIENT_ID": APP_CLIENT_ID,
+            "CLOUD_RAM_AGENT_PORT": str(self.agent_port),
+            "CLOUD_RAM_PLATFORM_OPS": "fake",
+            "CLOUD_RAM_CATALOG_CACHE": self.path("instance_catalog_cache.json"),
+            "APPDATA": self.path("client", "AppData", "Roaming"),
+            "LOCALAPPDATA": self.path("client", "AppData", "Local"),
+        })
+        self._prepare_workdir()
+        self._start_agent()
+        self._start_backend()
+
+    def stop(self):
+        if self._server:
+            self._server.should_exit = True
+            self._thread.join(timeout=10)
+        if self.agent and self.agent.poll() is None:
+            self.agent.terminate()
+            try:
+                self.agent.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.agent.kill()
+        self.aws.stop()
+        self.identity.stop()
+        if self._saved:
+            environ, cwd, stdout = self._saved
+            os.environ.clear()
+            os.environ.update(environ)
+            os.chdir(cwd)
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+        if not self.keep_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # setup
+
+    def _prepare_workdir(self):
+        # The backend reads the agent files relative to its working directory (aws_manager.VM_AGENT_FILES)
+        shutil.copytree(os.path.join(BACKEND_DIR, "vm_scripts"), self.path("backend", "vm_scripts"),
+                        ignore=shutil.ignore_patterns("__pycache__"))
+        for name in ("process_snapshot.py", "metrics.py", "tracing.py"):
+            shutil.copy(os.path.join(BACKEND_DIR, name), self.path("backend", name))
+
+        # VS Code with one workspace open, and a Chrome profile
+        workspace = self.path("client", "projects", "bench-workspace")
+        for n in range(self.workspace_files):
+            folder = os.path.join(workspace, f"pkg{n % 10}")
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, f"module_{n}.py"), "wb") as f:
+                f.write(os.urandom(self.file_bytes // 2).hex().encode()[:self.file_bytes])
+        storage = os.path.join(os.environ["APPDATA"], "Code", "User", "globalStorage", "storage.json")
+        os.makedirs(os.path.dirname(storage), exist_ok=True)
+        with open(storage, "w") as f:
+            json.dump({"windowsState": {"lastActiveWindow": {"folder": "file://" + workspace}, "openedWindows": []}}, f)
+        user_data = os.path.join(os.environ["LOCALAPPDATA"], "Google", "Chrome", "User Data")
+        os.makedirs(os.path.join(user_data, "Default", "Sessions"), exist_ok=True)
+        for name in ("Local State", "Default/Bookmarks", "Default/Preferences", "Default/Current Session",
+                     "Default/Current Tabs", "Default/Sessions/Session_13370000000000000"):
+            with open(os.path.join(user_data, name), "wb") as f:
+                f.write(os.urandom(self.file_bytes))
+
+        # Stand-ins for the app executables on the "VM"; the stub launcher never runs them
+        apps = {}
+        for name in ("notepad++.exe", "code.exe", "chrome.exe"):
+            apps[name] = self.path("vm", "apps", name)
+            os.makedirs(os.path.dirname(apps[name]), exist_ok=True)
+            with open(apps[name], "w") as f:
+                f.write("#!/bin/sh\n")
+            os.chmod(apps[name], 0o755)
+        self._app_paths = apps
+        os.makedirs(self.path("vm", "home"), exist_ok=True)
+
+    def _start_agent(self):
+        env = dict(
+            os.environ,
+            CLOUD_RAM_AGENT_DIR=self.path("vm", "agent"),
+            CLOUD_RAM_LAUNCHER="stub",
+            CLOUD_RAM_APP_PATHS=json.dumps(self._app_paths),
+            HOME=self.path("vm", "home"),
+            PYTHONUNBUFFERED="1",
+        )
+        os.makedirs(env["CLOUD_RAM_AGENT_DIR"], exist_ok=True)
+        with open(self.path("vm", "agent.out"), "w") as out:
+            self.agent = subprocess.Popen(
+                [sys.executable, os.path.join(BACKEND_DIR, "vm_scripts", "vm_server.py")],
+                cwd=env["CLOUD_RAM_AGENT_DIR"], env=env, stdout=out, stderr=subprocess.STDOUT
+            )
+        deadline = time.monotonic() + READY_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.agent.poll() is not None:
+                raise RuntimeError(f"VM agent exited with {self.agent.returncode}, see {self.path('vm', 'agent.out')}")
+            try:
+                if requests.get(f"http://127.0.0.1:{self.agent_port}/", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError(f"VM agent did not answer within {READY_TIMEOUT}s")
+
+    def _start_backend(self):
+        import uvicorn
+
+        os.chdir(self.path("backend"))
+        # The backend reports progress with print() and logs to the console; keep both in files unless asked for
+        if not self.verbose:
+            sys.stdout = open(self.path("backend", "stdout.log"), "w", buffering=1)
+            logging.basicConfig(
+                level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s",
+                handlers=[logging.FileHandler(self.path("backend", "backend.log"))]
+            )
+        import main
+        self.main = main
+        config = uvicorn.Config(main.app, host="127.0.0.1", port=self.api_port, lifespan="off",
+                                log_level="warning", access_log=False)
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True, name="backend")
+        self._thread.start()
+        deadline = time.monotonic() + READY_TIMEOUT
+        while not self._server.started:
+            if time.monotonic() > deadline or not self._thread.is_alive():
+                raise RuntimeError("Backend did not start")
+            time.sleep(0.05)
+
+    # driving it
+
+    def session(self, user_id, groups=()):
+        """requests session authenticated as user_id"""
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {self.identity.token(user_id, groups)}"
+        return session
+
+    def start_apps(self, *image_names):
+        """Have the apps running on the client side (FakePlatformOps)"""
+        for image_name in image_names:
+            if not self.main.process_manager.platform.is_running(image_name):
+                self.main.process_manager.platform.start_app(image_name)
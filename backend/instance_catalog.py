@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.getenv(
+    "CLOUD_RAM_CATALOG_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance_catalog_cache.json")
+)
+CACHE_MAX_AGE = 24 * 3600
+
+# Families we launch: burstable for small requests, general purpose and memory
+# optimized (r*) for the 16-64 GB users. Graviton (arm64) only suits Linux VMs.
+FAMILIES = ("t3", "t3a", "t4g", "m6i", "m6a", "m7g", "r6i", "r6a", "r7g")
+
+# On-demand Linux price per GiB-hour in us-east-1. Within each family the price
+# scales linearly with memory, so this ranks every size without the Pricing API.
+FAMILY_PRICE_PER_GIB_HOUR = {
+    "t3": 0.0104,
+    "t3a": 0.0094,
+    "t4g": 0.0084,
+    "m6i": 0.012,
+    "m6a": 0.0108,
+    "m7g": 0.0102,
+    "r6i": 0.007875,
+    "r6a": 0.0070875,
+    "r7g": 0.0067,
+}
+# Windows instances add a licence fee per vCPU-hour, which favours fewer, bigger-memory cores
+WINDOWS_PRICE_PER_VCPU_HOUR = 0.046
+
+# Used when EC2 cannot be asked and no cache exists: (type, vCPUs, memory GiB, architecture)
+STATIC_CATALOG = [
+    ("t3.micro", 2, 1, "x86_64"), ("t3.small", 2, 2, "x86_64"), ("t3.medium", 2, 4, "x86_64"),
+    ("t3.large", 2, 8, "x86_64"), ("t3.xlarge", 4, 16, "x86_64"), ("t3.2xlarge", 8, 32, "x86_64"),
+    ("t3a.micro", 2, 1, "x86_64"), ("t3a.small", 2, 2, "x86_64"), ("t3a.medium", 2, 4, "x86_64"),
+    ("t3a.large", 2, 8, "x86_64"), ("t3a.xlarge", 4, 16, "x86_64"), ("t3a.2xlarge", 8, 32, "x86_64"),
+    ("t4g.micro", 2, 1, "arm64"), ("t4g.small", 2, 2, "arm64"), ("t4g.medium", 2, 4, "arm64"),
+    ("t4g.large", 2, 8, "arm64"), ("t4g.xlarge", 4, 16, "arm64"), ("t4g.2xlarge", 8, 32, "arm64"),
+    ("m6i.large", 2, 8, "x86_64"), ("m6i.xlarge", 4, 16, "x86_64"), ("m6i.2xlarge", 8, 32, "x86_64"),
+    ("m6i.4xlarge", 16, 64, "x86_64"),
+    ("m6a.large", 2, 8, "x86_64"), ("m6a.xlarge", 4, 16, "x86_64"), ("m6a.2xlarge", 8, 32, "x86_64"),
+    ("m6a.4xlarge", 16, 64, "x86_64"),
+    ("m7g.large", 2, 8, "arm64"), ("m7g.xlarge", 4, 16, "arm64"), ("m7g.2xlarge", 8, 32, "arm64"),
+    ("m7g.4xlarge", 16, 64, "arm64"),
+    ("r6i.large", 2, 16, "x86_64"), ("r6i.xlarge", 4, 32, "x86_64"), ("r6i.2xlarge", 8, 64, "x86_64"),
+    ("r6i.4xlarge", 16, 128, "x86_64"),
+    ("r6a.large", 2, 16, "x86_64"), ("r6a.xlarge", 4, 32, "x86_64"), ("r6a.2xlarge", 8, 64, "x86_64"),
+    ("r6a.4xlarge", 16, 128, "x86_64"),
+    ("r7g.large", 2, 16, "arm64"), ("r7g.xlarge", 4, 32, "arm64"), ("r7g.2xlarge", 8, 64, "arm64"),
+    ("r7g.4xlarge", 16, 128, "arm64"),
+]
+
+
+class NoMatchingInstanceType(ValueError):
+    pass
+
+
+def _static_entries():
+    return [
+        {"type": name, "vcpus": vcpus, "memory_mib": memory_gib * 1024, "architectures": [arch]}
+        for name, vcpus, memory_gib, arch in STATIC_CATALOG
+    ]
+
+
+def hourly_price(entry, platform="linux"):
+    """Estimated on-demand $/hour for a catalog entry, None for families we do not price"""
+    rate = FAMILY_PRICE_PER_GIB_HOUR.get(entry["type"].split(".")[0])
+    if rate is None:
+        return None
+    price = rate * entry["memory_mib"] / 1024
+    if platform == "windows":
+        price += WINDOWS_PRICE_PER_VCPU_HOUR * entry["vcpus"]
+    return round(price, 4)
+
+
+class InstanceCatalog:
+    """
+    The instance types we may launch, with their vCPUs, memory and architectures.
+
+    Built from EC2 describe_instance_types for FAMILIES and cached on disk per
+    region; the cache is refreshed once it is older than max_age. When EC2
+    cannot be reached the stale cache is used, and without one STATIC_CATALOG.
+    """
+
+    def __init__(self, ec2=None, cache_path=CACHE_PATH, max_age=CACHE_MAX_AGE, families=FAMILIES):
+        self.ec2 = ec2
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.families = families
+        self._entries = None
+        self._loaded_at = 0
+        self.source = None  # "ec2", "cache", "stale-cache" or "static"
+        self._lock = threading.Lock()
+
+    def _region(self):
+        return self.ec2.meta.region_name if self.ec2 is not None else None
+
+    def entries(self):
+        with self._lock:
+            if self._entries is None or time.time() - self._loaded_at >= self.max_age:
+                self._load()
+            return self._entries
+
+    def refresh(self):
+        """Re-read the catalog from EC2 now, whatever the cache age"""
+        with self._lock:
+            self._load(force=True)
+
+    def _load(self, force=False):
+        cached = self._read_cache()
+        if cached and not force and time.time() - cached["fetched_at"] < self.max_age:
+            self._set(cached["entries"], "cache", cached["fetched_at"])
+            return
+        try:
+            entries = self._describe()
+            self._write_cache(entries)
+            self._set(entries, "ec2", time.time())
+        except Exception as e:
+            if cached:
+                logger.warning(f"Could not refresh instance catalog ({e}), using cache from {cached['fetched_at']}")
+                # Retry the refresh on the next max_age, not on every call
+                self._set(cached["entries"], "stale-cache", time.time())
+            else:
+                logger.warning(f"Could not build instance catalog ({e}), using the static list")
+                self._set(_static_entries(), "static", time.time())
+
+    def _set(self, entries, source, loaded_at):
+        self._entries = entries
+        self.source = source
+        self._loaded_at = loaded_at
+        logger.info(f"Instance catalog: {len(entries)} types from {source}")
+
+    def _describe(self):
+        if self.ec2 is None:
+            raise RuntimeError("no EC2 client")
+        entries = []
+        paginator = self.ec2.get_paginator("describe_instance_types")
+        filters = [
+            {"Name": "instance-type", "Values": [f"{family}.*" for family in self.families]},
+            {"Name": "current-generation", "Values": ["true"]},
+            {"Name": "supported-usage-class", "Values": ["on-demand"]},
+        ]
+        for page in paginator.paginate(Filters=filters):
+            for info in page["InstanceTypes"]:
+                entries.append({
+                    "type": info["InstanceType"],
+                    "vcpus": info["VCpuInfo"]["DefaultVCpus"],
+                    "memory_mib": info["MemoryInfo"]["SizeInMiB"],
+                    "architectures": info["ProcessorInfo"]["SupportedArchitectures"],
+                })
+        if not entries:
+            raise RuntimeError("describe_instance_types returned no types")
+        return sorted(entries, key=lambda entry: entry["type"])
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get("region") != self._region() or not cached.get("entries"):
+            return None
+        return cached
+
+    def _write_cache(self, entries):
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"region": self._region(), "fetched_at": time.time(), "entries": entries}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write instance catalog cache: {e}")
+
+    def candidates(self, memory_gib, min_vcpus=0, architecture="x86_64", platform="linux"):
+        """Every type that fits, cheapest first, as (price, entry)"""
+        fits = []
+        for entry in self.entries():
+            price = hourly_price(entry, platform)
+            if (
+                price is not None
+                and entry["memory_mib"] >= memory_gib * 1024
+                and entry["vcpus"] >= min_vcpus
+                and architecture in entry["architectures"]
+            ):
+                fits.append((price, entry))
+        return sorted(fits, key=lambda fit: (fit[0], fit[1]["memory_mib"], fit[1]["vcpus"]))
+
+    def select(self, memory_gib, min_vcpus=0, architecture="x86_64", platform="linux"):
+        """Cheapest type with at least memory_gib GiB and min_vcpus vCPUs for architecture"""
+        fits = self.candidates(memory_gib, min_vcpus, architecture, platform)
+        if not fits:
+            raise NoMatchingInstanceType(
+                f"No {architecture} instance type with {memory_gib} GiB and {min_vcpus} vCPUs"
+            )
+        price, entry = fits[0]
+        logger.info(f"Selected {entry['type']} (~${price}/h) for {memory_gib} GiB, {min_vcpus} vCPUs, {architecture}")
+        return entry["type"]
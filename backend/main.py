@@ -1,16 +1,26 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from aws_manager import AWSManager
+from aws_manager import AWSManager, PLATFORMS, BULK_WORKERS
 from process_manager import ProcessManager
+from vm_reaper import VMReaper
+from right_sizer import RightSizer
+from placement import PlacementScheduler, UserFleet, PoolConsolidator, NoCapacity
+from instance_catalog import NoMatchingInstanceType
+from rate_governor import GOVERNOR, governed_resource
+from vm_client import get_vm_client, evict_vm_client
+import metrics
+import tracing
 import uvicorn
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 import sys
 import os
 import requests
+import random
+from concurrent.futures import ThreadPoolExecutor
 from jose import jwt, JWTError
-import boto3
 from botocore.exceptions import ClientError
 import time
 
@@ -29,6 +39,53 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+HTTP_LATENCY = metrics.histogram(
+    "cloud_ram_http_request_duration_seconds", "Backend API requests by route, method and status",
+    labels=("method", "route", "status")
+)
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # The route template, not the path, so /ram_usage/?vm_ip=... stays one series
+        route = request.scope.get("route")
+        HTTP_LATENCY.observe(
+            time.perf_counter() - started,
+            method=request.method, route=route.path if route else "unmatched", status=status
+        )
+
+# Requests that run the provisioning and migration pipelines get a trace; polling does not
+TRACED_PATHS = {"/allocate/", "/allocate_bulk/", "/move_task/", "/migrate_tasks/", "/place_tasks/"}
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    if request.url.path not in TRACED_PATHS:
+        return await call_next(request)
+    # A caller that sends a traceparent gets our spans in its own trace
+    span = tracing.start_span(
+        f"{request.method} {request.url.path}", parent=tracing.extract(request.headers.get(tracing.HEADER))
+    )
+    token = tracing.attach(span)
+    try:
+        response = await call_next(request)
+        span.set(status_code=response.status_code)
+        if response.status_code >= 500:
+            span.fail(f"HTTP {response.status_code}")
+        response.headers["X-Trace-Id"] = span.trace_id
+        return response
+    except Exception as e:
+        span.fail(e)
+        raise
+    finally:
+        tracing.detach(token)
+        span.end()
+
 # Mount static files
 STATIC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'frontend', 'static'))
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
@@ -36,15 +93,40 @@ app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 # Cognito Configuration
 COGNITO_REGION = 'us-east-1'
 COGNITO_USER_POOL_ID = 'us-east-2_4Fo9tOcji'  # Replace with your User Pool ID
-COGNITO_JWKS_URL = f'https://cognito-idp.us-east-2.amazonaws.com/us-east-2_4Fo9tOcji/.well-known/jwks.json'
+# Overridable so a local identity provider can stand in (see benchmarks/)
+COGNITO_ISSUER = os.getenv("CLOUD_RAM_COGNITO_ISSUER", f'https://cognito-idp.us-east-2.amazonaws.com/{COGNITO_USER_POOL_ID}')
+COGNITO_APP_CLIENT_ID = os.getenv("CLOUD_RAM_COGNITO_APP_CLIENT_ID", '18bacrpgl7tnfj5sgi7h1iq2oq')  # Replace with your App Client ID
+COGNITO_JWKS_URL = f'{COGNITO_ISSUER}/.well-known/jwks.json'
 
 # Fetch JWKS for JWT verification
 jwks = requests.get(COGNITO_JWKS_URL).json()
 
 # DynamoDB for storing user-VM mappings
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+dynamodb = governed_resource('dynamodb', region_name='us-east-1')
 table = dynamodb.Table('CloudRAMUserVMs')
 
+# Stops idle VMs, terminates orphaned and long-stopped ones, keeps the table in sync
+reaper = VMReaper(aws_manager, table)
+# Recommends (or, with CLOUD_RAM_RIGHT_SIZING=apply, makes) instance type changes from observed memory use
+right_sizer = RightSizer(aws_manager, table, on_ip_change=process_manager.vm_ip_changed)
+# Empties underused extra VMs of users whose tasks were spread over several
+consolidator = PoolConsolidator(aws_manager, table)
+metrics.gauge(
+    "cloud_ram_vm_memory_percent", "Memory use of each running VM at the reaper's last sweep", labels=("vm_id",),
+    fn=lambda: {(vm_id,): report.get("memory_percent", 0) for vm_id, report in list(reaper.last_activity.items())}
+)
+
+# batch_get_item retries of unprocessed keys: full-jitter backoff from 50ms, doubling up to 5s
+BATCH_GET_BACKOFF = 0.05
+BATCH_GET_MAX_BACKOFF = 5
+
+# Cognito group whose members may allocate VMs for other users
+ADMIN_GROUP = os.getenv("CLOUD_RAM_ADMIN_GROUP", "admin")
+
+def require_admin(user, action="do this"):
+    if ADMIN_GROUP not in user.get('cognito:groups', []):
+        raise HTTPException(status_code=403, detail=f"Only members of {ADMIN_GROUP} can {action}.")
+
 # Security scheme for JWT
 security = HTTPBearer()
 
@@ -68,8 +150,8 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
                 token,
                 rsa_key,
                 algorithms=["RS256"],
-                audience='18bacrpgl7tnfj5sgi7h1iq2oq',  # Replace with your App Client ID
-                issuer=f'https://cognito-idp.us-east-2.amazonaws.com/us-east-2_4Fo9tOcji'
+                audience=COGNITO_APP_CLIENT_ID,
+                issuer=COGNITO_ISSUER
             )
             return payload
         raise HTTPException(status_code=401, detail="Invalid token")
@@ -78,6 +160,19 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
 
 class RamRequest(BaseModel):
     ram_size: int
+    platform: str = "windows"
+    min_vcpus: int = 0
+    architecture: str = "x86_64"
+
+class Seat(BaseModel):
+    user_id: str
+    ram_size: int
+    platform: str = "windows"
+    min_vcpus: int = 0
+    architecture: str = "x86_64"
+
+class BulkAllocateRequest(BaseModel):
+    seats: list[Seat]
 
 class TaskRequest(BaseModel):
     task_name: str
@@ -87,8 +182,13 @@ class MigrateTasksRequest(BaseModel):
     task_names: list[str]
     vm_ip: str
 
+class PlaceTasksRequest(BaseModel):
+    task_names: list[str]
+
 class TerminateRequest(BaseModel):
     vm_id: str
+    # "stop" keeps the instance for a quick resume; "terminate" destroys it
+    mode: str = "stop"
 
 class FileSyncRequest(BaseModel):
     file: str
@@ -96,29 +196,61 @@ class FileSyncRequest(BaseModel):
 @app.post("/allocate/")
 async def allocate_ram(request: RamRequest, user: dict = Depends(verify_token)):
     user_id = user['sub']
-    print(f"📌 User {user_id} requested to allocate {request.ram_size} GB RAM")
+    print(f"📌 User {user_id} requested to allocate {request.ram_size} GB RAM ({request.platform})")
+    if request.platform not in PLATFORMS:
+        raise HTTPException(status_code=400, detail=f"Unsupported platform: {request.platform}")
+    try:
+        # The first call builds the catalog from a paginated describe_instance_types
+        instance_type = await run_in_threadpool(
+            aws_manager.select_instance_type,
+            request.ram_size, request.platform, request.min_vcpus, request.architecture
+        )
+    except NoMatchingInstanceType as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     # Check if user already has a VM
     try:
         response = table.get_item(Key={'user_id': user_id})
         if 'Item' in response:
-            vm_id = response['Item']['vm_id']
-            vm_ip = response['Item']['vm_ip']
-            return {"vm_id": vm_id, "ip": vm_ip}
+            item = response['Item']
+            if item.get('state') == 'resizing':
+                raise HTTPException(status_code=409, detail="Your VM is being resized, try again in a few minutes.")
+            if item.get('state', 'running') != 'stopped':
+                return {"vm_id": item['vm_id'], "ip": item['vm_ip']}
+            resumed = await run_in_threadpool(resume_user_vm, user_id, item)
+            if resumed:
+                return resumed
     except ClientError as e:
         print(f"Error checking user VM: {e}")
-    
-    # Create new VM
-    vm_id, ip_address = aws_manager.create_vm(request.ram_size)
+
+    # Create new VM, staging the user's working set to S3 while it boots. The launch and boot
+    # wait take minutes, so they run in a worker thread and other requests keep being served.
+    vm_id, ip_address = await run_in_threadpool(
+        aws_manager.create_vm,
+        request.ram_size,
+        on_launched=lambda _vm_id: process_manager.start_working_set_staging(),
+        platform=request.platform,
+        user_id=user_id,
+        instance_type=instance_type,
+        architecture=request.architecture
+    )
     if vm_id is None or ip_address is None:
         raise HTTPException(status_code=500, detail="Failed to allocate RAM.")
 
+    # The agent pulls the manifest on boot; nudge it in case staging finished later
+    await run_in_threadpool(process_manager.wait_for_working_set_staging, timeout=60)
+    await run_in_threadpool(process_manager.request_working_set_prefetch, ip_address)
+
     # Store user-VM mapping in DynamoDB
     try:
         table.put_item(Item={
             'user_id': user_id,
             'vm_id': vm_id,
             'vm_ip': ip_address,
+            'platform': request.platform,
+            'instance_type': instance_type,
+            'architecture': request.architecture,
+            'state': 'running',
             'created_at': int(time.time())
         })
     except ClientError as e:
@@ -128,6 +260,193 @@ async def allocate_ram(request: RamRequest, user: dict = Depends(verify_token)):
 
     return {"vm_id": vm_id, "ip": ip_address}
 
+@app.post("/allocate_bulk/")
+async def allocate_bulk(request: BulkAllocateRequest, user: dict = Depends(verify_token)):
+    # Onboarding: one VM per seat, launched together so 50 seats take about as long as one
+    require_admin(user, "allocate for other users")
+    user_ids = [seat.user_id for seat in request.seats]
+    if len(set(user_ids)) != len(user_ids):
+        raise HTTPException(status_code=400, detail="Each user can only have one seat per request.")
+    print(f"📌 {user['sub']} requested {len(request.seats)} seats")
+
+    results = {}
+    launch = []
+    existing = await run_in_threadpool(existing_mappings, user_ids)
+    # A stopped VM's mapping has a stale IP; start those VMs again rather than handing it out
+    stopped = [item for item in existing.values() if item.get('state') == 'stopped']
+    resumed = await run_in_threadpool(resume_mappings, stopped) if stopped else {}
+    for seat in request.seats:
+        if seat.user_id in resumed:
+            vm_id, ip_address = resumed[seat.user_id]
+            results[seat.user_id] = {"status": "resumed", "vm_id": vm_id, "ip": ip_address}
+            continue
+        if seat.user_id in existing and existing[seat.user_id].get('state') != 'stopped':
+            item = existing[seat.user_id]
+            results[seat.user_id] = {"status": "existing", "vm_id": item['vm_id'], "ip": item['vm_ip']}
+            continue
+        if seat.platform not in PLATFORMS:
+            results[seat.user_id] = {"status": "failed", "detail": f"Unsupported platform: {seat.platform}"}
+            continue
+        try:
+            instance_type = await run_in_threadpool(
+                aws_manager.select_instance_type,
+                seat.ram_size, seat.platform, seat.min_vcpus, seat.architecture
+            )
+        except NoMatchingInstanceType as e:
+            results[seat.user_id] = {"status": "failed", "detail": str(e)}
+            continue
+        launch.append({
+            "user_id": seat.user_id, "platform": seat.platform,
+            "architecture": seat.architecture, "instance_type": instance_type
+        })
+
+    created = await run_in_threadpool(aws_manager.create_vms, launch) if launch else {}
+    now = int(time.time())
+    try:
+        with table.batch_writer() as batch:
+            for seat in launch:
+                if seat['user_id'] not in created:
+                    continue
+                vm_id, ip_address = created[seat['user_id']]
+                batch.put_item(Item={
+                    'user_id': seat['user_id'],
+                    'vm_id': vm_id,
+                    'vm_ip': ip_address,
+                    'platform': seat['platform'],
+                    'instance_type': seat['instance_type'],
+                    'architecture': seat['architecture'],
+                    'state': 'running',
+                    'created_at': now
+                })
+    except ClientError as e:
+        print(f"Error storing user VM mappings: {e}")
+        for vm_id, _ in created.values():
+            aws_manager.terminate_vm(vm_id)
+        raise HTTPException(status_code=500, detail="Failed to store VM mappings.")
+
+    for seat in launch:
+        if seat['user_id'] in created:
+            vm_id, ip_address = created[seat['user_id']]
+            results[seat['user_id']] = {"status": "created", "vm_id": vm_id, "ip": ip_address}
+        else:
+            results[seat['user_id']] = {"status": "failed", "detail": "VM did not come up."}
+    return {"seats": [dict(results[user_id], user_id=user_id) for user_id in user_ids]}
+
+def existing_mappings(user_ids):
+    """user_id -> mapping item for those of user_ids that already have a VM"""
+    items = {}
+    for start in range(0, len(user_ids), 100):
+        keys = [{'user_id': user_id} for user_id in user_ids[start:start + 100]]
+        request_items = {table.name: {'Keys': keys}}
+        delay = BATCH_GET_BACKOFF
+        while request_items:
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(table.name, []):
+                items[item['user_id']] = item
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                # Unprocessed keys mean the table is throttling us; back off before asking again
+                time.sleep(random.uniform(0, delay))
+                delay = min(delay * 2, BATCH_GET_MAX_BACKOFF)
+    return items
+
+def resume_mappings(items):
+    """Start the stopped VMs of these mapping items together; user_id -> (vm_id, ip) for those that came back"""
+    def resume(item):
+        return item, aws_manager.resume_vm(item['vm_id'], platform=item.get('platform', 'windows'))
+
+    resumed = {}
+    with ThreadPoolExecutor(max_workers=min(BULK_WORKERS, len(items))) as pool:
+        for item, (vm_id, ip_address) in pool.map(tracing.wrap(resume), items):
+            if vm_id is None:
+                print(f"⚠️ Could not resume {item['vm_id']} for {item['user_id']}, allocating a new VM")
+                continue
+            try:
+                record_resumed(item, ip_address)
+            except ClientError as e:
+                print(f"Error updating user VM mapping: {e}")
+            resumed[item['user_id']] = (vm_id, ip_address)
+    return resumed
+
+def resume_user_vm(user_id, item):
+    """Start the user's stopped VM; None if it is gone and a new one must be built."""
+    # Files may have changed since the stop; stage them while the VM starts
+    process_manager.start_working_set_staging()
+    vm_id, ip_address = aws_manager.resume_vm(item['vm_id'], platform=item.get('platform', 'windows'))
+    if vm_id is None:
+        print(f"⚠️ Could not resume {item['vm_id']} for {user_id}, allocating a new VM")
+        table.delete_item(Key={'user_id': user_id})
+        return None
+    process_manager.wait_for_working_set_staging(timeout=60)
+    process_manager.request_working_set_prefetch(ip_address)
+    record_resumed(item, ip_address)
+    return {"vm_id": vm_id, "ip": ip_address, "resumed": True}
+
+def record_resumed(item, ip_address):
+    """Mark the mapping running again at the IP its VM came back with"""
+    # A stop releases the public IP; the client kept for the old one is of no use anymore
+    evict_vm_client(item.get('vm_ip'))
+    process_manager.vm_ip_changed(item.get('vm_ip'), ip_address)
+    table.update_item(
+        Key={'user_id': item['user_id']},
+        UpdateExpression="SET vm_ip = :ip, #state = :running, resumed_at = :now REMOVE stopped_at",
+        ExpressionAttributeNames={'#state': 'state'},
+        ExpressionAttributeValues={':ip': ip_address, ':running': 'running', ':now': int(time.time())}
+    )
+
+@app.on_event("startup")
+async def start_background_sweeps():
+    # Idle, orphaned and long-stopped VMs are released within a sweep or two
+    reaper.start()
+    right_sizer.start()
+    consolidator.start()
+
+@app.get("/right_sizing/")
+async def right_sizing(user: dict = Depends(verify_token)):
+    recommendation = right_sizer.recommendations.get(user['sub'])
+    if recommendation is None:
+        raise HTTPException(status_code=404, detail="No recommendation yet for your VM.")
+    return recommendation
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/rate_limits/")
+async def rate_limits(user: dict = Depends(verify_token)):
+    # Per AWS API family: current rate, tokens, throttles seen and queue depth by priority
+    require_admin(user, "read rate limits")
+    return GOVERNOR.snapshot()
+
+@app.get("/traces/")
+async def traces(limit: int = 50, user: dict = Depends(verify_token)):
+    # Newest first; the X-Trace-Id header of a traced request names its trace
+    require_admin(user, "read traces")
+    return tracing.STORE.recent(limit)
+
+@app.get("/traces/{trace_id}")
+async def trace(trace_id: str, user: dict = Depends(verify_token)):
+    # Per-stage waterfall of one allocation or migration, the VM agents' spans included
+    require_admin(user, "read traces")
+    spans = tracing.STORE.get(trace_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail="Unknown or expired trace.")
+    spans += await run_in_threadpool(agent_spans, trace_id, spans)
+    return tracing.waterfall(trace_id, spans)
+
+def agent_spans(trace_id, spans):
+    """Spans the VM agents recorded for a trace, from every VM the trace called"""
+    vm_ips = {span['attributes']['vm_ip'] for span in spans if span['attributes'].get('vm_ip')}
+    found = []
+    for vm_ip in vm_ips:
+        try:
+            for span in get_vm_client(vm_ip).get_json(f"traces/{trace_id}")['spans']:
+                found.append(dict(span, attributes=dict(span['attributes'], vm_ip=vm_ip)))
+        except (requests.RequestException, ValueError, KeyError) as e:
+            # A VM released since keeps its spans to itself; the backend's still make a waterfall
+            print(f"⚠️ Could not fetch spans of trace {trace_id} from {vm_ip}: {e}")
+    return found
+
 @app.get("/running_tasks/")
 async def running_tasks():
     tasks = process_manager.get_local_tasks()
@@ -139,21 +458,63 @@ async def move_task(request: TaskRequest, user: dict = Depends(verify_token)):
     success = process_manager.move_task_to_cloud(request.task_name, request.vm_ip)
     if not success:
         raise HTTPException(status_code=500, detail="Failed to move task.")
-    return {"message": f"Task {request.task_name} moved to Cloud RAM at {request.vm_ip}"}
+    return {
+        "message": f"Task {request.task_name} moved to Cloud RAM at {request.vm_ip}",
+        "timings": process_manager.last_migration_timings
+    }
 
 @app.post("/migrate_tasks/")
 async def migrate_tasks(request: MigrateTasksRequest, user: dict = Depends(verify_token)):
+    # One pass for all tasks: app state is captured in parallel by each app's adapter
+    migrated = await run_in_threadpool(process_manager.migrate_tasks, request.task_names, request.vm_ip)
+    results = [
+        {"task": task_name, "success": result["success"], "timings": result["timings"]}
+        for task_name, result in migrated.items()
+    ]
+    return {"results": results}
+
+@app.post("/place_tasks/")
+async def place_tasks(request: PlaceTasksRequest, user: dict = Depends(verify_token)):
+    # Spread the tasks over the user's VMs by memory, adding a VM when none has room
+    user_id = user['sub']
+    item = table.get_item(Key={'user_id': user_id}).get('Item')
+    if not item or item.get('state', 'running') != 'running':
+        raise HTTPException(status_code=400, detail="Allocate RAM before placing tasks.")
+    scheduler = PlacementScheduler(UserFleet(aws_manager, table, user_id, item.get('platform', 'windows')))
+    try:
+        placements = await run_in_threadpool(scheduler.place, process_manager.task_memory(request.task_names))
+    except NoCapacity as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    by_vm = {}
+    for task_name, vm in placements.items():
+        by_vm.setdefault(vm['vm_id'], (vm, []))[1].append(task_name)
     results = []
-    for task_name in request.task_names:
-        success = process_manager.move_task_to_cloud(task_name, request.vm_ip, sync_state=(task_name == "notepad++.exe"))
-        results.append({"task": task_name, "success": success})
+    for vm, task_names in by_vm.values():
+        migrated = await run_in_threadpool(process_manager.migrate_tasks, task_names, vm['vm_ip'])
+        results += [
+            {"task": task_name, "vm_id": vm['vm_id'], "vm_ip": vm['vm_ip'],
+             "success": result["success"], "timings": result["timings"]}
+            for task_name, result in migrated.items()
+        ]
     return {"results": results}
 
+def release_pool(user_id):
+    """Terminate the extra VMs tasks were placed on; they are not kept across releases."""
+    try:
+        item = table.get_item(Key={'user_id': user_id}).get('Item') or {}
+        for member in item.get('pool', []):
+            aws_manager.terminate_vm(member['vm_id'])
+        if item.get('pool'):
+            table.update_item(Key={'user_id': user_id}, UpdateExpression="REMOVE pool")
+    except ClientError as e:
+        print(f"Error releasing VM pool: {e}")
+
 @app.get("/ram_usage/")
 async def ram_usage(vm_ip: str, user: dict = Depends(verify_token)):
     if not vm_ip:
         raise HTTPException(status_code=400, detail="VM IP is required")
-    ram_info = aws_manager.get_vm_status(vm_ip)
+    ram_info = await aws_manager.get_vm_status_async(vm_ip)
     if "error" in ram_info:
         raise HTTPException(status_code=500, detail=ram_info["error"])
     return {
@@ -166,7 +527,32 @@ async def ram_usage(vm_ip: str, user: dict = Depends(verify_token)):
 @app.post("/release_ram/")
 async def release_ram(request: TerminateRequest, user: dict = Depends(verify_token)):
     user_id = user['sub']
+    if request.mode not in ("stop", "terminate"):
+        raise HTTPException(status_code=400, detail=f"Unsupported release mode: {request.mode}")
+    # The vm_id comes from the client: only ever stop or terminate the caller's own VM
+    item = (await run_in_threadpool(table.get_item, Key={'user_id': user_id})).get('Item')
+    if not item or item.get('vm_id') != request.vm_id:
+        raise HTTPException(status_code=404, detail="You have no VM with that ID.")
+    await run_in_threadpool(release_pool, user_id)
+    if request.mode == "stop":
+        if not await run_in_threadpool(aws_manager.stop_vm, request.vm_id):
+            raise HTTPException(status_code=500, detail="Failed to stop VM.")
+        evict_vm_client(item.get('vm_ip'))
+        # Keep the mapping so the next allocation resumes this VM
+        try:
+            table.update_item(
+                Key={'user_id': user_id},
+                UpdateExpression="SET #state = :stopped, stopped_at = :now",
+                ConditionExpression="vm_id = :vm_id",
+                ExpressionAttributeNames={'#state': 'state'},
+                ExpressionAttributeValues={':stopped': 'stopped', ':now': int(time.time()), ':vm_id': request.vm_id}
+            )
+        except ClientError as e:
+            print(f"Error updating user VM mapping: {e}")
+        return {"message": f"VM {request.vm_id} stopped, RAM released. It resumes on your next allocation."}
+
     aws_manager.terminate_vm(request.vm_id)
+    evict_vm_client(item.get('vm_ip'))
     # Remove user-VM mapping
     try:
         table.delete_item(Key={'user_id': user_id})
@@ -177,8 +563,10 @@ async def release_ram(request: TerminateRequest, user: dict = Depends(verify_tok
 @app.post("/sync_notepad/")
 async def sync_notepad(request: TaskRequest, user: dict = Depends(verify_token)):
     print("Tracking files — pulling from session.xml...")
-    process_manager.tracked_files = process_manager.get_current_open_files()
-    process_manager.sync_notepad_files(request.vm_ip)
+    # Process and file I/O stays off the event loop; repeat calls hit the tracker cache
+    open_files = await run_in_threadpool(process_manager.get_current_open_files)
+    process_manager.tracked_files = set(open_files)
+    await run_in_threadpool(process_manager.sync_notepad_files, request.vm_ip)
     return {"message": "Synced Notepad++ files"}
 
 if __name__ == "__main__":
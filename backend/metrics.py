@@ -0,0 +1,232 @@
+import time
+import bisect
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds: HTTP handlers and agent calls up to boots and migrations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, got {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_labels_text(self.label_names, key)} {_number(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. With fn, the value is read when metrics
+    are rendered: fn returns a number, or for labelled gauges a dict of label
+    value tuples to numbers. That keeps queue depths and RSS off hot paths.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception as e:
+                logger.warning(f"Could not collect {self.name}: {e}")
+                value = {}
+            values = value if isinstance(value, dict) else {(): value}
+            with self._lock:
+                self._values = {tuple(str(v) for v in key): v for key, v in values.items()}
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # Counts are kept per bucket and made cumulative only when rendered
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self, **labels):
+        """{"count", "sum", "buckets": {le: cumulative count}} for one label set"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            counts, count, total = (list(state[0]), state[1], state[2]) if state else ([0] * (len(self.buckets) + 1), 0, 0.0)
+        cumulative, buckets = 0, {}
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            buckets[_number(bound)] = cumulative
+        return {"count": count, "sum": round(total, 6), "buckets": buckets}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        for key, (counts, count, total) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.label_names, key, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.label_names, key)} {_number(round(total, 6))}")
+            lines.append(f"{self.name}_count{_labels_text(self.label_names, key)} {count}")
+        return lines
+
+
+class Registry:
+    """Metrics by name. Registering a name twice returns the first metric, so modules can declare theirs at import."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels=labels)
+
+    def gauge(self, name, help, labels=(), fn=None):
+        gauge = self._register(Gauge, name, help, labels=labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels=labels, buckets=buckets)
+
+    def render(self):
+        """Prometheus text exposition of every metric"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+render = REGISTRY.render
+
+AWS_REQUESTS = counter(
+    "cloud_ram_aws_requests_total", "AWS API attempts by service, operation and HTTP status",
+    labels=("service", "operation", "status")
+)
+S3_BYTES = counter("cloud_ram_s3_bytes_total", "Bytes sent to or received from S3", labels=("direction", "operation"))
+
+
+def instrument_boto_client(client):
+    """Count every attempt a boto3 client makes, and S3 bytes in and out; returns the client"""
+    service = client.meta.service_model.service_id.hyphenize()
+
+    def count(event_name=None, response=None, **kwargs):
+        if response is None:
+            return None
+        http_response, _ = response
+        operation = event_name.rsplit(".", 1)[-1]
+        AWS_REQUESTS.inc(service=service, operation=operation, status=http_response.status_code)
+        if service == "s3":
+            received = http_response.headers.get("Content-Length")
+            # Object bodies are streamed, so their size comes from the headers of the answer
+            if received and operation in ("GetObject",):
+                S3_BYTES.inc(int(received), direction="received", operation=operation)
+        return None
+
+    def sent(event_name=None, request=None, **kwargs):
+        length = request.headers.get("Content-Length") if request is not None else None
+        if length and int(length):
+            S3_BYTES.inc(int(length), direction="sent", operation=event_name.rsplit(".", 1)[-1])
+
+    client.meta.events.register(f"needs-retry.{service}", count)
+    if service == "s3":
+        client.meta.events.register(f"before-send.{service}", sent)
+    return client
@@ -0,0 +1,358 @@
+import os
+import time
+import hashlib
+import threading
+import logging
+import requests
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from vm_client import get_vm_client
+from metrics import histogram, gauge
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Bookkeeping objects live under this prefix so file syncs never pick them up
+CONTROL_PREFIX = "_cloudram/"
+WORKING_SET_MANIFEST_KEY = CONTROL_PREFIX + "working_set.json"
+# Longest silence allowed on the launch batch: the VM may first wait out a prefetch, then launch
+LAUNCH_BATCH_TIMEOUT = 120
+# Added to a batch's read timeout for every key it has the VM download before answering
+SYNC_SECONDS_PER_KEY = 0.5
+
+MIGRATION_STAGES = histogram(
+    "cloud_ram_migration_stage_seconds", "Duration of each migration stage, per task", labels=("stage",)
+)
+MIGRATION_UPLOADS = histogram(
+    "cloud_ram_migration_s3_uploads", "Files uploaded to S3 per migration",
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+UPLOAD_QUEUE = gauge(
+    "cloud_ram_sync_queue_depth", "Files queued or in flight to S3", labels=("queue",)
+)
+
+
+class StageTimer:
+    """Collects wall-clock durations for the named stages of one migration; in a trace each stage is also a span."""
+
+    def __init__(self):
+        self.timings = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            with tracing.child_span(name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = round(self.timings.get(name, 0.0) + elapsed, 3)
+            MIGRATION_STAGES.observe(elapsed, stage=name)
+            logger.info(f"Stage '{name}' took {elapsed:.3f}s")
+
+    def record(self, name, seconds):
+        """Record a duration measured elsewhere (e.g. reported back by the VM)"""
+        self.timings[name] = round(seconds, 3)
+        MIGRATION_STAGES.observe(seconds, stage=name)
+
+    def summary(self):
+        summary = dict(self.timings)
+        summary["total"] = round(time.perf_counter() - self._started, 3)
+        return summary
+
+
+def file_signature(file_path):
+    """Cheap change signature for a local file: (size, mtime_ns)"""
+    st = os.stat(file_path)
+    return st.st_size, st.st_mtime_ns
+
+
+def file_md5(file_path):
+    """Hex MD5 of a file, comparable with the ETag of a single-part S3 upload"""
+    digest = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileStreamer:
+    """
+    Uploads files to S3 on a small worker pool as soon as they are handed over,
+    so capture can keep going while earlier files are already on their way.
+    Remembers the signature each upload was taken from, which lets the final
+    cutover resend only the files that changed afterwards.
+    """
+
+    def __init__(self, s3, bucket_name, max_workers=4):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3-stream")
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._uploaded = {}  # file_path -> (s3_key, signature)
+        self._streamed = set()  # files actually sent during this run
+        self._previous = {}  # file_path -> (s3_key, signature) uploaded by earlier migrations
+
+    def seed(self, uploaded):
+        """Mark files as already in S3, e.g. staged while the VM was provisioning"""
+        with self._lock:
+            self._uploaded.update(uploaded)
+
+    def remember(self, uploads):
+        """Files uploaded by earlier migrations; submit skips them until they change or move to another key"""
+        with self._lock:
+            self._previous.update(uploads)
+
+    def submit(self, file_path, s3_key=None):
+        """Queue a file for upload (keyed by basename unless s3_key is given); returns its S3 key, or None if the file is missing"""
+        if not os.path.isfile(file_path):
+            logger.warning(f"Not streaming missing file: {file_path}")
+            return None
+        s3_key = s3_key or os.path.basename(file_path)
+        with self._lock:
+            pending = self._futures.get(file_path)
+            if pending is not None and not pending.done():
+                return s3_key
+            known = self._uploaded.get(file_path)
+            if known and known[1] == file_signature(file_path):
+                logger.info(f"{file_path} unchanged since it was staged, not streaming")
+                return s3_key
+            previous = self._previous.get(file_path)
+            if not known and previous == (s3_key, file_signature(file_path)):
+                # Counted as uploaded from here on, so an edit before the cutover is still resent
+                self._uploaded[file_path] = previous
+                return s3_key
+            UPLOAD_QUEUE.inc(queue="migration")
+            self._futures[file_path] = self._executor.submit(tracing.wrap(self._upload), file_path, s3_key)
+        return s3_key
+
+    def _upload(self, file_path, s3_key):
+        try:
+            signature = file_signature(file_path)
+            logger.info(f"Streaming {file_path} -> s3://{self.bucket_name}/{s3_key}")
+            with tracing.child_span("s3.upload", key=s3_key, bytes=signature[0]):
+                self.s3.upload_file(file_path, self.bucket_name, s3_key)
+        finally:
+            UPLOAD_QUEUE.dec(queue="migration")
+        with self._lock:
+            self._uploaded[file_path] = (s3_key, signature)
+            self._streamed.add(file_path)
+        return s3_key
+
+    def wait(self):
+        """Block until every queued upload has finished; returns the S3 keys streamed in this run"""
+        with self._lock:
+            futures = list(self._futures.values())
+        wait(futures)
+        for future in futures:
+            error = future.exception()
+            if error:
+                logger.error(f"Streamed upload failed: {error}")
+        with self._lock:
+            return [self._uploaded[file_path][0] for file_path in self._streamed]
+
+    def available_keys(self):
+        """S3 keys whose current upload is done (staged ones included), so a VM can already pull them"""
+        with self._lock:
+            return [
+                s3_key for file_path, (s3_key, _) in self._uploaded.items()
+                if file_path not in self._futures or self._futures[file_path].done()
+            ]
+
+    def uploaded(self):
+        """Files streamed in this run, as file_path -> (s3_key, signature)"""
+        with self._lock:
+            return {file_path: self._uploaded[file_path] for file_path in self._streamed}
+
+    def flush_dirty(self):
+        """Re-upload files modified since they were streamed; returns the refreshed S3 keys"""
+        with self._lock:
+            uploaded = dict(self._uploaded)
+        dirty = []
+        for file_path, (s3_key, signature) in uploaded.items():
+            try:
+                if file_signature(file_path) != signature:
+                    dirty.append(file_path)
+            except OSError:
+                logger.warning(f"Streamed file disappeared before cutover: {file_path}")
+        for file_path in dirty:
+            self.submit(file_path, uploaded[file_path][0])
+        self.wait()
+        return [uploaded[file_path][0] for file_path in dirty]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class MigrationEngine:
+    """
+    Moves a set of apps to a VM in one pass, whatever the app.
+
+    Every app is driven through its adapter (see app_adapters): captures run in
+    parallel and feed one shared FileStreamer, the VM is asked to prefetch what
+    is already up before the remaining uploads are waited for, the apps are stopped together, state written on exit is
+    captured, and only files that changed after they were streamed are resent.
+    The VM then gets a single /batch that pulls those changes and launches every
+    app. An app whose capture fails is left running locally.
+    """
+
+    def __init__(self, s3, bucket_name, staged=None, previous=None, on_uploaded=None, agent_port=None, max_workers=4):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.staged = staged or {}
+        self.previous = previous or {}  # app state uploaded by earlier migrations, see FileStreamer.remember
+        self.on_uploaded = on_uploaded  # callback(file_path, s3_key, signature)
+        self.agent_port = agent_port
+        self.max_workers = max_workers
+
+    def migrate(self, adapters, vm_ip):
+        """adapters: task_name -> adapter. Returns task_name -> {"success", "timings"}"""
+        with tracing.child_span("migrate", vm_ip=vm_ip, tasks=",".join(adapters)):
+            return self._migrate(adapters, vm_ip)
+
+    def _migrate(self, adapters, vm_ip):
+        timers = {task: StageTimer() for task in adapters}
+        keys = {task: [] for task in adapters}
+        ok = {task: True for task in adapters}
+        streamer = FileStreamer(self.s3, self.bucket_name, self.max_workers)
+        streamer.seed(self.staged)
+        streamer.remember(self.previous)
+
+        def live_timers():
+            return [timers[task] for task in adapters if ok[task]]
+
+        fresh_keys = set()  # written on exit, so whatever the VM already has is stale
+
+        def emitter(task, fresh=False):
+            def emit(file_path, s3_key=None):
+                s3_key = streamer.submit(file_path, s3_key)
+                if s3_key and s3_key not in keys[task]:
+                    keys[task].append(s3_key)
+                if s3_key and fresh:
+                    fresh_keys.add(s3_key)
+            return emit
+
+        try:
+            self._each(adapters, ok, "capture", lambda task, adapter: adapter.capture(emitter(task), timers[task]))
+            # The VM warms the apps and pulls what is already up while the rest of the uploads finish
+            wanted = {s3_key for task in adapters if ok[task] for s3_key in keys[task]}
+            early = sorted(wanted.intersection(streamer.available_keys()))
+            self._post(vm_ip, "prefetch", {"tasks": [t for t in adapters if ok[t]], "files": early}, timeout=5)
+            streamed = self._shared_stage(live_timers(), "stream_upload", streamer.wait)
+            late = sorted(set(streamed) - set(early))
+            if late:
+                self._post(vm_ip, "prefetch", {"tasks": [], "files": late}, timeout=5)
+
+            def stop(task, adapter):
+                with timers[task].stage("terminate"):
+                    adapter.stop()
+            self._each(adapters, ok, "stop", stop)
+            self._each(adapters, ok, "capture_after_stop",
+                       lambda task, adapter: adapter.capture_after_stop(emitter(task, fresh=True), timers[task]))
+            dirty_keys = set(self._shared_stage(live_timers(), "delta_upload", streamer.flush_dirty)) | fresh_keys
+            logger.info(f"Cutover delta: {sorted(dirty_keys)}")
+        finally:
+            streamer.shutdown()
+
+        MIGRATION_UPLOADS.observe(len(streamer.uploaded()))
+        if self.on_uploaded:
+            for file_path, (s3_key, signature) in streamer.uploaded().items():
+                self.on_uploaded(file_path, s3_key, signature)
+
+        self._launch(adapters, ok, timers, keys, dirty_keys, vm_ip)
+
+        results = {}
+        for task in adapters:
+            results[task] = {"success": ok[task], "timings": timers[task].summary()}
+            logger.info(f"Migration of {task}: {results[task]}")
+        return results
+
+    def _launch(self, adapters, ok, timers, keys, dirty_keys, vm_ip):
+        """
+        One /batch for the whole cutover: refresh the changed files once, then
+        launch every app as soon as they are in. Each app is handed over as its
+        result streams back, without waiting for the slower launches.
+        """
+        live = [task for task in adapters if ok[task]]
+        if not live:
+            return
+        ops = []
+        if dirty_keys:
+            ops.append({"id": "sync", "op": "sync_keys", "args": {"keys": sorted(dirty_keys)}})
+        for task in live:
+            ops.append({
+                "id": task,
+                "op": "run_task",
+                "args": {"task": task, "files": keys[task], "restore": adapters[task].restore_spec()},
+                "depends_on": ["sync"] if dirty_keys else [],
+            })
+
+        started = time.perf_counter()
+        pending = set(live)
+        try:
+            timeout = LAUNCH_BATCH_TIMEOUT + SYNC_SECONDS_PER_KEY * len(dirty_keys)
+            for result in get_vm_client(vm_ip, self.agent_port).batch(ops, timeout=timeout):
+                if result.get("done"):
+                    logger.info(f"VM batch finished: {result}")
+                elif result["id"] == "sync":
+                    for stage, seconds in result["result"].get("timings", {}).items():
+                        for task in live:
+                            timers[task].record(f"vm_{stage}", seconds)
+                elif result["id"] in pending:
+                    task = result["id"]
+                    pending.discard(task)
+                    timers[task].record("vm_launch", time.perf_counter() - started)
+                    self._handover(task, adapters[task], ok, timers[task], result, vm_ip)
+        except (requests.RequestException, RuntimeError, ValueError) as e:
+            logger.error(f"Batch launch on VM failed: {e}")
+        for task in pending:
+            logger.error(f"VM never reported the launch of {task}")
+            ok[task] = False
+
+    def _handover(self, task, adapter, ok, timer, result, vm_ip):
+        if result["status"] != "ok":
+            logger.error(f"VM did not start {task}: {result['status']} {result['result']}")
+            ok[task] = False
+            return
+        for stage, seconds in result["result"].get("timings", {}).items():
+            timer.record(f"vm_{stage}", seconds)
+        try:
+            adapter.on_migrated(vm_ip)
+        except Exception as e:
+            logger.error(f"Follow-up after migrating {task} failed: {e}")
+            ok[task] = False
+
+    def _each(self, adapters, ok, step, fn):
+        """Run fn(task, adapter) for every app still in the migration, in parallel"""
+        live = [task for task in adapters if ok[task]]
+        if not live:
+            return
+        def run(task):
+            with tracing.child_span(step, task=task):
+                fn(task, adapters[task])
+
+        with ThreadPoolExecutor(max_workers=len(live), thread_name_prefix=f"migrate-{step}") as executor:
+            futures = {task: executor.submit(tracing.wrap(run), task) for task in live}
+        for task, future in futures.items():
+            error = future.exception()
+            if error:
+                logger.error(f"{step} failed for {task}: {error}")
+                ok[task] = False
+
+    def _shared_stage(self, timers, name, fn):
+        start = time.perf_counter()
+        with tracing.child_span(name):
+            result = fn()
+        for timer in timers:
+            timer.record(name, timer.timings.get(name, 0.0) + time.perf_counter() - start)
+        return result
+
+    def _post(self, vm_ip, endpoint, payload, timeout=None):
+        try:
+            return get_vm_client(vm_ip, self.agent_port).post(endpoint, payload, timeout=timeout, idempotent=True)
+        except requests.RequestException as e:
+            # A missed prefetch is not fatal: /run_task downloads whatever is missing
+            logger.warning(f"Could not reach VM /{endpoint}: {e}")
+            return None
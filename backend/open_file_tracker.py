@@ -0,0 +1,100 @@
+import os
+import threading
+import logging
+import xml.etree.ElementTree as ET
+import psutil
+from wait_utils import path_signature
+from process_snapshot import ProcessSnapshotService
+
+logger = logging.getLogger(__name__)
+
+NOTEPAD_EXTENSIONS = ('.txt', '.cpp', '.py', '.html')
+
+
+class OpenFileTracker:
+    """
+    Answers "which files does Notepad++ have open" from memory.
+
+    Results are cached under (target PID, session.xml size/mtime). A repeat query
+    costs one stat of session.xml and a liveness check of the remembered PID;
+    the process snapshot (the shared ProcessSnapshotService, if one is passed)
+    is only consulted when that PID is gone, and open_files() and
+    the session parse only run when the key changed. session.xml is read with
+    iterparse so it is never loaded or logged in full.
+    """
+
+    def __init__(self, session_path, process_name='notepad++.exe', extensions=NOTEPAD_EXTENSIONS, processes=None):
+        self.session_path = session_path
+        self.process_name = process_name.lower()
+        self.extensions = extensions
+        self.processes = processes if processes is not None else ProcessSnapshotService(target_apps=(process_name,))
+        self._lock = threading.Lock()
+        self._pid = None
+        self._cache_key = None
+        self._cached = []
+
+    def _find_pid(self):
+        if self._pid is not None:
+            try:
+                if psutil.Process(self._pid).name().lower() == self.process_name:
+                    return self._pid
+            except psutil.Error:
+                pass
+        matches = self.processes.find(self.process_name)
+        self._pid = matches[0]["pid"] if matches else None
+        return self._pid
+
+    def open_files(self):
+        """Open files, deduplicated in order; served from cache while the key is unchanged"""
+        with self._lock:
+            pid = self._find_pid()
+            key = (pid, path_signature(self.session_path))
+            if key == self._cache_key:
+                return list(self._cached)
+
+            open_files = self._from_process(pid) if pid else []
+            if not open_files:
+                logger.info("No files found via psutil, falling back to session.xml")
+                open_files = self._from_session()
+
+            self._cached = list(dict.fromkeys(open_files))
+            self._cache_key = key
+            logger.info(f"Open files refreshed: {self._cached}")
+            return list(self._cached)
+
+    def invalidate(self):
+        with self._lock:
+            self._cache_key = None
+
+    def _from_process(self, pid):
+        try:
+            files = psutil.Process(pid).open_files()
+        except psutil.AccessDenied:
+            logger.warning(f"Access denied while trying to get open files from {self.process_name}")
+            return []
+        except psutil.Error as e:
+            logger.error(f"Error getting open files via psutil: {e}")
+            return []
+        return [
+            f.path for f in files
+            # Filter for typical Notepad++ file extensions and exclude internal files
+            if f.path.lower().endswith(self.extensions)
+            and 'notepad++' not in f.path.lower()
+            and os.path.isfile(f.path)
+        ]
+
+    def _from_session(self):
+        if not os.path.exists(self.session_path):
+            logger.error("session.xml not found.")
+            return []
+        open_files = []
+        try:
+            for _, elem in ET.iterparse(self.session_path, events=('end',)):
+                if elem.tag == 'File':
+                    file_path = elem.get('filename')
+                    if file_path and os.path.isfile(file_path):
+                        open_files.append(file_path)
+                elem.clear()
+        except (ET.ParseError, OSError) as e:
+            logger.error(f"Failed to parse session.xml: {e}")
+        return open_files
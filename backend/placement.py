@@ -0,0 +1,457 @@
+import os
+import json
+import math
+import time
+import random
+import argparse
+import threading
+import logging
+import requests
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from vm_client import get_vm_client
+from rate_governor import background
+
+logger = logging.getLogger(__name__)
+
+GIB = 1024 ** 3
+# Kept free on every VM for the OS, the agent and apps growing after launch
+HEADROOM_PERCENT = 15
+# Apps reopen their documents on the VM and tend to grow past their local RSS
+RSS_GROWTH = 1.25
+# A VM using less than this share of its memory is emptied onto the others when they have room
+CONSOLIDATE_BELOW_PERCENT = 30
+# What the OS and agent use on a fresh VM, added when sizing one for a task
+VM_BASE_GIB = 1.5
+DEFAULT_VM_GIB = int(os.getenv("CLOUD_RAM_POOL_VM_GIB", "8"))
+MAX_POOL_SIZE = int(os.getenv("CLOUD_RAM_MAX_POOL_SIZE", "4"))
+CONSOLIDATE_INTERVAL = 600
+# Apps whose state directories (app_adapters' vscode/ and chrome/ prefixes) live on the VM they run on.
+# move() only hands the target their files, so moving them would lose the user's workspaces and tabs.
+STATEFUL_TASKS = {"code.exe", "chrome.exe"}
+
+
+class NoCapacity(RuntimeError):
+    pass
+
+
+def task_key(task):
+    """What placements are keyed by: the PID when known, so two instances of one app stay apart"""
+    return task.get("pid", task["task"])
+
+
+def movable(task):
+    """Whether move() can relaunch task on another VM without losing its state"""
+    return task["task"].lower() not in STATEFUL_TASKS
+
+
+class PlacementScheduler:
+    """
+    Places tasks on a user's pool of VMs by estimated memory, best-fit
+    decreasing: the largest tasks go first, each to the VM whose free memory
+    (minus headroom) it leaves smallest. When no VM fits, a VM sized for the
+    task (at least vm_gib) is added, up to max_vms. consolidate() empties
+    underused VMs onto the others and releases them.
+
+    The fleet is anything with vms(), add_vm(memory_gib), remove_vm(vm_id) and
+    move(task, source, target); UserFleet is the real one, FakeFleet the
+    in-memory one for synthetic workloads. vms() returns dicts with vm_id,
+    total, available (bytes), tasks ([{"task", "rss", "pid", ...}]) and primary.
+    Tasks are keyed by task_key(): their PID, or their name when they have none
+    (local apps, which are migrated as a whole).
+    """
+
+    def __init__(self, fleet, headroom_percent=HEADROOM_PERCENT, rss_growth=RSS_GROWTH,
+                 consolidate_below=CONSOLIDATE_BELOW_PERCENT, vm_gib=DEFAULT_VM_GIB, max_vms=MAX_POOL_SIZE):
+        self.fleet = fleet
+        self.headroom_percent = headroom_percent
+        self.rss_growth = rss_growth
+        self.consolidate_below = consolidate_below
+        self.vm_gib = vm_gib
+        self.max_vms = max_vms
+
+    def _free(self, vm):
+        return vm["available"] - vm["total"] * self.headroom_percent / 100
+
+    def demand(self, rss):
+        return int(rss * self.rss_growth)
+
+    def plan(self, tasks, vms):
+        """
+        Best-fit decreasing over tasks ({"task", "rss"}) and a copy of vms.
+        Returns (placements task_key -> vm_id or None, free bytes per vm_id after).
+        """
+        free = {vm["vm_id"]: self._free(vm) for vm in vms}
+        placements = {}
+        for task in sorted(tasks, key=lambda t: -t["rss"]):
+            need = self.demand(task["rss"])
+            fits = [(left - need, vm_id) for vm_id, left in free.items() if left >= need]
+            if not fits:
+                placements[task_key(task)] = None
+                continue
+            _, vm_id = min(fits)
+            free[vm_id] -= need
+            placements[task_key(task)] = vm_id
+        return placements, free
+
+    def place(self, tasks):
+        """task_key -> vm dict for every task; adds VMs when nothing fits. Raises NoCapacity at max_vms."""
+        vms = self.fleet.vms()
+        placements, _ = self.plan(tasks, vms)
+        unplaced = [task for task in sorted(tasks, key=lambda t: -t["rss"]) if placements[task_key(task)] is None]
+        while unplaced:
+            if len(vms) >= self.max_vms:
+                raise NoCapacity(f"{len(unplaced)} tasks do not fit in {len(vms)} VMs (pool limit {self.max_vms})")
+            # Size the new VM for the biggest leftover task; the rest may share it
+            need = self.demand(unplaced[0]["rss"])
+            memory_gib = max(self.vm_gib, math.ceil((need / GIB + VM_BASE_GIB) / (1 - self.headroom_percent / 100)))
+            vm = self.fleet.add_vm(memory_gib)
+            logger.info(f"No VM had room for {unplaced[0]['task']}, added {vm['vm_id']} ({memory_gib} GiB)")
+            vms.append(vm)
+            placed, _ = self.plan(unplaced, [vm])
+            if placed[task_key(unplaced[0])] is None:
+                raise NoCapacity(f"{unplaced[0]['task']} does not fit even in a new {memory_gib} GiB VM")
+            placements.update({key: vm_id for key, vm_id in placed.items() if vm_id})
+            unplaced = [task for task in unplaced if placed[task_key(task)] is None]
+        by_id = {vm["vm_id"]: vm for vm in vms}
+        return {key: by_id[vm_id] for key, vm_id in placements.items()}
+
+    def consolidate(self):
+        """Empty VMs below consolidate_below percent onto the others; returns the released vm_ids"""
+        vms = self.fleet.vms()
+        released = []
+        received = set()  # their task lists are stale now, so they are not emptied in this pass
+        # Least used first: those are the cheapest to empty
+        for vm in sorted(vms, key=lambda v: v["total"] - v["available"]):
+            used_percent = (vm["total"] - vm["available"]) * 100 / vm["total"]
+            others = [other for other in vms if other is not vm and other["vm_id"] not in released]
+            if vm.get("primary") or vm["vm_id"] in received or used_percent >= self.consolidate_below or not others:
+                continue
+            if not all(movable(task) for task in vm["tasks"]):
+                logger.info(f"VM {vm['vm_id']} runs apps that cannot be moved, keeping it")
+                continue
+            placements, _ = self.plan(vm["tasks"], others)
+            if any(vm_id is None for vm_id in placements.values()):
+                continue
+            by_id = {other["vm_id"]: other for other in others}
+            moved = []
+            for task in vm["tasks"]:
+                target = by_id[placements[task_key(task)]]
+                if not self.fleet.move(task, vm, target):
+                    logger.warning(f"Could not move {task['task']} off {vm['vm_id']}, keeping the VM")
+                    break
+                moved.append(task)
+                received.add(target["vm_id"])
+                target["available"] -= self.demand(task["rss"])
+            if len(moved) < len(vm["tasks"]):
+                continue
+            logger.info(f"VM {vm['vm_id']} was {round(used_percent)}% used, moved {len(moved)} tasks off and released it")
+            self.fleet.remove_vm(vm["vm_id"])
+            released.append(vm["vm_id"])
+        return released
+
+
+class UserFleet:
+    """
+    A user's VMs: the mapped VM (vm_id/vm_ip of their CloudRAMUserVMs item,
+    the one the UI shows) plus the extra VMs in the item's `pool` list. Live
+    headroom and the tasks on each VM come from one batch per agent.
+    """
+
+    def __init__(self, aws_manager, table, user_id, platform="windows"):
+        self.aws_manager = aws_manager
+        self.table = table
+        self.user_id = user_id
+        self.platform = platform
+
+    def _item(self):
+        return self.table.get_item(Key={"user_id": self.user_id}).get("Item")
+
+    def vms(self):
+        item = self._item()
+        if not item:
+            return []
+        members = [dict(vm_id=item["vm_id"], vm_ip=item["vm_ip"], primary=True)]
+        members += [dict(vm, primary=False) for vm in item.get("pool", [])]
+        vms = []
+        for member in members:
+            ops = [{"id": "ram", "op": "ram_usage"}, {"id": "tasks", "op": "launched_tasks"}]
+            results = {}
+            try:
+                for result in get_vm_client(member["vm_ip"]).batch(ops, timeout=10):
+                    if result.get("status") == "ok":
+                        results[result["id"]] = result["result"]
+            except (requests.RequestException, RuntimeError, ValueError) as e:
+                logger.warning(f"Leaving {member['vm_id']} out of placement, its agent did not answer: {e}")
+                continue
+            if "ram" not in results:
+                continue
+            vms.append(dict(
+                member,
+                total=results["ram"]["total_ram"],
+                available=results["ram"]["available_ram"],
+                tasks=results.get("tasks", {}).get("tasks", []),
+            ))
+        return vms
+
+    def add_vm(self, memory_gib):
+        # Always a new instance: reusing would hand back the user's own VM
+        vm_id, ip_address = self.aws_manager.create_vm(
+            memory_gib, platform=self.platform, user_id=self.user_id, reuse_existing=False, pool=True
+        )
+        if vm_id is None or ip_address is None:
+            raise NoCapacity(f"Could not launch a {memory_gib} GiB VM")
+        item = self._item() or {}
+        if vm_id == item.get("vm_id") or vm_id in {member["vm_id"] for member in item.get("pool", [])}:
+            # Not ours to terminate: consolidation would otherwise release the user's VM
+            raise NoCapacity(f"{vm_id} is already one of the VMs of {self.user_id}")
+        member = {"vm_id": vm_id, "vm_ip": ip_address, "memory_gib": memory_gib, "added_at": int(time.time())}
+        try:
+            self.table.update_item(
+                Key={"user_id": self.user_id},
+                UpdateExpression="SET pool = list_append(if_not_exists(pool, :empty), :member)",
+                ConditionExpression=Attr("user_id").exists(),
+                ExpressionAttributeValues={":empty": [], ":member": [member]},
+            )
+        except ClientError as e:
+            logger.error(f"Could not record {vm_id} in the pool of {self.user_id}: {e}")
+            self.aws_manager.terminate_vm(vm_id)
+            raise NoCapacity(f"Could not record the new VM: {e}")
+        # Free memory is what the fresh VM reports, not its nominal size
+        return dict(member, primary=False, tasks=[], **self._ram(ip_address, memory_gib))
+
+    def _ram(self, ip_address, memory_gib):
+        try:
+            ram = get_vm_client(ip_address).get_json("ram_usage")
+            return {"total": ram["total_ram"], "available": ram["available_ram"]}
+        except (requests.RequestException, ValueError, KeyError):
+            return {"total": memory_gib * GIB, "available": memory_gib * GIB}
+
+    def remove_vm(self, vm_id):
+        item = self._item() or {}
+        pool = item.get("pool", [])
+        remaining = [member for member in pool if member["vm_id"] != vm_id]
+        if len(remaining) == len(pool):
+            logger.warning(f"{vm_id} is not in the pool of {self.user_id}, not removing it")
+            return False
+        try:
+            # Only against the pool we read, so a concurrent add is not lost
+            self.table.update_item(
+                Key={"user_id": self.user_id},
+                UpdateExpression="SET pool = :remaining",
+                ConditionExpression=Attr("pool").eq(pool),
+                ExpressionAttributeValues={":remaining": remaining},
+            )
+        except ClientError as e:
+            logger.error(f"Could not remove {vm_id} from the pool of {self.user_id}: {e}")
+            return False
+        self.aws_manager.terminate_vm(vm_id)
+        return True
+
+    def move(self, task, source, target):
+        """Relaunch a task on target from its files in S3, then end it on source"""
+        if not movable(task):
+            logger.error(f"{task['task']} keeps its state on {source['vm_id']}, not moving it")
+            return False
+        payload = {
+            "task": task["task"],
+            "files": [os.path.basename(path) for path in task.get("files", [])],
+            "restore": task.get("restore") or {},
+        }
+        try:
+            response = get_vm_client(target["vm_ip"]).post("run_task", payload, timeout=120)
+            if response.status_code != 200:
+                logger.error(f"{target['vm_id']} could not launch {task['task']}: {response.text}")
+                return False
+            response = get_vm_client(source["vm_ip"]).post("terminate_task", {"pid": task["pid"]})
+            if response.status_code != 200:
+                # Running twice only costs memory, and consolidation releases the source VM next
+                logger.warning(f"{task['task']} (PID {task['pid']}) is still on {source['vm_id']}: {response.text}")
+        except requests.RequestException as e:
+            logger.error(f"Moving {task['task']} from {source['vm_id']} to {target['vm_id']} failed: {e}")
+            return False
+        return True
+
+
+class FakeFleet:
+    """
+    In-memory fleet for simulations: VMs have a size and a baseline (OS)
+    usage, tasks use exactly their rss. Every call is recorded in self.calls.
+    """
+
+    def __init__(self, vm_gibs=(), base_used_gib=1.0):
+        self.base_used = int(base_used_gib * GIB)
+        self.calls = []
+        self.members = {}  # vm_id -> {"total", "tasks": {task: rss}, "primary"}
+        self.vm_hours = 0.0
+        self.gib_hours = 0.0
+        self._next_id = 0
+        for memory_gib in vm_gibs:
+            self.add_vm(memory_gib)
+
+    def _view(self, vm_id):
+        member = self.members[vm_id]
+        used = self.base_used + sum(member["tasks"].values())
+        return {
+            "vm_id": vm_id,
+            "primary": member["primary"],
+            "total": member["total"],
+            "available": member["total"] - used,
+            "tasks": [{"task": task, "rss": rss} for task, rss in member["tasks"].items()],
+        }
+
+    def vms(self):
+        return [self._view(vm_id) for vm_id in self.members]
+
+    def add_vm(self, memory_gib):
+        vm_id = f"vm-{self._next_id}"
+        self._next_id += 1
+        self.calls.append(("add_vm", vm_id, memory_gib))
+        self.members[vm_id] = {"total": memory_gib * GIB, "tasks": {}, "primary": not self.members}
+        return self._view(vm_id)
+
+    def remove_vm(self, vm_id):
+        self.calls.append(("remove_vm", vm_id))
+        self.members.pop(vm_id)
+        return True
+
+    def move(self, task, source, target):
+        self.calls.append(("move", task["task"], source["vm_id"], target["vm_id"]))
+        rss = self.members[source["vm_id"]]["tasks"].pop(task["task"])
+        self.members[target["vm_id"]]["tasks"][task["task"]] = rss
+        return True
+
+    def start(self, task, rss, vm_id):
+        """A placed task starts running"""
+        self.members[vm_id]["tasks"][task] = rss
+
+    def finish(self, task):
+        for member in self.members.values():
+            member["tasks"].pop(task, None)
+
+    def tick(self, hours):
+        self.vm_hours += hours * len(self.members)
+        self.gib_hours += hours * sum(member["total"] for member in self.members.values()) / GIB
+
+
+class PoolConsolidator:
+    """Runs consolidate() for every user with extra VMs in their pool, every interval seconds."""
+
+    def __init__(self, aws_manager, table, interval=CONSOLIDATE_INTERVAL):
+        self.aws_manager = aws_manager
+        self.table = table
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep(self):
+        released = []
+        scan_kwargs = {"FilterExpression": Attr("pool").size().gt(0)}
+        while True:
+            page = self.table.scan(**scan_kwargs)
+            for item in page.get("Items", []):
+                if item.get("state", "running") != "running":
+                    continue
+                fleet = UserFleet(self.aws_manager, self.table, item["user_id"], item.get("platform", "windows"))
+                released.extend(PlacementScheduler(fleet).consolidate())
+            if "LastEvaluatedKey" not in page:
+                return released
+            scan_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    with background():
+                        self.sweep()
+                except Exception as e:
+                    logger.error(f"Pool consolidation failed: {e}")
+                self._stop.wait(self.interval)
+
+        self._thread = threading.Thread(target=run, daemon=True, name="pool-consolidator")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def simulate(hours=24, arrivals_per_hour=6, mean_gib=1.5, mean_hours=2.0, vm_gib=DEFAULT_VM_GIB,
+             max_vms=16, step_minutes=10, seed=1):
+    """
+    Synthetic workload on a FakeFleet: tasks arrive in a Poisson process with
+    lognormal RSS (mean mean_gib) and exponential lifetimes (mean mean_hours),
+    are placed as they arrive and consolidated every step. Returns VM-hours,
+    the peak VM count and how much of the provisioned memory tasks used.
+    """
+    rng = random.Random(seed)
+    fleet = FakeFleet([vm_gib])
+    scheduler = PlacementScheduler(fleet, vm_gib=vm_gib, max_vms=max_vms)
+    step = step_minutes / 60
+    running = {}  # task -> ends at (hours)
+    demand_gib_hours = 0.0
+    peak_vms = 1
+    rejected = 0
+    now = 0.0
+    for index in range(int(hours / step)):
+        now = index * step
+        for task, ends_at in list(running.items()):
+            if ends_at <= now:
+                fleet.finish(task)
+                del running[task]
+        arrivals = []
+        for n in range(_poisson(rng, arrivals_per_hour * step)):
+            rss = int(rng.lognormvariate(math.log(mean_gib) - 0.125, 0.5) * GIB)
+            arrivals.append({"task": f"task-{index}-{n}", "rss": rss})
+        if arrivals:
+            try:
+                placed = scheduler.place(arrivals)
+            except NoCapacity:
+                rejected += len(arrivals)
+                placed = {}
+            for task in arrivals:
+                if task["task"] in placed:
+                    fleet.start(task["task"], task["rss"], placed[task["task"]]["vm_id"])
+                    running[task["task"]] = now + rng.expovariate(1 / mean_hours)
+        scheduler.consolidate()
+        peak_vms = max(peak_vms, len(fleet.members))
+        demand_gib_hours += sum(
+            rss for vm in fleet.members.values() for rss in vm["tasks"].values()
+        ) * scheduler.rss_growth / GIB * step
+        fleet.tick(step)
+    return {
+        "vm_hours": round(fleet.vm_hours, 1),
+        "provisioned_gib_hours": round(fleet.gib_hours, 1),
+        "task_gib_hours": round(demand_gib_hours, 1),
+        "packing_efficiency": round(demand_gib_hours / fleet.gib_hours, 3) if fleet.gib_hours else None,
+        "peak_vms": peak_vms,
+        "rejected_tasks": rejected,
+        "added": sum(1 for call in fleet.calls if call[0] == "add_vm"),
+        "released": sum(1 for call in fleet.calls if call[0] == "remove_vm"),
+        "moves": sum(1 for call in fleet.calls if call[0] == "move"),
+    }
+
+
+def _poisson(rng, mean):
+    # Knuth; the means here are small
+    limit, count, product = math.exp(-mean), 0, rng.random()
+    while product > limit:
+        count += 1
+        product *= rng.random()
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the placement scheduler on a synthetic workload")
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--arrivals", type=float, default=6, help="tasks per hour")
+    parser.add_argument("--mean-gib", type=float, default=1.5, help="mean task RSS")
+    parser.add_argument("--mean-hours", type=float, default=2.0, help="mean task lifetime")
+    parser.add_argument("--vm-gib", type=int, default=DEFAULT_VM_GIB)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(simulate(args.hours, args.arrivals, args.mean_gib, args.mean_hours, args.vm_gib,
+                              seed=args.seed), indent=2))
@@ -0,0 +1,259 @@
+import os
+import shutil
+import subprocess
+import itertools
+import logging
+import psutil
+from wait_utils import wait_until
+from process_snapshot import ProcessSnapshotService
+
+logger = logging.getLogger(__name__)
+
+# Install locations we look in before falling back to PATH
+WINDOWS_APP_PATHS = {
+    "notepad++.exe": [
+        r"C:\\Program Files\\Notepad++\\notepad++.exe",
+        r"C:\\Program Files (x86)\\Notepad++\\notepad++.exe",
+    ],
+}
+POSIX_APP_COMMANDS = {
+    "notepad++.exe": ["notepad-plus-plus", "notepad++"],
+    "code.exe": ["code"],
+    "chrome.exe": ["google-chrome", "google-chrome-stable", "chromium"],
+}
+
+
+class PlatformOps:
+    """
+    The OS-specific operations the backend needs: window discovery, asking a
+    window to close (which makes Notepad++ save its session), killing and
+    launching apps. Pick an implementation with get_platform_ops().
+
+    Process lookups are served from a ProcessSnapshotService, the backend's
+    shared one when given, else one refreshed on demand, so nothing here scans
+    the process table on its own.
+    """
+
+    name = None
+
+    def __init__(self, processes=None):
+        self.processes = processes if processes is not None else ProcessSnapshotService()
+
+    def find_windows(self, title_substring):
+        """Handles of top-level windows whose title contains title_substring (case-insensitive)"""
+        return []
+
+    def request_close(self, handle):
+        """Politely ask a window to close; returns False if that is not supported"""
+        return False
+
+    def find(self, image_name, max_age=None):
+        """Running image_name processes as snapshot entries ({"pid", "name", "create_time", ...})"""
+        return self.processes.find(image_name, max_age=max_age)
+
+    def is_running(self, image_name, max_age=None):
+        return self.processes.is_running(image_name, max_age=max_age)
+
+    def pid_alive(self, pid, create_time=None):
+        """Whether pid still runs (as the process started at create_time, if given); asks about this PID only"""
+        try:
+            proc = psutil.Process(pid)
+            if create_time is not None and proc.create_time() != create_time:
+                return False
+            return proc.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+    def kill(self, image_name, force=True):
+        for info in self.find(image_name):
+            try:
+                proc = psutil.Process(info["pid"])
+                # Gone since the snapshot, and its PID reused
+                if proc.create_time() != info["create_time"]:
+                    continue
+                if force:
+                    proc.kill()
+                else:
+                    proc.terminate()
+            except psutil.NoSuchProcess:
+                continue
+            except psutil.Error as e:
+                logger.warning(f"Could not stop {image_name} ({info['pid']}): {e}")
+
+    def wait_for_exit(self, image_name, timeout):
+        # The processes are known up front, so polling only asks about their PIDs
+        known = self.find(image_name)
+        return wait_until(
+            lambda: not any(self.pid_alive(info["pid"], info["create_time"]) for info in known), timeout=timeout
+        )
+
+    def find_executable(self, image_name):
+        """Path (or command) that starts image_name, or None if it is not installed"""
+        return shutil.which(image_name)
+
+    def launch(self, command):
+        """Start command detached from the backend; returns the PID"""
+        return subprocess.Popen(command).pid
+
+
+class WindowsPlatformOps(PlatformOps):
+    """Win32 implementation; pywin32 is only imported on first window operation."""
+
+    name = "windows"
+
+    def __init__(self, processes=None):
+        super().__init__(processes)
+        self._win32 = None
+
+    def _modules(self):
+        if self._win32 is None:
+            import win32gui
+            import win32con
+            self._win32 = (win32gui, win32con)
+        return self._win32
+
+    def find_windows(self, title_substring):
+        win32gui, _ = self._modules()
+        needle = title_substring.lower()
+
+        def enum_windows_callback(hwnd, results):
+            if needle in win32gui.GetWindowText(hwnd).lower():
+                results.append(hwnd)
+        windows = []
+        win32gui.EnumWindows(enum_windows_callback, windows)
+        return windows
+
+    def request_close(self, handle):
+        win32gui, win32con = self._modules()
+        win32gui.PostMessage(handle, win32con.WM_CLOSE, 0, 0)
+        return True
+
+    def kill(self, image_name, force=True):
+        command = ["taskkill", "/IM", image_name] + (["/F"] if force else [])
+        subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def find_executable(self, image_name):
+        for path in WINDOWS_APP_PATHS.get(image_name.lower(), []):
+            if os.path.exists(path):
+                return path
+        return shutil.which(image_name)
+
+
+class PosixPlatformOps(PlatformOps):
+    """Linux/macOS implementation. Window operations go through wmctrl when it is installed."""
+
+    name = "posix"
+
+    def find_windows(self, title_substring):
+        if not shutil.which("wmctrl"):
+            return []
+        try:
+            output = subprocess.run(["wmctrl", "-l"], capture_output=True, text=True, timeout=5).stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"wmctrl failed: {e}")
+            return []
+        needle = title_substring.lower()
+        # "<window id> <desktop> <host> <title>"
+        return [
+            line.split(None, 1)[0] for line in output.splitlines()
+            if len(line.split(None, 3)) == 4 and needle in line.split(None, 3)[3].lower()
+        ]
+
+    def request_close(self, handle):
+        if not shutil.which("wmctrl"):
+            return False
+        return subprocess.call(["wmctrl", "-ic", str(handle)]) == 0
+
+    def find_executable(self, image_name):
+        for command in POSIX_APP_COMMANDS.get(image_name.lower(), []) + [image_name]:
+            path = shutil.which(command)
+            if path:
+                return path
+        return None
+
+    def launch(self, command):
+        return subprocess.Popen(command, start_new_session=True).pid
+
+
+class FakePlatformOps(PlatformOps):
+    """
+    In-memory stand-in for benchmarks and load tests: apps and windows exist only
+    in this object, and every call is recorded in self.calls. on_close, if set, is
+    called with the window title when a close is requested (e.g. to rewrite a
+    session file the way Notepad++ would).
+    """
+
+    name = "fake"
+
+    def __init__(self, on_close=None, close_exits=False, processes=None):
+        super().__init__(processes)
+        self.on_close = on_close
+        self.close_exits = close_exits  # whether a close request also ends the app
+        self.calls = []
+        self.apps = {}  # pid -> image name
+        self.windows = {}  # handle -> (pid, title)
+        self._pids = itertools.count(10000)
+
+    def start_app(self, image_name, title=None):
+        """Pretend image_name is running with one window; returns its PID"""
+        pid = next(self._pids)
+        self.apps[pid] = image_name
+        self.windows[pid] = (pid, title or image_name)
+        return pid
+
+    def find_windows(self, title_substring):
+        self.calls.append(("find_windows", title_substring))
+        needle = title_substring.lower()
+        return [handle for handle, (_, title) in self.windows.items() if needle in title.lower()]
+
+    def request_close(self, handle):
+        self.calls.append(("request_close", handle))
+        pid, title = self.windows.get(handle, (None, ""))
+        if self.on_close:
+            self.on_close(title)
+        if self.close_exits and pid is not None:
+            self._remove(pid)
+        return True
+
+    def find(self, image_name, max_age=None):
+        return [
+            {"pid": pid, "name": name, "create_time": None}
+            for pid, name in self.apps.items() if name.lower() == image_name.lower()
+        ]
+
+    def is_running(self, image_name, max_age=None):
+        return bool(self.find(image_name))
+
+    def pid_alive(self, pid, create_time=None):
+        return pid in self.apps
+
+    def kill(self, image_name, force=True):
+        self.calls.append(("kill", image_name, force))
+        for info in self.find(image_name):
+            self._remove(info["pid"])
+
+    def _remove(self, pid):
+        self.apps.pop(pid, None)
+        for handle, (owner, _) in list(self.windows.items()):
+            if owner == pid:
+                del self.windows[handle]
+
+    def find_executable(self, image_name):
+        return image_name
+
+    def launch(self, command):
+        self.calls.append(("launch", list(command)))
+        return self.start_app(os.path.basename(command[0]))
+
+
+def get_platform_ops(name=None, processes=None):
+    """Platform ops for name ("windows", "posix" or "fake"), else CLOUD_RAM_PLATFORM_OPS, else this OS"""
+    name = name or os.getenv("CLOUD_RAM_PLATFORM_OPS") or ("windows" if os.name == "nt" else "posix")
+    implementations = {
+        "windows": WindowsPlatformOps,
+        "posix": PosixPlatformOps,
+        "fake": FakePlatformOps,
+    }
+    if name not in implementations:
+        raise ValueError(f"Unknown platform ops: {name}")
+    return implementations[name](processes=processes)
@@ -1,18 +1,27 @@
-import psutil
 import requests
 import os
 import shutil
-import boto3
 import botocore.exceptions
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import threading
 import time
-import xml.etree.ElementTree as ET
-import subprocess
 import logging
-import win32gui
-import win32con
+import json
+from wait_utils import Deadline, wait_until, wait_for_file_stable, wait_for_dir_stable, path_signature
+from platform_ops import get_platform_ops
+from backup_snapshotter import BackupSnapshotter
+from open_file_tracker import OpenFileTracker
+from process_snapshot import ProcessSnapshotService
+from tracked_file_store import TrackedFileStore
+from migration_pipeline import (
+    StageTimer, FileStreamer, MigrationEngine, file_signature, file_md5,
+    CONTROL_PREFIX, WORKING_SET_MANIFEST_KEY, SYNC_SECONDS_PER_KEY
+)
+from app_adapters import adapter_for, APP_STATE_PREFIXES
+from vm_client import get_vm_client
+from rate_governor import governed_client, background, transfer_config
+from metrics import counter, gauge
 
 # Configure logging
 logging.basicConfig(
@@ -25,40 +34,138 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Upper bounds for the readiness waits; the waits return as soon as the app is done
+SESSION_SAVE_TIMEOUT = 5
+# How long a close request gets to start the session write or end the app
+SESSION_CLOSE_GRACE = 1
+BACKUP_SETTLE_TIMEOUT = 3
+PROCESS_EXIT_TIMEOUT = 5
+PROCESS_READY_TIMEOUT = 10
+# A migration acts on the PID it finds, so it wants a fresher snapshot than listings do
+LOCATE_MAX_AGE = 0.25
+# Read timeout of a sync batch before the per-key allowance: the VM first waits out any prefetch (up to 60s)
+SYNC_BATCH_TIMEOUT = 60
+
+TRACKED_FILES_DB = "tracked_files.db"
+
+WATCHER_EVENTS = counter(
+    "cloud_ram_watcher_events_total", "File change events seen by the watcher, by what was done with them",
+    labels=("side", "outcome")
+)
+
+class TrackedPaths(set):
+    """
+    The tracked file paths, with a basename index for the watcher, which gets
+    events by path and would otherwise compare every tracked path per event.
+    The index is rebuilt on first use after the set changes.
+    """
+
+    def __init__(self, paths=()):
+        super().__init__(paths)
+        self._by_basename = None
+
+    def by_basename(self, name):
+        """A tracked path with this basename, or None"""
+        if self._by_basename is None:
+            self._by_basename = {os.path.basename(path): path for path in self}
+        return self._by_basename.get(name)
+
+    def _changed(self):
+        self._by_basename = None
+
+    def add(self, path):
+        super().add(path)
+        self._changed()
+
+    def remove(self, path):
+        super().remove(path)
+        self._changed()
+
+    def discard(self, path):
+        super().discard(path)
+        self._changed()
+
+    def pop(self):
+        path = super().pop()
+        self._changed()
+        return path
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def update(self, *others):
+        super().update(*others)
+        self._changed()
+
+    def difference_update(self, *others):
+        super().difference_update(*others)
+        self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+
 class ProcessManager:
-    def __init__(self):
-        self.s3 = boto3.client('s3')
+    def __init__(self, platform=None):
+        self.s3 = governed_client('s3')
         self.BUCKET_NAME = 'notepadfiles'
         self.sync_running = False
         self.notepad_dir = r"C:\\Users\\muvva\\AppData\\Roaming\\Notepad++"
         self.backup_dir = os.path.join(self.notepad_dir, "backup")
+        self.session_path = os.path.join(self.notepad_dir, "session.xml")
+        # Shared, periodically refreshed view of the process table
+        self.processes = ProcessSnapshotService()
+        self.processes.start()
+        # Window, kill and launch operations; FakePlatformOps makes this runnable anywhere
+        self.platform = platform or get_platform_ops(processes=self.processes)
+        gauge(
+            "cloud_ram_local_task_rss_bytes", "Resident memory of each target app on this machine", labels=("task",),
+            fn=lambda: {(task["task"],): task["rss"] for task in self.task_memory(self.processes.target_apps)}
+        )
+        self.open_file_tracker = OpenFileTracker(self.session_path, processes=self.processes)
         self.unsaved_temp_dir = os.path.join(os.getcwd(), "unsaved_files")
         os.makedirs(self.unsaved_temp_dir, exist_ok=True)
+        self.backup_snapshotter = BackupSnapshotter(self.backup_dir, self.unsaved_temp_dir)
         self.tracked_files = set()
-        self.file_record_path = "notepad_file_paths.txt"
+        self.file_record_path = "notepad_file_paths.txt"  # legacy flat record, imported once
+        self.file_store = TrackedFileStore(TRACKED_FILES_DB, legacy_record_path=self.file_record_path)
+        self._stored_paths = set()
         self.vm_ip = None
+        self.last_migration_timings = {}
+        self.staged_files = {}  # file_path -> (s3_key, signature) staged ahead of migration
+        self._staging_thread = None
         self.load_tracked_files()
 
+    @property
+    def tracked_files(self):
+        return self._tracked_files
+
+    @tracked_files.setter
+    def tracked_files(self, paths):
+        self._tracked_files = TrackedPaths(paths)
+
     def load_tracked_files(self):
-        """Load previously tracked files from the record"""
-        if os.path.exists(self.file_record_path):
-            with open(self.file_record_path, 'r') as f:
-                self.tracked_files = set(line.strip() for line in f)
-                logger.info(f"Loaded {len(self.tracked_files)} tracked files from record")
+        """Load previously tracked files from the store"""
+        self._stored_paths = self.file_store.paths()
+        self.tracked_files = set(self._stored_paths)
+        logger.info(f"Loaded {len(self.tracked_files)} tracked files from store")
 
     def force_notepad_session_save(self):
         """
-        Force Notepad++ to save its session by sending a WM_CLOSE message to its window,
-        then immediately cancel the close to keep it running.
+        Force Notepad++ to save its session by asking its window to close (WM_CLOSE
+        on Windows), then immediately cancel the close to keep it running. Returns as
+        soon as session.xml has been rewritten and settled instead of sleeping a fixed time.
         """
         try:
             # Find the Notepad++ window
             hwnd = None
-            def enum_windows_callback(hwnd, results):
-                if "notepad++" in win32gui.GetWindowText(hwnd).lower():
-                    results.append(hwnd)
-            windows = []
-            win32gui.EnumWindows(enum_windows_callback, windows)
+            windows = self._find_notepad_windows()
             if not windows:
                 logger.warning("No Notepad++ window found to force session save")
                 return False
@@ -66,20 +173,31 @@ class ProcessManager:
             hwnd = windows[0]
             logger.info(f"Found Notepad++ window handle: {hwnd}")
 
-            # Send WM_CLOSE to trigger session save
-            win32gui.PostMessage(hwnd, win32con.WM_CLOSE, 0, 0)
-            time.sleep(1)  # Give it a moment to save the session
+            # Ask the window to close to trigger session save
+            deadline = Deadline(SESSION_SAVE_TIMEOUT)
+            session_before = path_signature(self.session_path)
+            # Looked up once; the waits below only poll these PIDs
+            notepad = self.platform.find('notepad++.exe', max_age=LOCATE_MAX_AGE)
+            if not self.platform.request_close(hwnd):
+                logger.warning(f"Closing windows is not supported on {self.platform.name}")
+                return False
+
+            # On close Notepad++ rewrites session.xml and exits. If it does neither within
+            # the grace period, the close was refused (e.g. a save prompt).
+            wait_until(
+                lambda: path_signature(self.session_path) != session_before or not self._any_alive(notepad),
+                timeout=SESSION_CLOSE_GRACE
+            )
+            if path_signature(self.session_path) != session_before:
+                wait_for_file_stable(self.session_path, deadline=deadline)
+            elif self._any_alive(notepad):
+                logger.warning("Notepad++ did not save its session after the close request")
+                return False
 
             # Check if Notepad++ is still running; if not, restart it
-            notepad_running = any(proc.info['name'].lower() == 'notepad++.exe' 
-                                 for proc in psutil.process_iter(['pid', 'name']))
-            if not notepad_running:
-                logger.info("Notepad++ closed after WM_CLOSE, restarting...")
-                notepad_exe = r"C:\\Program Files\\Notepad++\\notepad++.exe"
-                if not os.path.exists(notepad_exe):
-                    notepad_exe = r"C:\\Program Files (x86)\\Notepad++\\notepad++.exe"
-                subprocess.Popen([notepad_exe])
-                time.sleep(3)
+            if not self._any_alive(notepad):
+                logger.info("Notepad++ closed after the close request, restarting...")
+                self._wait_for_notepad_ready(self.platform.launch([self._notepad_exe()]))
 
             logger.info("Forced Notepad++ session save")
             return True
@@ -87,105 +205,62 @@ class ProcessManager:
             logger.error(f"Failed to force Notepad++ session save: {e}")
             return False
 
+    def _find_notepad_windows(self):
+        """Handles of top-level windows whose title mentions Notepad++"""
+        return self.platform.find_windows("notepad++")
+
+    def _any_alive(self, processes):
+        return any(self.platform.pid_alive(info["pid"], info["create_time"]) for info in processes)
+
+    def _wait_for_notepad_ready(self, pid):
+        """Wait until the Notepad++ we launched as pid runs and has a window up"""
+        return wait_until(
+            lambda: self.platform.pid_alive(pid) and bool(self._find_notepad_windows()),
+            timeout=PROCESS_READY_TIMEOUT
+        )
+
+    def _notepad_exe(self):
+        notepad_exe = self.platform.find_executable('notepad++.exe')
+        if not notepad_exe:
+            raise FileNotFoundError("Notepad++ executable not found.")
+        return notepad_exe
+
     def get_current_open_files(self):
         """
         Get the currently open files in Notepad++ by inspecting the process's open file handles.
-        Fallback to session.xml if necessary.
+        Fallback to session.xml if necessary. Repeat calls are answered from the
+        tracker's cache until the Notepad++ PID or session.xml changes.
         """
-        open_files = []
-        
-        # Step 1: Find the Notepad++ process and inspect its open files
-        notepad_proc = None
-        for proc in psutil.process_iter(['pid', 'name']):
-            if proc.info['name'].lower() == 'notepad++.exe':
-                notepad_proc = proc
-                break
-        
-        if notepad_proc:
-            try:
-                # Get all file handles opened by the Notepad++ process
-                all_files = notepad_proc.open_files()
-                logger.info(f"All open files in Notepad++ via psutil: {[f.path for f in all_files]}")
-                for file in all_files:
-                    file_path = file.path
-                    # Filter for typical Notepad++ file extensions and exclude internal files
-                    if (file_path.lower().endswith(('.txt', '.cpp', '.py', '.html')) and 
-                        'notepad++' not in file_path.lower() and 
-                        os.path.isfile(file_path)):
-                        open_files.append(file_path)
-                        logger.info(f"Found open file via psutil: {file_path}")
-            except psutil.AccessDenied:
-                logger.warning("Access denied while trying to get open files from Notepad++ process")
-            except Exception as e:
-                logger.error(f"Error getting open files via psutil: {e}")
-
-        # Step 2: Fallback to session.xml if no files were found via psutil
-        if not open_files:
-            logger.info("No files found via psutil, falling back to session.xml")
-            session_path = os.path.expanduser("C:\\Users\\muvva\\AppData\\Roaming\\Notepad++\\session.xml")
-            if not os.path.exists(session_path):
-                logger.error("session.xml not found.")
-                return open_files
-
-            try:
-                with open(session_path, 'r', encoding='utf-8') as f:
-                    session_content = f.read()
-                    logger.info(f"session.xml content: {session_content}")
-                tree = ET.parse(session_path)
-                root = tree.getroot()
-                for file_node in root.iter('File'):
-                    file_path = file_node.get('filename')
-                    if file_path and os.path.isfile(file_path):
-                        open_files.append(file_path)
-                        logger.info(f"Found open file in session.xml: {file_path}")
-            except Exception as e:
-                logger.error(f"Failed to parse session.xml: {e}")
-
-        # Remove duplicates while preserving order
-        open_files = list(dict.fromkeys(open_files))
+        open_files = self.open_file_tracker.open_files()
         logger.info(f"Final list of open files: {open_files}")
         return open_files
 
     def get_unsaved_backup_files(self):
         """
         Get unsaved backup files from Notepad++'s backup directory.
-        Wait briefly to ensure backups are created.
+        Waits only until the directory has stopped changing, then snapshots
+        incrementally: only new or changed buffers are copied.
         """
-        # Wait to allow Notepad++ to create backup files
-        time.sleep(2)  # Adjust delay if needed
-        backups = []
+        # Let Notepad++ finish flushing backup files
         if os.path.exists(self.backup_dir):
-            backup_files = os.listdir(self.backup_dir)
-            logger.info(f"Backup files found in {self.backup_dir}: {backup_files}")
-            for file in backup_files:
-                full_path = os.path.join(self.backup_dir, file)
-                if os.path.isfile(full_path):
-                    dest = os.path.join(self.unsaved_temp_dir, file)
-                    shutil.copy2(full_path, dest)
-                    backups.append(dest)
-                    logger.info(f"Backed up unsaved file: {file}")
-        else:
-            logger.warning(f"Backup directory {self.backup_dir} does not exist")
+            wait_for_dir_stable(self.backup_dir, timeout=BACKUP_SETTLE_TIMEOUT)
+        backups = self.backup_snapshotter.snapshot()
+        logger.info(f"Unsaved buffers snapshotted: {len(backups)} ({self.backup_snapshotter.last_stats})")
         return backups
 
     def _refresh_notepad_session(self, files_to_open, unsaved_files):
         try:
             logger.info("Terminating Notepad++ to refresh state...")
-            subprocess.call(["taskkill", "/F", "/IM", "notepad++.exe"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            time.sleep(2)
+            self.platform.kill('notepad++.exe', force=True)
+            self.platform.wait_for_exit('notepad++.exe', timeout=PROCESS_EXIT_TIMEOUT)
 
-            notepad_exe = r"C:\\Program Files\\Notepad++\\notepad++.exe"
-            if not os.path.exists(notepad_exe):
-                notepad_exe = r"C:\\Program Files (x86)\\Notepad++\\notepad++.exe"
-            if not os.path.exists(notepad_exe):
-                raise FileNotFoundError("Notepad++ executable not found.")
+            notepad_exe = self._notepad_exe()
 
             # Combine files_to_open and unsaved_files, removing duplicates
             all_files = list(dict.fromkeys(files_to_open + unsaved_files))
             command = [notepad_exe] + all_files  # Remove -nosession to allow Notepad++ to load its session state
             logger.info(f"Restarting Notepad++ with updated files: {all_files}")
-            subprocess.Popen(command)
-            time.sleep(3)
+            self._wait_for_notepad_ready(self.platform.launch(command))
 
             logger.info("Restart complete.")
             return True
@@ -194,154 +269,252 @@ class ProcessManager:
             logger.error(f"Error refreshing Notepad++ session: {e}")
             return False
 
-    def move_task_to_cloud(self, task_name, vm_ip, sync_state=False):
-        logger.info(f"move_task_to_cloud called for {task_name} to VM {vm_ip}")
-        self.vm_ip = vm_ip
+    def track_captured_notepad_files(self, open_files, unsaved_files):
+        """
+        Make the captured open files the tracked set. Unsaved buffers without a
+        corresponding open file get a real path under ~/Documents/NotepadSync;
+        returns those copies so they are migrated as well.
+        """
+        self.tracked_files = set(open_files)
+        new_files = []
+        # Include unsaved files in tracked files if they correspond to actual files
+        for unsaved_file in unsaved_files:
+            # If the unsaved file has a corresponding real file, track it
+            base_name = os.path.basename(unsaved_file)
+            # Try to match with open files or assume it's a new file
+            corresponding_file = None
+            for tracked in open_files:
+                if base_name in tracked:
+                    corresponding_file = tracked
+                    break
+            if corresponding_file:
+                self.tracked_files.add(corresponding_file)
+            else:
+                # If it's a new unsaved file, we need to give it a proper path
+                new_file_path = os.path.join(os.path.expanduser("~/Documents/NotepadSync"), base_name)
+                if not os.path.exists(os.path.dirname(new_file_path)):
+                    os.makedirs(os.path.dirname(new_file_path))
+                # copy2 keeps mtime, so an identical signature means nothing changed
+                if path_signature(new_file_path) != path_signature(unsaved_file):
+                    shutil.copy2(unsaved_file, new_file_path)
+                self.tracked_files.add(new_file_path)
+                new_files.append(new_file_path)
+                logger.info(f"Added new unsaved file to tracked files: {new_file_path}")
 
-        # Find the process before we do anything
-        task = next((p for p in psutil.process_iter(["pid", "name"]) if p.info["name"].lower() == task_name.lower()), None)
-        if not task:
-            logger.error(f"Task {task_name} not found locally")
-            return False
+        self._update_tracked_file_list(self.tracked_files)
+        logger.info(f"Tracked files after update: {self.tracked_files}")
+        return new_files
 
-        pid = task.info["pid"]  # Store PID early
-
-        if task_name.lower() == "notepad++.exe" and sync_state:
-            logger.info("Extracting Notepad++ session info...")
-            # Force Notepad++ to save its session
-            self.force_notepad_session_save()
-
-            # Get currently open files
-            files_to_track = self.get_current_open_files()
-            logger.info(f"Files to track after get_current_open_files: {files_to_track}")
-
-            # Get unsaved files
-            unsaved_files = self.get_unsaved_backup_files()
-            logger.info(f"Unsaved files detected: {unsaved_files}")
-
-            logger.info("Refreshing Notepad++ session...")
-            self._refresh_notepad_session(files_to_track, unsaved_files)
-
-            # Update tracked files
-            self.tracked_files = set(files_to_track)
-            # Include unsaved files in tracked files if they correspond to actual files
-            for unsaved_file in unsaved_files:
-                # If the unsaved file has a corresponding real file, track it
-                base_name = os.path.basename(unsaved_file)
-                # Try to match with open files or assume it's a new file
-                corresponding_file = None
-                for tracked in files_to_track:
-                    if base_name in tracked:
-                        corresponding_file = tracked
-                        break
-                if corresponding_file:
-                    self.tracked_files.add(corresponding_file)
-                else:
-                    # If it's a new unsaved file, we need to give it a proper path
-                    new_file_path = os.path.join(os.path.expanduser("~/Documents/NotepadSync"), base_name)
-                    if not os.path.exists(os.path.dirname(new_file_path)):
-                        os.makedirs(os.path.dirname(new_file_path))
-                    shutil.copy2(unsaved_file, new_file_path)
-                    self.tracked_files.add(new_file_path)
-                    logger.info(f"Added new unsaved file to tracked files: {new_file_path}")
+    def migrate_tasks(self, task_names, vm_ip):
+        """
+        Migrate several tasks to the VM in one pass. Each app's state is captured by
+        its adapter (app_adapters.adapter_for) and all of them share one engine:
+        captures run in parallel, files stream to S3 as they are identified and the
+        final cutover only resends what changed afterwards. Returns
+        task_name -> {"success", "timings"}; timings are also kept in
+        self.last_migration_timings.
+        """
+        logger.info(f"migrate_tasks called for {task_names} to VM {vm_ip}")
+        self.vm_ip = vm_ip
+        results = {}
+        adapters = {}
+
+        # Find the processes before we do anything
+        for task_name in task_names:
+            timer = StageTimer()
+            with timer.stage("locate_task"):
+                running = self.platform.is_running(task_name, max_age=LOCATE_MAX_AGE)
+            if not running:
+                logger.error(f"Task {task_name} not found locally")
+                results[task_name] = {"success": False, "timings": timer.summary()}
+                continue
+            adapters[task_name] = adapter_for(task_name, self)
 
-            self._update_tracked_file_list(self.tracked_files)
-            logger.info(f"Tracked files after update: {self.tracked_files}")
+        if adapters:
+            engine = MigrationEngine(
+                self.s3, self.BUCKET_NAME,
+                staged=self.staged_files,
+                previous=self.file_store.app_state_uploads(),
+                on_uploaded=self._record_migrated_upload
+            )
+            results.update(engine.migrate(adapters, vm_ip))
 
-            logger.info("Uploading tracked files to S3...")
-            self._upload_tracked_files_to_s3()
+        self.last_migration_timings = {task: result["timings"] for task, result in results.items()}
+        return results
 
-            self.start_notepad_auto_sync(vm_ip)
-            self.start_periodic_sync(interval_seconds=30)
+    def _record_migrated_upload(self, file_path, s3_key, signature):
+        if file_path in self.tracked_files:
+            self.file_store.record_upload(file_path, signature)
+        elif s3_key.startswith(APP_STATE_PREFIXES):
+            # App state streamed by other adapters (VS Code, Chrome) is not a tracked file
+            self.file_store.record_app_state_upload(file_path, s3_key, signature)
+
+    def move_task_to_cloud(self, task_name, vm_ip):
+        """Migrate a single task; see migrate_tasks"""
+        result = self.migrate_tasks([task_name], vm_ip)[task_name]
+        self.last_migration_timings = result["timings"]
+        return result["success"]
+
+    def stage_working_set(self):
+        """
+        Upload the tracked working set to S3 ahead of migration and publish a manifest
+        the VM agent pulls on boot. The bucket is listed once; a file is skipped when
+        its object is there and its MD5 matches the hash recorded at its last upload
+        (or the ETag, which is only an MD5 for single-part uploads).
+        """
+        files = [f for f in self.tracked_files if os.path.isfile(f)]
+        if not files:
+            logger.info("No tracked files to stage")
+            return []
 
-            # Force kill again just to be sure
-            logger.info("Force killing Notepad++ after refresh...")
-            subprocess.call(["taskkill", "/F", "/IM", "notepad++.exe"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            time.sleep(1)
-            for proc in psutil.process_iter(["pid", "name"]):
-                if proc.info["name"].lower() == "notepad++.exe":
-                    try:
-                        proc.terminate()
-                        proc.wait(timeout=5)
-                    except Exception as e:
-                        logger.warning(f"Could not terminate lingering Notepad++: {e}")
+        remote_etags = {}
+        try:
+            paginator = self.s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.BUCKET_NAME):
+                for obj in page.get('Contents', []):
+                    remote_etags[obj['Key']] = obj['ETag'].strip('"')
+        except botocore.exceptions.ClientError as e:
+            logger.error(f"Could not list bucket for staging: {e}")
+
+        streamer = FileStreamer(self.s3, self.BUCKET_NAME)
+        manifest = []
+        hashes = {}
+        try:
+            for file_path in files:
+                s3_key = os.path.basename(file_path)
+                signature = file_signature(file_path)
+                state = self.file_store.get(file_path) or {}
+                # Skip hashing when the file is exactly what we last uploaded
+                if (state.get("uploaded_size"), state.get("uploaded_mtime_ns")) == signature and state.get("last_uploaded_hash"):
+                    digest = state["last_uploaded_hash"]
+                else:
+                    digest = file_md5(file_path)
+                hashes[file_path] = digest
+                if s3_key in remote_etags and digest in (state.get("last_uploaded_hash"), remote_etags[s3_key]):
+                    self.staged_files[file_path] = (s3_key, signature)
+                    self.file_store.record_upload(file_path, signature, digest, remote_etags[s3_key])
+                else:
+                    streamer.submit(file_path)
+                manifest.append({"key": s3_key, "md5": digest})
+            uploaded = streamer.wait()
+        finally:
+            streamer.shutdown()
+        for file_path, (s3_key, signature) in streamer.uploaded().items():
+            self.staged_files[file_path] = (s3_key, signature)
+            self.file_store.record_upload(file_path, signature, hashes[file_path])
+
+        self.s3.put_object(
+            Bucket=self.BUCKET_NAME,
+            Key=WORKING_SET_MANIFEST_KEY,
+            Body=json.dumps({"files": manifest, "staged_at": int(time.time())}).encode("utf-8")
+        )
+        logger.info(f"Staged working set: {len(manifest)} files, {len(uploaded)} uploaded")
+        return [entry["key"] for entry in manifest]
+
+    def start_working_set_staging(self):
+        """Stage the working set in the background, e.g. while a VM boots"""
+        if self._staging_thread and self._staging_thread.is_alive():
+            logger.info("Working set staging already running.")
+            return
 
-        else:
+        def run_staging():
             try:
-                logger.info(f"Terminating {task_name} (PID: {pid})...")
-                proc = psutil.Process(pid)
-                proc.terminate()
-                proc.wait(timeout=5)
-            except psutil.NoSuchProcess:
-                logger.warning(f"{task_name} already terminated.")
+                self.stage_working_set()
             except Exception as e:
-                logger.error(f"Error terminating {task_name}: {e}")
-                return False
+                logger.error(f"Working set staging failed: {e}")
+
+        self._staging_thread = threading.Thread(target=run_staging, daemon=True)
+        self._staging_thread.start()
+
+    def wait_for_working_set_staging(self, timeout=None):
+        if self._staging_thread:
+            self._staging_thread.join(timeout)
 
-        # Start on VM
+    def request_working_set_prefetch(self, vm_ip):
+        """Have the VM pull the staged working set manifest now"""
+        self._request_vm_prefetch(vm_ip, None, [], manifest=True)
+
+    def _request_vm_prefetch(self, vm_ip, task_name, s3_keys, manifest=False):
+        """Ask the VM to start downloading files and warming the app in the background"""
         try:
-            logger.info(f"Sending POST to VM: http://{vm_ip}:5000/run_task with task={task_name}")
-            response = requests.post(f"http://{vm_ip}:5000/run_task", json={"task": task_name})
-            logger.info(f"Response: {response.status_code} - {response.text}")
-            if response.status_code == 200:
-                logger.info(f"{task_name} started on VM")
-                return True
-            else:
-                logger.error(f"Failed to start {task_name} on VM")
-                return False
-        except Exception as e:
-            logger.error(f"Could not contact VM: {e}")
-            return False
+            response = get_vm_client(vm_ip).post(
+                "prefetch",
+                {"task": task_name, "files": s3_keys, "manifest": manifest},
+                timeout=5,
+                idempotent=True
+            )
+            logger.info(f"VM prefetch response: {response.status_code}")
+        except requests.RequestException as e:
+            # Not fatal: /run_task downloads whatever the prefetch did not get to
+            logger.warning(f"Could not start VM prefetch: {e}")
+
+    def task_memory(self, task_names):
+        """[{"task", "rss"}]: resident memory of each task's processes here, for placement"""
+        snapshot = self.processes.snapshot()
+        return [
+            {"task": task_name, "rss": sum(info["rss"] for info in snapshot.find(task_name))}
+            for task_name in task_names
+        ]
 
     def get_local_tasks(self):
         try:
-            target_tasks = ['notepad++.exe', 'chrome.exe', 'Code.exe']
-            tasks = [{"pid": p.info["pid"], "name": p.info["name"]}
-                     for p in psutil.process_iter(["pid", "name"]) if p.info["name"] in target_tasks]
-            return {"tasks": tasks}
+            return {"tasks": self.processes.target_tasks()}
         except Exception as e:
             logger.error(f"Error fetching local tasks: {str(e)}")
             return {"tasks": []}
 
     def _update_tracked_file_list(self, current_files):
-        previous_files = set()
-        if os.path.exists(self.file_record_path):
-            with open(self.file_record_path, 'r') as f:
-                previous_files = set(line.strip() for line in f)
-
-        updated_files = previous_files.union(current_files)
-        with open(self.file_record_path, 'w') as f:
-            for file in sorted(updated_files):
-                f.write(file + '\n')
+        """Persist files not yet in the store; already stored ones cost nothing"""
+        new_files = set(current_files) - self._stored_paths
+        if new_files:
+            self.file_store.add_many(new_files)
+            self._stored_paths |= new_files
 
-        logger.info(f"Updated tracked files list with {len(updated_files)} files")
+        logger.info(f"Updated tracked files list with {len(new_files)} new files ({len(self._stored_paths)} total)")
 
     def _upload_tracked_files_to_s3(self):
+        uploaded_keys = []
         for file_path in self.tracked_files:
             if os.path.exists(file_path):
                 s3_key = os.path.basename(file_path)
                 try:
-                    self._upload_file_to_s3(file_path, s3_key)
+                    self._upload_file_to_s3(file_path, s3_key, notify=False)
+                    uploaded_keys.append(s3_key)
                 except Exception as e:
                     logger.error(f"Upload error: {e}")
             else:
                 logger.warning(f"Tracked file not found, can't upload: {file_path}")
+        self._notify_vm_sync(uploaded_keys)
 
-    def _upload_file_to_s3(self, file_path, s3_key):
+    def _upload_file_to_s3(self, file_path, s3_key, notify=True):
         logger.info(f"Uploading {file_path} -> s3://{self.BUCKET_NAME}/{s3_key}...")
-        self.s3.upload_file(file_path, self.BUCKET_NAME, s3_key)
+        signature = file_signature(file_path)
+        digest = file_md5(file_path)
+        self.s3.upload_file(file_path, self.BUCKET_NAME, s3_key, Config=transfer_config())
+        self.file_store.record_upload(file_path, signature, digest)
         logger.info(f"Upload complete: {s3_key}")
-        
+
         # Notify VM to sync this file if we have a VM IP
-        if self.vm_ip:
-            try:
-                response = requests.post(
-                    f"http://{self.vm_ip}:5000/sync_notepad_files", 
-                    json={"file": s3_key}
-                )
-                logger.info(f"VM notification response: {response.status_code}")
-            except Exception as e:
-                logger.error(f"Failed to notify VM of file change: {e}")
+        if notify:
+            self._notify_vm_sync([s3_key])
+
+    def _notify_vm_sync(self, s3_keys):
+        """Have the VM pull the given keys, all in one batch request"""
+        if not self.vm_ip or not s3_keys:
+            return
+        try:
+            ops = [{"op": "sync_keys", "args": {"keys": list(s3_keys)}}]
+            timeout = SYNC_BATCH_TIMEOUT + SYNC_SECONDS_PER_KEY * len(s3_keys)
+            for result in get_vm_client(self.vm_ip).batch(ops, timeout=timeout):
+                logger.info(f"VM sync of {len(s3_keys)} files: {result}")
+        except Exception as e:
+            logger.error(f"Failed to notify VM of file change: {e}")
+
+    def vm_ip_changed(self, old_ip, new_ip):
+        """The VM came back at a new address (resize or resume); sync there from now on"""
+        if old_ip and self.vm_ip == old_ip:
+            logger.info(f"VM moved from {old_ip} to {new_ip}, syncing there")
+            self.vm_ip = new_ip
 
     def start_notepad_auto_sync(self, vm_ip):
         if self.sync_running:
@@ -366,10 +539,10 @@ class ProcessManager:
                 # Direct match with tracked files
                 if file_path in self.manager.tracked_files:
                     is_tracked = True
-                
-                # Check if file basename matches a tracked file
-                for tracked in self.manager.tracked_files:
-                    if os.path.basename(file_path) == os.path.basename(tracked):
+                else:
+                    # Check if file basename matches a tracked file
+                    tracked = self.manager.tracked_files.by_basename(os.path.basename(file_path))
+                    if tracked:
                         is_tracked = True
                         file_path = tracked  # Use the tracked path for sync
                         
@@ -377,11 +550,16 @@ class ProcessManager:
                     # Debounce rapidly occurring events (files sometimes trigger multiple events)
                     current_time = time.time()
                     if file_path in self.last_modified and current_time - self.last_modified[file_path] < 2:
+                        WATCHER_EVENTS.inc(side="local", outcome="debounced")
                         return
                         
                     self.last_modified[file_path] = current_time
                     logger.info(f"Detected file save: {file_path}")
-                    self.manager.sync_specific_file(file_path)
+                    WATCHER_EVENTS.inc(side="local", outcome="synced")
+                    with background():
+                        self.manager.sync_specific_file(file_path)
+                else:
+                    WATCHER_EVENTS.inc(side="local", outcome="ignored")
 
         def run_watcher():
             event_handler = NotepadFileEventHandler(self)
@@ -427,6 +605,7 @@ class ProcessManager:
             logger.info(f"Synced file: {s3_key}")
         except Exception as e:
             logger.error(f"Error syncing file {file_path}: {e}")
+            self.file_store.record_error(file_path, e)
 
     def sync_notepad_files(self, vm_ip=None, upload=True, specific_file=None):
         """Sync all tracked files or a specific file"""
@@ -443,6 +622,7 @@ class ProcessManager:
         else:
             files_to_sync = self.tracked_files
 
+        uploaded_keys = []
         for file_path in files_to_sync:
             if not os.path.exists(file_path):
                 logger.warning(f"Tracked file not found: {file_path}")
@@ -450,7 +630,9 @@ class ProcessManager:
                 
             s3_key = os.path.basename(file_path)
             try:
-                if upload:
+                if upload and self.file_store.uploaded_signature(file_path) == file_signature(file_path):
+                    logger.info(f"{s3_key} unchanged since its last upload, skipping")
+                elif upload:
                     try:
                         # Check if file exists in S3 and is older
                         s3_head = self.s3.head_object(Bucket=self.BUCKET_NAME, Key=s3_key)
@@ -459,15 +641,21 @@ class ProcessManager:
                         
                         if local_mtime > s3_mtime:
                             logger.info(f"Local file {s3_key} is newer than S3 version, uploading...")
-                            self._upload_file_to_s3(file_path, s3_key)
+                            self._upload_file_to_s3(file_path, s3_key, notify=False)
+                            uploaded_keys.append(s3_key)
                         else:
                             logger.info(f"S3 version of {s3_key} is newer or same as local, skipping upload")
                     except botocore.exceptions.ClientError:
                         # File doesn't exist in S3, upload it
                         logger.info(f"File {s3_key} not found in S3, uploading...")
-                        self._upload_file_to_s3(file_path, s3_key)
+                        self._upload_file_to_s3(file_path, s3_key, notify=False)
+                        uploaded_keys.append(s3_key)
             except Exception as e:
                 logger.error(f"Sync error for {file_path}: {e}")
+                self.file_store.record_error(file_path, e)
+
+        # One request for the whole round instead of one per uploaded file
+        self._notify_vm_sync(uploaded_keys)
 
         logger.info(f"Sync completed at {time.strftime('%Y-%m-%d %H:%M:%S')}")
 
@@ -475,7 +663,7 @@ class ProcessManager:
         """Add a new file to tracked files list"""
         if os.path.exists(file_path):
             self.tracked_files.add(file_path)
-            self._update_tracked_file_list(self.tracked_files)
+            self._update_tracked_file_list([file_path])
             logger.info(f"Added {file_path} to tracked files")
             return True
         else:
@@ -486,7 +674,8 @@ class ProcessManager:
         """Remove a file from tracked files list"""
         if file_path in self.tracked_files:
             self.tracked_files.remove(file_path)
-            self._update_tracked_file_list(self.tracked_files)
+            self.file_store.remove(file_path)
+            self._stored_paths.discard(file_path)
             logger.info(f"Removed {file_path} from tracked files")
             return True
         else:
@@ -497,7 +686,7 @@ class ProcessManager:
         """Download a specific file from S3"""
         try:
             logger.info(f"Downloading {s3_key} to {local_path}")
-            self.s3.download_file(self.BUCKET_NAME, s3_key, local_path)
+            self.s3.download_file(self.BUCKET_NAME, s3_key, local_path, Config=transfer_config())
             logger.info(f"Downloaded {s3_key}")
             return True
         except Exception as e:
@@ -507,11 +696,14 @@ class ProcessManager:
     def get_all_s3_files(self):
         """List all files in the S3 bucket"""
         try:
-            response = self.s3.list_objects_v2(Bucket=self.BUCKET_NAME)
+            # One listing returns at most 1,000 keys
+            paginator = self.s3.get_paginator('list_objects_v2')
             files = []
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    files.append(obj['Key'])
+            for page in paginator.paginate(Bucket=self.BUCKET_NAME):
+                for obj in page.get('Contents', []):
+                    # Control objects and app state (VS Code, Chrome) are not Notepad++ files
+                    if not obj['Key'].startswith((CONTROL_PREFIX,) + APP_STATE_PREFIXES):
+                        files.append(obj['Key'])
             logger.info(f"Found {len(files)} files in S3 bucket {self.BUCKET_NAME}")
             return files
         except Exception as e:
@@ -577,16 +769,11 @@ class ProcessManager:
         """Restart Notepad++ with specified files or all tracked files"""
         try:
             # Kill any running Notepad++ instances
-            subprocess.call(["taskkill", "/IM", "notepad++.exe"], 
-                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            time.sleep(2)
+            self.platform.kill('notepad++.exe', force=False)
+            self.platform.wait_for_exit('notepad++.exe', timeout=PROCESS_EXIT_TIMEOUT)
             
             # Find Notepad++ executable
-            notepad_exe = r"C:\\Program Files\\Notepad++\\notepad++.exe"
-            if not os.path.exists(notepad_exe):
-                notepad_exe = r"C:\\Program Files (x86)\\Notepad++\\notepad++.exe"
-            if not os.path.exists(notepad_exe):
-                raise FileNotFoundError("Notepad++ executable not found.")
+            notepad_exe = self._notepad_exe()
                 
             files_to_open = []
             if files:
@@ -596,12 +783,12 @@ class ProcessManager:
                 
             if not files_to_open:
                 logger.warning("No files to open in Notepad++")
-                subprocess.Popen([notepad_exe])
+                self.platform.launch([notepad_exe])
                 return False
                 
             logger.info(f"Restarting Notepad++ with {len(files_to_open)} files...")
             command = [notepad_exe] + files_to_open
-            subprocess.Popen(command)
+            self.platform.launch(command)
             logger.info("Notepad++ restarted with tracked files")
             return True
             
@@ -619,7 +806,7 @@ class ProcessManager:
                 return False
                 
         try:
-            response = requests.get(f"http://{vm_ip}:5000/status", timeout=5)
+            response = get_vm_client(vm_ip).get("status", timeout=5)
             if response.status_code == 200:
                 logger.info(f"VM at {vm_ip} is responding")
                 return True
@@ -634,10 +821,7 @@ class ProcessManager:
         """Clean up temporary unsaved files"""
         if os.path.exists(self.unsaved_temp_dir):
             try:
-                for file in os.listdir(self.unsaved_temp_dir):
-                    file_path = os.path.join(self.unsaved_temp_dir, file)
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
+                self.backup_snapshotter.clear()
                 logger.info(f"Cleaned up temporary files in {self.unsaved_temp_dir}")
                 return True
             except Exception as e:
@@ -654,7 +838,8 @@ class ProcessManager:
             logger.info(f"Starting periodic sync every {interval_seconds} seconds...")
             while True:
                 try:
-                    self.sync_from_s3()
+                    with background():
+                        self.sync_from_s3()
                 except Exception as e:
                     logger.error(f"Periodic sync failed: {e}")
                 time.sleep(interval_seconds)
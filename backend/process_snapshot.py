@@ -0,0 +1,154 @@
+import os
+import time
+import threading
+import logging
+import psutil
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TARGET_APPS = ('notepad++.exe', 'chrome.exe', 'Code.exe')
+
+
+def target_apps_from_env(default=DEFAULT_TARGET_APPS):
+    """Target apps from CLOUD_RAM_TARGET_APPS (comma separated), else the default set"""
+    value = os.getenv("CLOUD_RAM_TARGET_APPS")
+    if not value:
+        return tuple(default)
+    return tuple(app.strip() for app in value.split(",") if app.strip())
+
+
+class ProcessSnapshot:
+    """One pass over the process table, indexed by PID and by lowercase name."""
+
+    def __init__(self, processes, taken_at):
+        self.taken_at = taken_at
+        self.by_pid = {info["pid"]: info for info in processes}
+        self.by_name = {}
+        for info in processes:
+            self.by_name.setdefault(info["name"].lower(), []).append(info)
+
+    def find(self, name):
+        return self.by_name.get(name.lower(), [])
+
+    def get(self, pid):
+        return self.by_pid.get(pid)
+
+    def age(self):
+        return time.monotonic() - self.taken_at
+
+
+class ProcessSnapshotService:
+    """
+    Serves process lookups from an in-memory snapshot instead of rescanning the
+    process table for every caller.
+
+    The snapshot is refreshed every `interval` seconds by a background thread
+    (start()) or on demand when a caller asks for data fresher than it has.
+    Each refresh reads name, create time and RSS in a single psutil oneshot per
+    process and diffs against the previous snapshot to emit "start" and "exit"
+    events to subscribers.
+
+    aliases maps an image name to other process names the same app runs under
+    (the native Linux binaries on a Linux VM); lookups by the image name find
+    those too, and target_tasks() reports them under the image name.
+    """
+
+    def __init__(self, target_apps=None, interval=1.0, aliases=None):
+        self.target_apps = tuple(target_apps) if target_apps else target_apps_from_env()
+        self.interval = interval
+        self.aliases = {name.lower(): tuple(names) for name, names in (aliases or {}).items()}
+        self._snapshot = ProcessSnapshot([], 0.0)
+        self._refresh_lock = threading.Lock()
+        self._listeners = []
+        self._thread = None
+        self._stop = threading.Event()
+
+    def subscribe(self, callback):
+        """callback(event, info) with event "start" or "exit"""
+        self._listeners.append(callback)
+
+    def refresh(self):
+        with self._refresh_lock:
+            processes = []
+            for proc in psutil.process_iter():
+                try:
+                    with proc.oneshot():
+                        processes.append({
+                            "pid": proc.pid,
+                            "name": proc.name(),
+                            "create_time": proc.create_time(),
+                            "rss": proc.memory_info().rss,
+                        })
+                except psutil.Error:
+                    continue
+            previous = self._snapshot
+            snapshot = ProcessSnapshot(processes, time.monotonic())
+            self._snapshot = snapshot
+            if previous.taken_at and self._listeners:
+                self._emit_changes(previous, snapshot)
+            return snapshot
+
+    def _emit_changes(self, previous, current):
+        # A PID can be reused, so identity is (pid, create_time)
+        before = {(p["pid"], p["create_time"]): p for p in previous.by_pid.values()}
+        after = {(p["pid"], p["create_time"]): p for p in current.by_pid.values()}
+        events = [("start", after[key]) for key in after.keys() - before.keys()]
+        events += [("exit", before[key]) for key in before.keys() - after.keys()]
+        for event, info in events:
+            for callback in self._listeners:
+                try:
+                    callback(event, info)
+                except Exception as e:
+                    logger.error(f"Process event listener failed: {e}")
+
+    def snapshot(self, max_age=None):
+        """The current snapshot, refreshed first if older than max_age (default: two refresh intervals)"""
+        max_age = 2 * self.interval if max_age is None else max_age
+        snapshot = self._snapshot
+        if snapshot.age() > max_age:
+            snapshot = self.refresh()
+        return snapshot
+
+    def _find(self, snapshot, name):
+        found = snapshot.find(name)
+        for alias in self.aliases.get(name.lower(), ()):
+            found = found + snapshot.find(alias)
+        return found
+
+    def find(self, name, max_age=None):
+        return self._find(self.snapshot(max_age), name)
+
+    def get(self, pid, max_age=None):
+        return self.snapshot(max_age).get(pid)
+
+    def is_running(self, name, max_age=None):
+        return bool(self.find(name, max_age))
+
+    def target_tasks(self, max_age=None):
+        """Running target apps as [{"pid", "name"}]"""
+        snapshot = self.snapshot(max_age)
+        return [
+            {"pid": info["pid"], "name": info["name"] if info["name"].lower() == name.lower() else name}
+            for name in self.target_apps
+            for info in self._find(snapshot, name)
+        ]
+
+    def start(self):
+        """Keep the snapshot fresh in the background"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.error(f"Process snapshot refresh failed: {e}")
+                self._stop.wait(self.interval)
+
+        self._thread = threading.Thread(target=run, daemon=True, name="process-snapshot")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
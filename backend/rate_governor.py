@@ -0,0 +1,224 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+import logging
+from contextlib import contextmanager
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from metrics import gauge, counter, instrument_boto_client
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first: a user waiting on an allocation or migration goes ahead of background sync
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+# Per API family: (steady requests/second, burst). EC2 meters describes and
+# mutations separately; S3 object calls are plentiful, listings much less so.
+FAMILY_LIMITS = {
+    "ec2_describe": (20, 50),
+    "ec2_mutate": (5, 10),
+    "s3_object": (100, 200),
+    "s3_list": (10, 20),
+    "other": (20, 40),
+}
+# Error codes AWS answers with when it throttles us
+THROTTLE_CODES = {
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottled", "RequestThrottledException",
+    "RequestLimitExceeded", "SlowDown", "TooManyRequestsException", "ProvisionedThroughputExceededException",
+    "RequestLimitExceededException", "BandwidthLimitExceeded",
+}
+# botocore's adaptive mode retries throttles with jittered backoff and rate limits on its own side too
+AWS_CONFIG = Config(retries={"mode": "adaptive", "total_max_attempts": int(os.getenv("CLOUD_RAM_AWS_MAX_ATTEMPTS", "8"))})
+
+_priority = contextvars.ContextVar("aws_call_priority", default=INTERACTIVE)
+# s3transfer's worker threads start from an empty context, so background transfers run on the caller's thread
+BACKGROUND_TRANSFER = TransferConfig(use_threads=False)
+
+
+@contextmanager
+def priority(level):
+    """AWS calls made in this block wait at level.
+
+    The level lives in a contextvar: work handed to an executor keeps it only
+    when run through contextvars.copy_context().run (tracing.wrap does this).
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def background():
+    return priority(BACKGROUND)
+
+
+def transfer_config():
+    """Config= for upload_file/download_file that keeps the transfer at the caller's priority"""
+    return BACKGROUND_TRANSFER if _priority.get() == BACKGROUND else None
+
+
+def api_family(service, operation):
+    if service == "ec2":
+        return "ec2_describe" if operation.startswith(("Describe", "Get")) else "ec2_mutate"
+    if service == "s3":
+        return "s3_list" if operation.startswith("List") else "s3_object"
+    return "other"
+
+
+class TokenBucket:
+    """
+    Token bucket whose waiters are served in priority order, then arrival
+    order. The rate adapts AIMD style: a throttle halves it (down to
+    min_rate), and it climbs back to the configured rate over recover_seconds.
+    """
+
+    def __init__(self, rate, burst, min_rate=0.5, recover_seconds=30, clock=time.monotonic):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate = min_rate
+        self.recover_seconds = recover_seconds
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated_at = clock()
+        self.granted = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self._waiters = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / self.recover_seconds * elapsed)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    def acquire(self, level=INTERACTIVE):
+        """Block until a token is ours; returns the seconds waited"""
+        started = self.clock()
+        with self._cond:
+            ticket = (level, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            while True:
+                self._refill()
+                if self._waiters[0] == ticket and self.tokens >= 1:
+                    heapq.heappop(self._waiters)
+                    self.tokens -= 1
+                    self.granted += 1
+                    waited = self.clock() - started
+                    self.wait_seconds += waited
+                    self._cond.notify_all()
+                    return waited
+                if self._waiters[0] == ticket:
+                    self._cond.wait((1 - self.tokens) / self.rate)
+                else:
+                    self._cond.wait()
+
+    def on_throttle(self):
+        with self._cond:
+            self._refill()
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            self._refill()
+            waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+            for level, _ in self._waiters:
+                waiting[PRIORITY_NAMES.get(level, str(level))] += 1
+            return {
+                "rate": round(self.rate, 2),
+                "max_rate": self.max_rate,
+                "tokens": round(self.tokens, 2),
+                "waiting": waiting,
+                "granted": self.granted,
+                "throttled": self.throttled,
+                "wait_seconds": round(self.wait_seconds, 3),
+            }
+
+
+class RateGovernor:
+    """
+    One token bucket per API family, shared by every boto3 client attached to
+    it. Each attempt of a call (retries included) takes a token before it is
+    sent, at the priority set with priority()/background(); a throttling
+    answer slows the family's bucket for every caller at once.
+    """
+
+    def __init__(self, limits=None):
+        self.buckets = {family: TokenBucket(rate, burst) for family, (rate, burst) in (limits or FAMILY_LIMITS).items()}
+
+    def bucket(self, service, operation):
+        return self.buckets.get(api_family(service, operation)) or self.buckets["other"]
+
+    def attach(self, client):
+        """Route client's calls through the governor; returns the client"""
+        service = client.meta.service_model.service_id.hyphenize()
+        events = client.meta.events
+
+        def before_send(event_name=None, **kwargs):
+            waited = self.bucket(service, event_name.rsplit(".", 1)[-1]).acquire(_priority.get())
+            if waited > 1:
+                logger.info(f"{event_name} waited {round(waited, 2)}s for its rate limit")
+            # Returning None lets botocore send the request
+
+        def needs_retry(event_name=None, response=None, **kwargs):
+            if response is None:
+                return None
+            http_response, parsed = response
+            code = parsed.get("Error", {}).get("Code") if isinstance(parsed, dict) else None
+            if code in THROTTLE_CODES or http_response.status_code == 429:
+                operation = event_name.rsplit(".", 1)[-1]
+                THROTTLES.inc(family=api_family(service, operation))
+                logger.warning(f"AWS throttled {service}.{operation} ({code}), slowing down {api_family(service, operation)}")
+                self.bucket(service, operation).on_throttle()
+            # The retry decision itself stays with botocore's retry handler
+            return None
+
+        events.register(f"before-send.{service}", before_send)
+        events.register(f"needs-retry.{service}", needs_retry)
+        return client
+
+    def snapshot(self):
+        """family -> bucket state, including queue depth by priority"""
+        return {family: bucket.snapshot() for family, bucket in self.buckets.items()}
+
+
+GOVERNOR = RateGovernor()
+
+THROTTLES = counter("cloud_ram_aws_throttles_total", "Throttling answers from AWS by API family", labels=("family",))
+gauge(
+    "cloud_ram_aws_queue_depth", "Callers waiting for an AWS rate limit token", labels=("family", "priority"),
+    fn=lambda: {
+        (family, level): n
+        for family, state in GOVERNOR.snapshot().items()
+        for level, n in state["waiting"].items()
+    },
+)
+gauge(
+    "cloud_ram_aws_rate_limit", "Current requests/second allowed per AWS API family", labels=("family",),
+    fn=lambda: {(family,): state["rate"] for family, state in GOVERNOR.snapshot().items()},
+)
+
+
+def governed_client(service, **kwargs):
+    """boto3 client with adaptive retries whose calls go through GOVERNOR and are counted in metrics"""
+    return instrument_boto_client(GOVERNOR.attach(boto3.client(service, config=AWS_CONFIG, **kwargs)))
+
+
+def governed_resource(service, **kwargs):
+    resource = boto3.resource(service, config=AWS_CONFIG, **kwargs)
+    instrument_boto_client(GOVERNOR.attach(resource.meta.client))
+    return resource
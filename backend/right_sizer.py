@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import logging
+import requests
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from vm_client import get_vm_client, evict_vm_client
+from rate_governor import background
+from instance_catalog import InstanceCatalog, NoMatchingInstanceType, hourly_price
+
+logger = logging.getLogger(__name__)
+
+# "off", "recommend" (log and expose only) or "apply" (resize VMs)
+MODE = os.getenv("CLOUD_RAM_RIGHT_SIZING", "recommend")
+SWEEP_INTERVAL = 300
+GIB = 1024 ** 3
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class RightSizingPolicy:
+    """
+    Turns a VM's memory history into a size recommendation.
+
+    The p95 of percent_used over `window` seconds is compared with a band:
+    at or above scale_up_percent (or while swap grows) the VM is too small, at or
+    below scale_down_percent it is too big. The new size holds the p95 working
+    set at target_percent, at most max_step times bigger or smaller than now,
+    within [min_gib, max_gib].
+
+    Guardrails block applying a recommendation: less than min_history seconds
+    of samples, a resize within `cooldown` (scale_up_cooldown when growing, so
+    a VM under pressure is not left swapping for hours), an app launch or file
+    sync in the last quiet_for seconds (a migration may be running), or a VNC
+    viewer connected (a resize restarts the VM under them).
+    """
+
+    def __init__(self, window=2 * 3600, min_history=30 * 60, target_percent=65, scale_up_percent=90,
+                 scale_down_percent=35, max_step=4, min_gib=1, max_gib=64, cooldown=6 * 3600,
+                 scale_up_cooldown=30 * 60, quiet_for=5 * 60):
+        self.window = window
+        self.min_history = min_history
+        self.target_percent = target_percent
+        self.scale_up_percent = scale_up_percent
+        self.scale_down_percent = scale_down_percent
+        self.max_step = max_step
+        self.min_gib = min_gib
+        self.max_gib = max_gib
+        self.cooldown = cooldown
+        self.scale_up_cooldown = scale_up_cooldown
+        self.quiet_for = quiet_for
+
+    def recommend(self, history, current_type, catalog, platform="windows", architecture="x86_64",
+                  activity=None, last_resized_ago=None):
+        """Returns {"action": "keep"|"resize", "current", "recommended", "reason", "blocked", ...}"""
+        samples = [s for s in history.get("samples", []) if s["seconds_ago"] <= self.window]
+        result = {"action": "keep", "current": current_type, "recommended": current_type, "blocked": None}
+        if len(samples) < 2 or samples[0]["seconds_ago"] - samples[-1]["seconds_ago"] < self.min_history:
+            result["reason"] = "not enough memory history yet"
+            return result
+
+        p95_percent = percentile([s["percent_used"] for s in samples], 95)
+        working_set = percentile([s["used_ram"] for s in samples], 95)
+        swap_growth = samples[-1]["swap_used"] - samples[0]["swap_used"]
+        current_gib = self._memory_gib(catalog, current_type) or history["total_ram"] / GIB
+        result.update({
+            "p95_percent": p95_percent,
+            "working_set_gib": round(working_set / GIB, 2),
+            "current_gib": current_gib,
+        })
+
+        too_small = p95_percent >= self.scale_up_percent or (swap_growth > 0 and p95_percent >= self.target_percent)
+        too_big = p95_percent <= self.scale_down_percent
+        if not too_small and not too_big:
+            result["reason"] = f"p95 memory use {p95_percent}% is within the target band"
+            return result
+
+        desired_gib = working_set / GIB * 100 / self.target_percent
+        desired_gib = min(max(desired_gib, current_gib / self.max_step), current_gib * self.max_step)
+        desired_gib = min(max(desired_gib, self.min_gib), self.max_gib)
+        try:
+            recommended = catalog.select(desired_gib, architecture=architecture, platform=platform)
+        except NoMatchingInstanceType as e:
+            result["reason"] = str(e)
+            return result
+        recommended_gib = self._memory_gib(catalog, recommended)
+        if recommended == current_type or (too_small and recommended_gib <= current_gib) or \
+                (too_big and recommended_gib >= current_gib):
+            result["reason"] = f"{current_type} is already the best fit for {round(desired_gib, 1)} GiB"
+            return result
+
+        result.update({
+            "action": "resize",
+            "recommended": recommended,
+            "recommended_gib": recommended_gib,
+            "reason": f"p95 memory use {p95_percent}% of {current_gib} GiB"
+                      f"{' with swap growing' if swap_growth > 0 else ''}; {recommended} fits the working set",
+        })
+        result["blocked"] = self._blocked(activity, last_resized_ago, too_small)
+        return result
+
+    def _blocked(self, activity, last_resized_ago, growing):
+        cooldown = self.scale_up_cooldown if growing else self.cooldown
+        if last_resized_ago is not None and last_resized_ago < cooldown:
+            return f"resized {round(last_resized_ago)}s ago (cooldown {cooldown}s)"
+        if activity:
+            if activity.get("vnc_connections"):
+                return "a VNC viewer is connected"
+            recent = [kind for kind in ("launch", "sync") if activity.get("seconds_since", {}).get(kind, self.quiet_for) < self.quiet_for]
+            if recent:
+                return f"recent {', '.join(recent)} activity"
+        return None
+
+    def _memory_gib(self, catalog, instance_type):
+        for entry in catalog.entries():
+            if entry["type"] == instance_type:
+                return entry["memory_mib"] / 1024
+        return None
+
+
+class RightSizer:
+    """
+    Periodically asks each running user VM for its memory history and, in
+    "apply" mode, resizes it when the policy says so and nothing blocks it:
+    the apps launched on the VM are noted, the instance is stopped, retyped and
+    started, and the apps are launched again from the files kept on its disk.
+    Recommendations are kept in self.recommendations (user_id -> dict).
+    """
+
+    def __init__(self, aws_manager, table, catalog=None, policy=None, mode=MODE, interval=SWEEP_INTERVAL,
+                 on_ip_change=None):
+        self.aws_manager = aws_manager
+        self.table = table
+        # Called with (old_ip, new_ip) after a resize, for whoever still talks to the VM by address
+        self.on_ip_change = on_ip_change
+        self.catalog = catalog or aws_manager.catalog
+        self.policy = policy or RightSizingPolicy()
+        self.mode = mode
+        self.interval = interval
+        self.recommendations = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep(self):
+        if self.mode == "off":
+            return []
+        applied = []
+        for item in self._running_mappings():
+            recommendation = self.evaluate(item)
+            if recommendation is None:
+                continue
+            self.recommendations[item["user_id"]] = recommendation
+            if recommendation["action"] != "resize":
+                continue
+            if recommendation["blocked"]:
+                logger.info(f"Resize of {item['vm_id']} to {recommendation['recommended']} held back: {recommendation['blocked']}")
+            elif self.mode == "apply":
+                if self.apply(item, recommendation):
+                    applied.append((item["vm_id"], recommendation["recommended"]))
+            else:
+                logger.info(f"Recommend resizing {item['vm_id']} to {recommendation['recommended']}: {recommendation['reason']}")
+        return applied
+
+    def evaluate(self, item):
+        """The policy's recommendation for one mapped VM, or None if its agent cannot be asked"""
+        ops = [
+            {"id": "history", "op": "memory_history", "args": {"since": self.policy.window}},
+            {"id": "activity", "op": "activity"},
+        ]
+        results = {}
+        try:
+            for result in get_vm_client(item["vm_ip"]).batch(ops, timeout=15):
+                if result.get("status") == "ok":
+                    results[result["id"]] = result["result"]
+        except (requests.RequestException, RuntimeError, ValueError) as e:
+            logger.warning(f"Could not read memory history of {item['vm_id']}: {e}")
+            return None
+        if "history" not in results:
+            return None
+        current_type = item.get("instance_type") or self._instance_type(item["vm_id"])
+        resized_at = item.get("resized_at")
+        return self.policy.recommend(
+            results["history"], current_type, self.catalog,
+            platform=item.get("platform", "windows"),
+            architecture=item.get("architecture", "x86_64"),
+            activity=results.get("activity"),
+            last_resized_ago=time.time() - int(resized_at) if resized_at else None,
+        )
+
+    def apply(self, item, recommendation):
+        vm_id, user_id = item["vm_id"], item["user_id"]
+        client = get_vm_client(item["vm_ip"])
+        try:
+            tasks = next(r for r in client.batch([{"id": "tasks", "op": "launched_tasks"}]) if r.get("id") == "tasks")
+            tasks = tasks["result"]["tasks"] if tasks["status"] == "ok" else []
+        except (requests.RequestException, RuntimeError, ValueError, StopIteration) as e:
+            logger.warning(f"Not resizing {vm_id}: could not list its apps ({e})")
+            return False
+
+        self._update(user_id, vm_id, "SET #state = :resizing, resizing_since = :now",
+                     {":resizing": "resizing", ":now": int(time.time())})
+        new_id, ip_address, resized = self.aws_manager.resize_vm(
+            vm_id, recommendation["recommended"], item.get("platform", "windows")
+        )
+        if new_id is None:
+            logger.error(f"VM {vm_id} did not come back after the resize attempt")
+            self._update(user_id, vm_id, "SET #state = :stopped, stopped_at = :now",
+                         {":stopped": "stopped", ":now": int(time.time())})
+            return False
+        instance_type = recommendation["recommended"] if resized else recommendation["current"]
+        self._update(
+            user_id, vm_id,
+            "SET #state = :running, vm_ip = :ip, instance_type = :type, resized_at = :now REMOVE resizing_since",
+            {":running": "running", ":ip": ip_address, ":type": instance_type, ":now": int(time.time())}
+        )
+        if ip_address != item["vm_ip"]:
+            evict_vm_client(item["vm_ip"])
+            if self.on_ip_change:
+                self.on_ip_change(item["vm_ip"], ip_address)
+        self._relaunch(ip_address, tasks)
+        logger.info(f"VM {vm_id} of {user_id} is now {instance_type} at {ip_address}, {len(tasks)} apps relaunched")
+        return resized
+
+    def _relaunch(self, ip_address, tasks):
+        """Start the apps again from what is on the VM's disk; files are named by their S3 keys"""
+        ops = [
+            {
+                "id": f"{task['task']}-{task['pid']}",
+                "op": "run_task",
+                "args": {
+                    "task": task["task"],
+                    "files": [os.path.basename(path) for path in task["files"]],
+                    "restore": task["restore"],
+                },
+            }
+            for task in tasks
+        ]
+        if not ops:
+            return
+        try:
+            for result in get_vm_client(ip_address).batch(ops, timeout=120):
+                if result.get("status") not in (None, "ok"):
+                    logger.warning(f"Relaunch after resize failed: {result}")
+        except (requests.RequestException, RuntimeError, ValueError) as e:
+            logger.error(f"Could not relaunch apps after resize: {e}")
+
+    def _running_mappings(self):
+        items = []
+        scan_kwargs = {}
+        while True:
+            page = self.table.scan(**scan_kwargs)
+            items.extend(item for item in page.get("Items", []) if item.get("state", "running") == "running")
+            if "LastEvaluatedKey" not in page:
+                return items
+            scan_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    def _instance_type(self, vm_id):
+        try:
+            reservations = self.aws_manager.ec2.describe_instances(InstanceIds=[vm_id])["Reservations"]
+            return reservations[0]["Instances"][0]["InstanceType"]
+        except (ClientError, IndexError, KeyError) as e:
+            logger.warning(f"Could not read the type of {vm_id}: {e}")
+            return None
+
+    def _update(self, user_id, vm_id, expression, values):
+        try:
+            self.table.update_item(
+                Key={"user_id": user_id},
+                UpdateExpression=expression,
+                ConditionExpression=Attr("vm_id").eq(vm_id),
+                ExpressionAttributeNames={"#state": "state"},
+                ExpressionAttributeValues=values,
+            )
+        except ClientError as e:
+            logger.error(f"Could not update mapping of {user_id}: {e}")
+
+    def start(self):
+        if self.mode == "off" or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    with background():
+                        self.sweep()
+                except Exception as e:
+                    logger.error(f"Right-sizing sweep failed: {e}")
+                self._stop.wait(self.interval)
+
+        self._thread = threading.Thread(target=run, daemon=True, name="right-sizer")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def simulate(history, instance_type, catalog, policy=None, platform="windows", architecture="x86_64", step=300):
+    """
+    Replay recorded memory history (an agent /memory_history response) through
+    the policy as if the controller were in "apply" mode, evaluating every
+    `step` seconds. Used bytes are taken as the workload, so after a simulated
+    resize percent_used is recomputed for the new size; what no longer fits in
+    a smaller size is counted as swap, as the VM would page it out. Viewer and migration
+    guardrails are not simulated; the cooldown is.
+
+    Returns {"decisions": [...], "hours": {type: h}, "cost": $, "static_cost": $}
+    """
+    policy = policy or RightSizingPolicy()
+    samples = sorted(history["samples"], key=lambda s: -s["seconds_ago"])
+    if not samples:
+        return {"decisions": [], "hours": {}, "cost": 0.0, "static_cost": 0.0}
+    start = samples[0]["seconds_ago"]
+    timeline = [dict(s, t=start - s["seconds_ago"]) for s in samples]
+    end = timeline[-1]["t"]
+    memory = {entry["type"]: entry["memory_mib"] * 1024 ** 2 for entry in catalog.entries()}
+    prices = {entry["type"]: hourly_price(entry, platform) for entry in catalog.entries()}
+
+    decisions, hours = [], {}
+    current, since, last_resized = instance_type, 0, None
+    total_bytes = memory.get(instance_type, history["total_ram"])
+    for now in range(step, end + step, step):
+        window = [s for s in timeline if now - policy.window < s["t"] <= now]
+        replay = {"total_ram": total_bytes, "samples": [
+            {"seconds_ago": now - s["t"], "percent_used": round(min(s["used_ram"], total_bytes) * 100 / total_bytes, 1),
+             "used_ram": min(s["used_ram"], total_bytes),
+             "swap_used": s["swap_used"] + max(0, s["used_ram"] - total_bytes)}
+            for s in window
+        ]}
+        recommendation = policy.recommend(
+            replay, current, catalog, platform, architecture,
+            last_resized_ago=now - last_resized if last_resized is not None else None,
+        )
+        if recommendation["action"] == "resize" and not recommendation["blocked"]:
+            hours[current] = hours.get(current, 0) + (now - since) / 3600
+            decisions.append(dict(recommendation, at=now))
+            current, since, last_resized = recommendation["recommended"], now, now
+            total_bytes = memory[current]
+    hours[current] = hours.get(current, 0) + (end - since) / 3600
+    cost = sum((prices.get(t) or 0) * h for t, h in hours.items())
+    static_cost = (prices.get(instance_type) or 0) * end / 3600
+    return {
+        "decisions": decisions,
+        "hours": {t: round(h, 2) for t, h in hours.items()},
+        "cost": round(cost, 4),
+        "static_cost": round(static_cost, 4),
+    }
+
+
+if __name__ == "__main__":
+    # Record with: curl http://<vm>:5000/memory_history > history.json
+    parser = argparse.ArgumentParser(description="Replay recorded VM memory history through the right-sizing policy")
+    parser.add_argument("history", help="JSON file saved from the agent's /memory_history")
+    parser.add_argument("--type", required=True, help="instance type the history was recorded on")
+    parser.add_argument("--platform", default="windows", choices=("windows", "linux"))
+    parser.add_argument("--arch", default="x86_64")
+    parser.add_argument("--step", type=int, default=300, help="seconds between controller evaluations")
+    args = parser.parse_args()
+    with open(args.history) as f:
+        recorded = json.load(f)
+    report = simulate(recorded, args.type, InstanceCatalog(), platform=args.platform,
+                      architecture=args.arch, step=args.step)
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,63 @@
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs fn, the
+    others wait for it and get the same result (or exception). With max_age > 0
+    a finished result is also handed to callers arriving within that many
+    seconds, which absorbs pollers whose ticks land close together.
+    """
+
+    def __init__(self, max_age=0):
+        self.max_age = max_age
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            fresh = call is not None and (
+                call.finished_at is None or time.monotonic() - call.finished_at < self.max_age
+            )
+            leader = not fresh
+            if leader:
+                self._prune()
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    call.finished_at = time.monotonic()
+                    # Failures are never reused, and without max_age nothing is
+                    if (call.error or not self.max_age) and self._calls.get(key) is call:
+                        del self._calls[key]
+                call.done.set()
+
+        if call.error:
+            raise call.error
+        return call.result
+
+    def _prune(self):
+        now = time.monotonic()
+        for key, call in list(self._calls.items()):
+            if call.finished_at is not None and now - call.finished_at >= self.max_age:
+                del self._calls[key]
@@ -0,0 +1,71 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migration_pipeline import FileStreamer, file_signature  # noqa: E402
+from tracked_file_store import TrackedFileStore  # noqa: E402
+
+
+class RecordingS3:
+    def __init__(self):
+        self.uploads = []
+
+    def upload_file(self, file_path, bucket_name, s3_key):
+        self.uploads.append(s3_key)
+
+
+class PreviousUploadsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.s3 = RecordingS3()
+        self.streamer = FileStreamer(self.s3, "bucket", max_workers=1)
+        self.addCleanup(self.streamer.shutdown)
+
+    def write(self, name, text):
+        file_path = os.path.join(self.dir, name)
+        with open(file_path, "w") as f:
+            f.write(text)
+        return file_path
+
+    def test_unchanged_files_are_listed_but_not_uploaded(self):
+        kept = self.write("kept.py", "a")
+        edited = self.write("edited.py", "b")
+        self.streamer.remember({
+            kept: ("vscode/ws/kept.py", file_signature(kept)),
+            edited: ("vscode/ws/edited.py", (0, 0)),
+        })
+
+        self.assertEqual(self.streamer.submit(kept, "vscode/ws/kept.py"), "vscode/ws/kept.py")
+        self.streamer.submit(edited, "vscode/ws/edited.py")
+        self.streamer.wait()
+
+        self.assertEqual(self.s3.uploads, ["vscode/ws/edited.py"])
+        self.assertIn("vscode/ws/kept.py", self.streamer.available_keys())
+
+    def test_an_edit_before_the_cutover_is_still_resent(self):
+        kept = self.write("kept.py", "a")
+        self.streamer.remember({kept: ("vscode/ws/kept.py", file_signature(kept))})
+        self.streamer.submit(kept, "vscode/ws/kept.py")
+
+        self.write("kept.py", "changed")
+
+        self.assertEqual(self.streamer.flush_dirty(), ["vscode/ws/kept.py"])
+        self.assertEqual(self.s3.uploads, ["vscode/ws/kept.py"])
+
+    def test_the_store_keeps_app_state_uploads(self):
+        store = TrackedFileStore(os.path.join(self.dir, "tracked.db"))
+        self.addCleanup(store.close)
+
+        store.record_app_state_upload("C:/ws/a.py", "vscode/ws/a.py", (3, 42))
+
+        self.assertEqual(store.app_state_uploads(), {"C:/ws/a.py": ("vscode/ws/a.py", (3, 42))})
+        self.assertEqual(store.paths(), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
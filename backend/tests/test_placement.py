@@ -0,0 +1,157 @@
+import os
+import sys
+import copy
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from placement import PlacementScheduler, UserFleet, NoCapacity, GIB  # noqa: E402
+
+
+class FakeTable:
+    """The CloudRAMUserVMs item of one user, with the two pool updates UserFleet makes"""
+
+    def __init__(self, item):
+        self.item = item
+
+    def get_item(self, Key):
+        return {"Item": copy.deepcopy(self.item)} if self.item else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        if "list_append" in UpdateExpression:
+            self.item["pool"] = self.item.get("pool", []) + ExpressionAttributeValues[":member"]
+        else:
+            self.item["pool"] = ExpressionAttributeValues[":remaining"]
+
+
+class StubAWSManager:
+    """create_vm hands out the given (vm_id, ip) pairs in order"""
+
+    def __init__(self, launches=()):
+        self.launches = list(launches)
+        self.created = []
+        self.terminated = []
+
+    def create_vm(self, ram_size, **kwargs):
+        self.created.append((ram_size, kwargs))
+        return self.launches.pop(0)
+
+    def terminate_vm(self, vm_id):
+        self.terminated.append(vm_id)
+
+
+class StubAgent:
+    def __init__(self, total_gib, available_gib, tasks=()):
+        self.ram = {"total_ram": int(total_gib * GIB), "available_ram": int(available_gib * GIB)}
+        self.tasks = list(tasks)
+        self.posts = []
+
+    def batch(self, ops, timeout=None):
+        yield {"id": "ram", "status": "ok", "result": self.ram}
+        yield {"id": "tasks", "status": "ok", "result": {"tasks": self.tasks}}
+        yield {"done": True}
+
+    def get_json(self, endpoint, **kwargs):
+        return self.ram
+
+    def post(self, endpoint, payload=None, **kwargs):
+        self.posts.append((endpoint, payload))
+        return SimpleNamespace(status_code=200, text="")
+
+
+class UserFleetTest(unittest.TestCase):
+    def setUp(self):
+        self.table = FakeTable({"user_id": "user-1", "vm_id": "i-primary", "vm_ip": "10.0.0.1"})
+        self.agents = {"10.0.0.1": StubAgent(8, 1)}
+        patcher = mock.patch("placement.get_vm_client", side_effect=lambda vm_ip: self.agents[vm_ip])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fleet(self, aws_manager):
+        return UserFleet(aws_manager, self.table, "user-1")
+
+    def test_add_vm_launches_a_new_pool_vm(self):
+        aws_manager = StubAWSManager([("i-pool1", "10.0.0.2")])
+        self.agents["10.0.0.2"] = StubAgent(8, 7)
+
+        vm = self.fleet(aws_manager).add_vm(8)
+
+        _, kwargs = aws_manager.created[0]
+        self.assertFalse(kwargs["reuse_existing"])
+        self.assertTrue(kwargs["pool"])
+        self.assertEqual(vm["vm_id"], "i-pool1")
+        self.assertFalse(vm["primary"])
+        self.assertEqual([member["vm_id"] for member in self.table.item["pool"]], ["i-pool1"])
+
+    def test_add_vm_never_pools_the_primary(self):
+        aws_manager = StubAWSManager([("i-primary", "10.0.0.1")])
+
+        with self.assertRaises(NoCapacity):
+            self.fleet(aws_manager).add_vm(8)
+
+        self.assertNotIn("pool", self.table.item)
+        self.assertEqual(aws_manager.terminated, [])
+
+    def test_place_adds_a_pool_vm_when_the_primary_is_full(self):
+        aws_manager = StubAWSManager([("i-pool1", "10.0.0.2")])
+        self.agents["10.0.0.2"] = StubAgent(8, 7)
+
+        placements = PlacementScheduler(self.fleet(aws_manager), vm_gib=8).place([{"task": "Code.exe", "rss": 2 * GIB}])
+
+        self.assertEqual(placements["Code.exe"]["vm_id"], "i-pool1")
+        self.assertEqual(len(aws_manager.created), 1)
+
+    def test_consolidate_moves_every_instance_of_an_app(self):
+        self.agents["10.0.0.1"] = StubAgent(16, 14)
+        self.agents["10.0.0.2"] = StubAgent(16, 14, tasks=[
+            {"pid": 101, "task": "notepad++.exe", "rss": GIB // 2, "files": []},
+            {"pid": 102, "task": "notepad++.exe", "rss": GIB // 2, "files": []},
+        ])
+        self.table.item["pool"] = [{"vm_id": "i-pool1", "vm_ip": "10.0.0.2"}]
+        aws_manager = StubAWSManager()
+
+        released = PlacementScheduler(self.fleet(aws_manager)).consolidate()
+
+        self.assertEqual(released, ["i-pool1"])
+        self.assertEqual(aws_manager.terminated, ["i-pool1"])
+        self.assertEqual(self.table.item["pool"], [])
+        terminated_pids = [payload["pid"] for endpoint, payload in self.agents["10.0.0.2"].posts
+                           if endpoint == "terminate_task"]
+        self.assertEqual(sorted(terminated_pids), [101, 102])
+
+    def test_consolidate_keeps_a_vm_running_a_stateful_app(self):
+        self.agents["10.0.0.1"] = StubAgent(16, 14)
+        self.agents["10.0.0.2"] = StubAgent(16, 14, tasks=[
+            {"pid": 101, "task": "notepad++.exe", "rss": GIB // 2, "files": []},
+            {"pid": 102, "task": "Code.exe", "rss": GIB // 2, "files": []},
+        ])
+        self.table.item["pool"] = [{"vm_id": "i-pool1", "vm_ip": "10.0.0.2"}]
+        aws_manager = StubAWSManager()
+
+        released = PlacementScheduler(self.fleet(aws_manager)).consolidate()
+
+        self.assertEqual(released, [])
+        self.assertEqual(aws_manager.terminated, [])
+        # Nothing is moved off, not even the apps that could be
+        self.assertEqual(self.agents["10.0.0.1"].posts, [])
+        self.assertEqual(self.agents["10.0.0.2"].posts, [])
+
+
+class PlanTest(unittest.TestCase):
+    def test_instances_of_one_app_are_planned_separately(self):
+        scheduler = PlacementScheduler(fleet=None, headroom_percent=0, rss_growth=1)
+        vms = [
+            {"vm_id": "a", "total": 4 * GIB, "available": 2 * GIB},
+            {"vm_id": "b", "total": 4 * GIB, "available": 2 * GIB},
+        ]
+        tasks = [{"task": "Code.exe", "pid": 1, "rss": 2 * GIB}, {"task": "Code.exe", "pid": 2, "rss": 2 * GIB}]
+
+        placements, _ = scheduler.plan(tasks, vms)
+
+        self.assertEqual(sorted(placements.values()), ["a", "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
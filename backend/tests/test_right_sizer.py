@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from right_sizer import RightSizer  # noqa: E402
+
+
+class FakeTable:
+    def __init__(self, item):
+        self.item = item
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        if ":ip" in ExpressionAttributeValues:
+            self.item["vm_ip"] = ExpressionAttributeValues[":ip"]
+
+
+class StubAWSManager:
+    catalog = None
+
+    def __init__(self, new_ip):
+        self.new_ip = new_ip
+
+    def resize_vm(self, vm_id, instance_type, platform="windows"):
+        return vm_id, self.new_ip, True
+
+
+class StubAgent:
+    def batch(self, ops, timeout=None):
+        yield {"id": "tasks", "status": "ok", "result": {"tasks": []}}
+        yield {"done": True}
+
+
+class ApplyTest(unittest.TestCase):
+    def setUp(self):
+        self.item = {"user_id": "user-1", "vm_id": "i-1", "vm_ip": "10.0.0.1", "platform": "linux"}
+        patcher = mock.patch("right_sizer.get_vm_client", return_value=StubAgent())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        evict = mock.patch("right_sizer.evict_vm_client")
+        self.evict = evict.start()
+        self.addCleanup(evict.stop)
+
+    def test_a_resize_hands_on_the_new_ip(self):
+        moves = []
+        sizer = RightSizer(StubAWSManager("10.0.0.2"), FakeTable(self.item), catalog=object(), mode="apply",
+                           on_ip_change=lambda old, new: moves.append((old, new)))
+
+        resized = sizer.apply(dict(self.item), {"recommended": "t3.large", "current": "t3.medium"})
+
+        self.assertTrue(resized)
+        self.assertEqual(self.item["vm_ip"], "10.0.0.2")
+        self.assertEqual(moves, [("10.0.0.1", "10.0.0.2")])
+        self.evict.assert_called_once_with("10.0.0.1")
+
+    def test_the_same_ip_is_not_reported(self):
+        moves = []
+        sizer = RightSizer(StubAWSManager("10.0.0.1"), FakeTable(self.item), catalog=object(), mode="apply",
+                           on_ip_change=lambda old, new: moves.append((old, new)))
+
+        sizer.apply(dict(self.item), {"recommended": "t3.large", "current": "t3.medium"})
+
+        self.assertEqual(moves, [])
+        self.evict.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process_manager import TrackedPaths  # noqa: E402
+
+
+class TrackedPathsTest(unittest.TestCase):
+    def test_lookup_by_basename(self):
+        paths = TrackedPaths(["/notes/a.txt", "/work/b.txt"])
+
+        self.assertEqual(paths.by_basename("b.txt"), "/work/b.txt")
+        self.assertIsNone(paths.by_basename("c.txt"))
+
+    def test_the_index_follows_changes(self):
+        paths = TrackedPaths(["/notes/a.txt"])
+        paths.by_basename("a.txt")
+
+        paths.add("/notes/c.txt")
+        paths.discard("/notes/a.txt")
+        paths |= {"/other/d.txt"}
+
+        self.assertEqual(paths.by_basename("c.txt"), "/notes/c.txt")
+        self.assertEqual(paths.by_basename("d.txt"), "/other/d.txt")
+        self.assertIsNone(paths.by_basename("a.txt"))
+        self.assertIsInstance(paths, TrackedPaths)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vm_client  # noqa: E402
+from vm_client import VMClient, CircuitBreaker, VMUnavailable, get_vm_client, evict_vm_client  # noqa: E402
+
+
+class HalfOpenTrialTest(unittest.TestCase):
+    def client(self, error):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        client = VMClient("10.0.0.9", retries=0, breaker=breaker, traced=False)
+        client.session.request = mock.Mock(side_effect=error)
+        return client, breaker
+
+    def test_a_broken_answer_ends_the_trial(self):
+        client, breaker = self.client(requests.exceptions.ChunkedEncodingError("truncated"))
+        breaker.record_failure()  # open; with reset_timeout=0 the next call is the trial
+
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            client.get("ram_usage")
+
+        # The trial counted as a failure, so another trial is allowed instead of the circuit staying shut
+        self.assertFalse(breaker._trial_running)
+        self.assertTrue(breaker.allow())
+
+    def test_an_open_circuit_fails_fast(self):
+        client, breaker = self.client(requests.exceptions.ConnectionError("refused"))
+        breaker.reset_timeout = 60
+        breaker.record_failure()
+
+        with self.assertRaises(VMUnavailable):
+            client.get("ram_usage")
+        client.session.request.assert_not_called()
+
+
+class EvictTest(unittest.TestCase):
+    def test_evict_drops_the_client_for_an_old_address(self):
+        client = get_vm_client("10.0.0.10")
+
+        evict_vm_client("10.0.0.10")
+
+        self.assertNotIn(("10.0.0.10", vm_client.AGENT_PORT), vm_client._clients)
+        self.assertIsNot(get_vm_client("10.0.0.10"), client)
+        evict_vm_client("10.0.0.10")
+
+    def test_evict_ignores_unknown_and_missing_addresses(self):
+        evict_vm_client(None)
+        evict_vm_client("10.0.0.11")
+
+
+if __name__ == "__main__":
+    unittest.main()
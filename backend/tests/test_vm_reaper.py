@@ -0,0 +1,93 @@
+import os
+import sys
+import unittest
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vm_reaper import VMReaper, IdlePolicy  # noqa: E402
+
+NOW = 1_000_000
+
+
+class FakeTable:
+    def __init__(self, items):
+        self.items = {item["user_id"]: item for item in items}
+
+    def scan(self, **kwargs):
+        return {"Items": list(self.items.values())}
+
+    def delete_item(self, Key, **kwargs):
+        self.items.pop(Key["user_id"], None)
+
+    def update_item(self, **kwargs):
+        pass
+
+
+class StubAWSManager:
+    """Lists only tagged instances; adopt_vm finds the untagged ones in `untagged`"""
+
+    def __init__(self, tagged=(), untagged=(), lookup_error=None):
+        self.tagged = list(tagged)
+        self.untagged = {vm["vm_id"]: vm for vm in untagged}
+        self.lookup_error = lookup_error
+        self.adopted = []
+        self.terminated = []
+
+    def list_managed_vms(self):
+        return self.tagged
+
+    def adopt_vm(self, vm_id, user_id):
+        if self.lookup_error:
+            raise self.lookup_error
+        vm = self.untagged.pop(vm_id, None)
+        if vm is not None:
+            self.adopted.append((vm_id, user_id))
+            self.tagged.append(vm)
+        return vm
+
+    def terminate_vm(self, vm_id):
+        self.terminated.append(vm_id)
+
+
+def stopped_vm(vm_id):
+    return {"vm_id": vm_id, "state": "stopped", "ip": None, "user_id": None, "launched_at": NOW - 3600}
+
+
+class UntaggedMappingTest(unittest.TestCase):
+    def setUp(self):
+        self.item = {"user_id": "user-1", "vm_id": "i-old", "vm_ip": "10.0.0.1", "state": "stopped",
+                     "stopped_at": NOW - 60}
+        self.table = FakeTable([self.item])
+
+    def reaper(self, aws_manager):
+        return VMReaper(aws_manager, self.table, policy=IdlePolicy(stopped_retention=3600), clock=lambda: NOW)
+
+    def test_an_untagged_vm_is_adopted_not_dropped(self):
+        aws_manager = StubAWSManager(untagged=[stopped_vm("i-old")])
+
+        actions = self.reaper(aws_manager).sweep()
+
+        self.assertEqual(actions, [("adopt", "i-old")])
+        self.assertEqual(aws_manager.adopted, [("i-old", "user-1")])
+        self.assertIn("user-1", self.table.items)
+        self.assertEqual(aws_manager.terminated, [])
+
+    def test_a_vm_ec2_does_not_know_drops_the_mapping(self):
+        actions = self.reaper(StubAWSManager()).sweep()
+
+        self.assertEqual(actions, [("drop_mapping", "i-old")])
+        self.assertNotIn("user-1", self.table.items)
+
+    def test_a_failed_lookup_keeps_the_mapping(self):
+        error = ClientError({"Error": {"Code": "RequestLimitExceeded", "Message": "slow down"}}, "DescribeInstances")
+
+        actions = self.reaper(StubAWSManager(lookup_error=error)).sweep()
+
+        self.assertEqual(actions, [])
+        self.assertIn("user-1", self.table.items)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+import os
+import re
+import time
+import secrets
+import threading
+import contextvars
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# W3C Trace Context: the backend and the VM agent put their spans in the same trace
+HEADER = "traceparent"
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+# Traces kept in memory, oldest dropped first
+MAX_TRACES = int(os.getenv("CLOUD_RAM_MAX_TRACES", "200"))
+MAX_SPANS_PER_TRACE = 2000
+SERVICE = os.getenv("CLOUD_RAM_TRACE_SERVICE", "backend")
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+class RemoteParent:
+    """The caller's span, known only by its ids (from a traceparent header)"""
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+class Span:
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start = time.time()
+        self.duration = None
+        self._started = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error):
+        self.status = "error"
+        self.attributes["error"] = str(error)
+
+    def end(self, error=None):
+        if self.duration is not None:
+            return
+        if error is not None:
+            self.fail(error)
+        self.duration = time.perf_counter() - self._started
+        STORE.add(self)
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "service": SERVICE,
+            "start": round(self.start, 6),
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class TraceStore:
+    """Finished spans by trace, for the last MAX_TRACES traces"""
+
+    def __init__(self, max_traces=MAX_TRACES):
+        self.max_traces = max_traces
+        self._traces = OrderedDict()  # trace_id -> [span dict]
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        record = span.to_dict()
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if spans is None:
+                spans = self._traces[span.trace_id] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            if len(spans) < MAX_SPANS_PER_TRACE:
+                spans.append(record)
+
+    def get(self, trace_id):
+        with self._lock:
+            return list(self._traces.get(trace_id, []))
+
+    def recent(self, limit=50):
+        """Newest first: one summary per trace, from its root span when that has finished"""
+        with self._lock:
+            traces = list(self._traces.items())[-limit:]
+        summaries = []
+        for trace_id, spans in reversed(traces):
+            root = next((s for s in spans if s["parent_id"] is None), None)
+            start = min(s["start"] for s in spans)
+            summaries.append({
+                "trace_id": trace_id,
+                "name": root["name"] if root else None,
+                "start": start,
+                "duration": root["duration"] if root else None,
+                "status": "error" if any(s["status"] == "error" for s in spans) else "ok",
+                "spans": len(spans),
+            })
+        return summaries
+
+
+STORE = TraceStore()
+
+
+def current():
+    return _current.get()
+
+
+def start_span(name, parent=None, **attributes):
+    """A span that is not made current; call .end() on it"""
+    return Span(name, parent if parent is not None else _current.get(), attributes)
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """
+    Time the block as a child of the current span (or of parent), starting a
+    new trace when there is neither. The span is current inside the block and
+    is marked as failed if the block raises.
+    """
+    s = start_span(name, parent, **attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.fail(e)
+        raise
+    finally:
+        _current.reset(token)
+        s.end()
+
+
+@contextmanager
+def child_span(name, parent=None, **attributes):
+    """span() when a trace is in progress (or parent is given); otherwise nothing is recorded and None is yielded"""
+    if parent is None and _current.get() is None:
+        yield None
+        return
+    with span(name, parent, **attributes) as s:
+        yield s
+
+
+def attach(span):
+    """Make span current until detach(token), for code that cannot use a with block"""
+    return _current.set(span)
+
+
+def detach(token):
+    _current.reset(token)
+
+
+def wrap(fn):
+    """fn bound to the caller's trace context, for handing to threads or executors (calls may overlap)"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def inject(headers=None):
+    """headers with the current span's traceparent added (unchanged outside a trace)"""
+    headers = dict(headers or {})
+    s = _current.get()
+    if s is not None:
+        headers[HEADER] = s.traceparent()
+    return headers
+
+
+def extract(value):
+    """RemoteParent from a traceparent header value, or None"""
+    match = _TRACEPARENT.match((value or "").strip().lower())
+    if not match or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return RemoteParent(match.group(1), match.group(2))
+
+
+def waterfall(trace_id, spans):
+    """
+    Spans of one trace ordered by start, each with its offset from the start of
+    the trace and its depth in the span tree. Spans from other machines are
+    placed by their wall clock, so they are only as aligned as the clocks are.
+    """
+    if not spans:
+        return {"trace_id": trace_id, "spans": []}
+    spans = sorted(spans, key=lambda s: s["start"])
+    by_id = {s["span_id"]: s for s in spans}
+    origin = spans[0]["start"]
+    end = max(s["start"] + (s["duration"] or 0) for s in spans)
+
+    def depth(s):
+        level, seen = 0, set()
+        while s["parent_id"] in by_id and s["span_id"] not in seen:
+            seen.add(s["span_id"])
+            s = by_id[s["parent_id"]]
+            level += 1
+        return level
+
+    root = next((s for s in spans if s["parent_id"] is None), spans[0])
+    return {
+        "trace_id": trace_id,
+        "name": root["name"],
+        "start": origin,
+        "duration": round(end - origin, 6),
+        "spans": [
+            dict(s, offset=round(s["start"] - origin, 6), depth=depth(s))
+            for s in spans
+        ],
+    }
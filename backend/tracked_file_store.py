@@ -0,0 +1,148 @@
+import os
+import time
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracked_files (
+    path TEXT PRIMARY KEY,
+    added_at REAL NOT NULL,
+    uploaded_size INTEGER,
+    uploaded_mtime_ns INTEGER,
+    last_uploaded_hash TEXT,
+    remote_version TEXT,
+    last_synced_at REAL,
+    last_error TEXT
+)
+"""
+
+APP_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS app_state_files (
+    path TEXT PRIMARY KEY,
+    s3_key TEXT NOT NULL,
+    uploaded_size INTEGER NOT NULL,
+    uploaded_mtime_ns INTEGER NOT NULL
+)
+"""
+
+
+class TrackedFileStore:
+    """
+    SQLite-backed record of tracked files and their per-file sync state.
+
+    Every add, remove or sync result is a single-row write, so nothing is
+    rewritten as the set grows, and startup is one SELECT. The database runs in
+    WAL mode so the watcher, periodic sync and request threads can share it.
+    On first use, paths from the legacy flat record file are imported.
+
+    Sync state per file:
+      uploaded_size / uploaded_mtime_ns - local signature of the last upload,
+                                          lets syncs skip unchanged files cheaply
+      last_uploaded_hash                - MD5 of the uploaded content, when known
+      remote_version                    - ETag of the S3 object, when known
+      last_error                        - last sync failure, cleared on success
+
+    App state migrated by the other adapters (VS Code workspaces, the Chrome
+    profile) is not tracked, but the signature of its last upload is kept in
+    app_state_files so later migrations only resend what changed.
+    """
+
+    def __init__(self, db_path, legacy_record_path=None):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(SCHEMA)
+        self._conn.execute(APP_STATE_SCHEMA)
+        if legacy_record_path:
+            self._import_legacy_record(legacy_record_path)
+
+    def _import_legacy_record(self, record_path):
+        if not os.path.exists(record_path):
+            return
+        if self._conn.execute("SELECT 1 FROM tracked_files LIMIT 1").fetchone():
+            return
+        with open(record_path, 'r') as f:
+            paths = [line.strip() for line in f if line.strip()]
+        self.add_many(paths)
+        logger.info(f"Imported {len(paths)} tracked files from {record_path}")
+
+    def paths(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT path FROM tracked_files")}
+
+    def add(self, path):
+        self.add_many([path])
+
+    def add_many(self, paths):
+        now = time.time()
+        # The connection commits on success and rolls back on an exception, so it is never left mid-transaction
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO tracked_files (path, added_at) VALUES (?, ?)",
+                [(path, now) for path in paths]
+            )
+
+    def remove(self, path):
+        with self._lock:
+            self._conn.execute("DELETE FROM tracked_files WHERE path = ?", (path,))
+
+    def get(self, path):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM tracked_files WHERE path = ?", (path,)).fetchone()
+        return dict(row) if row else None
+
+    def uploaded_signature(self, path):
+        """(size, mtime_ns) the file had when it was last uploaded, or None"""
+        state = self.get(path)
+        if not state or state["uploaded_size"] is None:
+            return None
+        return state["uploaded_size"], state["uploaded_mtime_ns"]
+
+    def record_upload(self, path, signature, content_hash=None, remote_version=None):
+        """Record an upload, adding the path if it was not tracked yet. A None hash or version means unknown."""
+        size, mtime_ns = signature
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO tracked_files
+                       (path, added_at, uploaded_size, uploaded_mtime_ns, last_uploaded_hash,
+                        remote_version, last_synced_at, last_error)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, NULL)
+                   ON CONFLICT(path) DO UPDATE
+                   SET uploaded_size = excluded.uploaded_size, uploaded_mtime_ns = excluded.uploaded_mtime_ns,
+                       last_uploaded_hash = excluded.last_uploaded_hash, remote_version = excluded.remote_version,
+                       last_synced_at = excluded.last_synced_at, last_error = NULL""",
+                (path, now, size, mtime_ns, content_hash, remote_version, now)
+            )
+
+    def record_error(self, path, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE tracked_files SET last_error = ? WHERE path = ?",
+                (str(error), path)
+            )
+
+    def app_state_uploads(self):
+        """file_path -> (s3_key, (size, mtime_ns)) of every app state file uploaded so far"""
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM app_state_files").fetchall()
+        return {row["path"]: (row["s3_key"], (row["uploaded_size"], row["uploaded_mtime_ns"])) for row in rows}
+
+    def record_app_state_upload(self, path, s3_key, signature):
+        size, mtime_ns = signature
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO app_state_files (path, s3_key, uploaded_size, uploaded_mtime_ns) VALUES (?, ?, ?, ?)",
+                (path, s3_key, size, mtime_ns)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
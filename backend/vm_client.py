@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import histogram
+import tracing
+
+logger = logging.getLogger(__name__)
+
+AGENT_PORT = int(os.getenv("CLOUD_RAM_AGENT_PORT", "5000"))
+# (connect, read): a VM that does not accept a connection in 3s is not going to
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 10
+RETRIES = 2
+BACKOFF_SECONDS = 0.2
+RETRY_STATUSES = (502, 503, 504)
+POOL_SIZE = 10
+# Batch ops that are safe to run twice, so a batch made only of these may be retried
+IDEMPOTENT_BATCH_OPS = {
+    "list_tasks", "ram_usage", "activity", "memory_history", "launched_tasks", "prefetch", "sync_keys", "sync_files"
+}
+
+
+class VMUnavailable(requests.exceptions.ConnectionError):
+    """The VM's circuit is open: recent calls failed, so this one is not attempted."""
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive transport failures, so calls to a
+    dead VM fail at once instead of each waiting out its timeout. After
+    reset_timeout one trial call is let through; its outcome closes the circuit
+    or opens it again.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+# Kept per endpoint across all VMs; the label set would grow with every VM otherwise
+AGENT_LATENCY = histogram(
+    "cloud_ram_agent_request_duration_seconds", "Calls to VM agents by endpoint and outcome",
+    labels=("endpoint", "outcome")
+)
+
+
+class VMClient:
+    """
+    HTTP client for one VM agent. Connections are kept alive in a pool, every
+    call has a (connect, read) timeout, and only idempotent calls are retried,
+    with jittered exponential backoff; after a read timeout only GETs are.
+    Connection failures feed a circuit breaker that makes calls to a dead VM
+    fail fast with VMUnavailable, a
+    requests.ConnectionError, so existing RequestException handlers cover it.
+    Inside a trace, each call is a span and carries a traceparent header, so
+    the agent's spans join the caller's trace.
+    """
+
+    def __init__(self, vm_ip, port=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=RETRIES, breaker=None,
+                 traced=True):
+        self.vm_ip = vm_ip
+        self.port = port or AGENT_PORT
+        self.base_url = f"http://{vm_ip}:{self.port}"
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker()
+        self.traced = traced
+        self.session = requests.Session()
+        # No urllib3-level retries: they would bypass the idempotency check below
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0))
+
+    def request(self, method, endpoint, payload=None, timeout=None, idempotent=None, stream=False):
+        """
+        Call the agent and return the response. idempotent defaults to True for
+        GET; a timeout given as a number applies to the read, the connect
+        timeout stays short. Raises requests.RequestException (VMUnavailable
+        when the circuit is open).
+        """
+        if idempotent is None:
+            idempotent = method == "GET"
+        if timeout is None:
+            timeout = self.timeout
+        elif not isinstance(timeout, tuple):
+            timeout = (CONNECT_TIMEOUT, timeout)
+        url = f"{self.base_url}/{endpoint.lstrip('/')}"
+        if not self.traced:
+            return self._send(method, url, endpoint, payload, timeout, idempotent, stream)
+        with tracing.child_span(f"agent {method} /{endpoint.lstrip('/')}", vm_ip=self.vm_ip) as span:
+            response = self._send(method, url, endpoint, payload, timeout, idempotent, stream)
+            if span is not None:
+                span.set(status_code=response.status_code)
+            return response
+
+    def _send(self, method, url, endpoint, payload, timeout, idempotent, stream):
+        attempts = 1 + (self.retries if idempotent else 0)
+        headers = tracing.inject()
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                raise VMUnavailable(f"VM {self.vm_ip} is unavailable (circuit open after repeated failures)")
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, json=payload, headers=headers, timeout=timeout, stream=stream)
+            except requests.ConnectionError as e:
+                # Includes ConnectTimeout: the VM could not be reached at all
+                self.breaker.record_failure()
+                AGENT_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, outcome="error")
+                if attempt + 1 >= attempts:
+                    raise
+                logger.warning(f"{method} {url} failed ({e}), retrying")
+            except requests.Timeout:
+                # A read timeout: the agent took the request and is still working on it. It is
+                # reachable, so the circuit stays closed, and resending would only repeat the work.
+                self.breaker.record_success()
+                AGENT_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, outcome="timeout")
+                if method != "GET" or attempt + 1 >= attempts:
+                    raise
+                logger.warning(f"{method} {url} timed out, retrying")
+            except requests.RequestException as e:
+                # A broken or undecodable answer (ChunkedEncodingError, TooManyRedirects, ...). It has
+                # to count either way, or a half-open trial that ends here would hold the circuit shut.
+                self.breaker.record_failure()
+                AGENT_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, outcome="error")
+                if attempt + 1 >= attempts:
+                    raise
+                logger.warning(f"{method} {url} failed ({e}), retrying")
+            else:
+                self.breaker.record_success()
+                AGENT_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, outcome=response.status_code)
+                if response.status_code not in RETRY_STATUSES or attempt + 1 >= attempts:
+                    return response
+                logger.warning(f"{method} {url} returned {response.status_code}, retrying")
+                response.close()
+            # Full jitter keeps retries from many callers from lining up
+            time.sleep(random.uniform(0, BACKOFF_SECONDS * 2 ** attempt))
+
+    def get(self, endpoint, **kwargs):
+        return self.request("GET", endpoint, **kwargs)
+
+    def post(self, endpoint, payload=None, **kwargs):
+        return self.request("POST", endpoint, payload, **kwargs)
+
+    def get_json(self, endpoint, **kwargs):
+        """GET and decode; raises requests.HTTPError on a non-2xx answer"""
+        response = self.get(endpoint, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def batch(self, ops, timeout=None):
+        """
+        Run ops through the agent's /batch and yield each result as it streams
+        back; the last item is the summary ({"done": True, ...}). The batch is
+        retried only if every op in it is idempotent.
+        """
+        idempotent = all(op.get("op") in IDEMPOTENT_BATCH_OPS for op in ops)
+        # The request's own span ends with the headers; this one lasts until the last result.
+        # It is not made current across yields, which would leak it into the caller's context.
+        span = None
+        if self.traced and tracing.current():
+            span = tracing.start_span("agent batch", vm_ip=self.vm_ip, ops=len(ops))
+        token = tracing.attach(span) if span else None
+        try:
+            response = self.post("batch", {"ops": ops, "stream": True}, timeout=timeout, idempotent=idempotent, stream=True)
+        except Exception as e:
+            if span:
+                span.end(e)
+            raise
+        finally:
+            if token:
+                tracing.detach(token)
+        try:
+            with response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"VM rejected batch: {response.status_code} {response.text}")
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line)
+        except Exception as e:
+            if span:
+                span.fail(e)
+            raise
+        finally:
+            if span:
+                span.end()
+
+    async def arequest(self, method, endpoint, payload=None, **kwargs):
+        """request() for async code (FastAPI): the blocking call runs in a worker thread"""
+        return await asyncio.to_thread(self.request, method, endpoint, payload, **kwargs)
+
+    async def aget(self, endpoint, **kwargs):
+        return await self.arequest("GET", endpoint, **kwargs)
+
+    async def apost(self, endpoint, payload=None, **kwargs):
+        return await self.arequest("POST", endpoint, payload, **kwargs)
+
+    async def aget_json(self, endpoint, **kwargs):
+        response = await self.aget(endpoint, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_vm_client(vm_ip, port=None):
+    """The shared client for a VM, so its connection pool and circuit state are reused"""
+    key = (vm_ip, port or AGENT_PORT)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = VMClient(vm_ip, port)
+        return _clients[key]
+
+
+def evict_vm_client(vm_ip, port=None):
+    """Drop the shared client for an address a VM no longer has (stopped, resumed or resized)"""
+    if not vm_ip:
+        return
+    with _clients_lock:
+        client = _clients.pop((vm_ip, port or AGENT_PORT), None)
+    if client is not None:
+        client.close()
@@ -0,0 +1,206 @@
+import os
+import time
+import threading
+import logging
+import requests
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from vm_client import get_vm_client, evict_vm_client
+from rate_governor import background
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = 60
+# A resize stops the VM for a few minutes; after this long it is treated as stuck
+RESIZE_GRACE = 3600
+
+
+class IdlePolicy:
+    """
+    When a VM counts as unused, and what happens to it then.
+
+    A running VM is active while someone is connected over VNC, while files
+    sync or apps launch (within idle_after), or while its memory use is at or
+    above busy_memory_percent (a workload is using the RAM). Idle VMs are
+    stopped so they can be resumed; stopped VMs are terminated after
+    stopped_retention. Instances with no user mapping are terminated once
+    orphan_grace has passed since launch (a build takes up to ~15 minutes
+    before its mapping is written), and mapped VMs whose agent stays
+    unreachable for unreachable_after are stopped.
+    """
+
+    def __init__(self, idle_after=None, stopped_retention=None, orphan_grace=45 * 60,
+                 unreachable_after=10 * 60, busy_memory_percent=90):
+        self.idle_after = idle_after if idle_after is not None else \
+            int(float(os.getenv("CLOUD_RAM_IDLE_MINUTES", "15")) * 60)
+        self.stopped_retention = stopped_retention if stopped_retention is not None else \
+            int(float(os.getenv("CLOUD_RAM_STOPPED_RETENTION_HOURS", "72")) * 3600)
+        self.orphan_grace = orphan_grace
+        self.unreachable_after = unreachable_after
+        self.busy_memory_percent = busy_memory_percent
+
+    def is_active(self, activity):
+        if activity.get("vnc_connections"):
+            return True
+        if activity.get("idle_seconds", 0) < self.idle_after:
+            return True
+        return activity.get("memory_percent", 0) >= self.busy_memory_percent
+
+
+class VMReaper:
+    """
+    Periodically reconciles the instances Cloud RAM launched with the
+    CloudRAMUserVMs table and each agent's /activity report, releasing capacity
+    nobody uses: idle VMs are stopped (and marked stopped, so the next
+    allocation resumes them), long-stopped and orphaned ones are terminated,
+    and mappings whose instance is gone are dropped.
+    """
+
+    def __init__(self, aws_manager, table, policy=None, interval=SWEEP_INTERVAL, clock=time.time):
+        self.aws_manager = aws_manager
+        self.table = table
+        self.policy = policy or IdlePolicy()
+        self.interval = interval
+        self.clock = clock
+        self.unreachable_since = {}  # vm_id -> first failed /activity poll
+        self.last_activity = {}  # vm_id -> last /activity report
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep(self):
+        """One reconciliation pass; returns the actions taken as (action, vm_id) pairs"""
+        now = self.clock()
+        actions = []
+        vms = {vm["vm_id"]: vm for vm in self.aws_manager.list_managed_vms()}
+        mappings = self._mappings()
+        mapped_ids = {item["vm_id"] for item in mappings}
+        # Extra VMs placed for the user (placement.UserFleet) are released by consolidation or with the user's VM
+        mapped_ids.update(member["vm_id"] for item in mappings for member in item.get("pool", []))
+
+        for item in mappings:
+            vm = vms.get(item["vm_id"])
+            if item.get("state") == "resizing" and now - int(item.get("resizing_since", 0)) < RESIZE_GRACE:
+                # The right-sizer stopped it on purpose and will start it again
+                continue
+            if vm is None:
+                # Not listed: either gone, or launched before instances were tagged. Ask EC2 before dropping.
+                try:
+                    vm = self.aws_manager.adopt_vm(item["vm_id"], item["user_id"])
+                except ClientError as e:
+                    logger.error(f"Could not look up {item['vm_id']} of {item['user_id']}: {e}")
+                    continue
+                if vm is not None:
+                    vms[vm["vm_id"]] = vm
+                    actions.append(("adopt", vm["vm_id"]))
+            if vm is None:
+                # Terminated outside of us (or by an earlier sweep); the mapping is stale
+                logger.info(f"VM {item['vm_id']} of {item['user_id']} no longer exists, dropping its mapping")
+                self._delete_mapping(item)
+                actions.append(("drop_mapping", item["vm_id"]))
+            elif vm["state"] in ("stopping", "stopped"):
+                actions.extend(self._check_stopped(item, vm, now))
+            elif item.get("state", "running") == "running" and vm["state"] == "running":
+                actions.extend(self._check_running(item, vm, now))
+
+        for vm_id, vm in vms.items():
+            if vm_id not in mapped_ids and now - vm["launched_at"] >= self.policy.orphan_grace:
+                logger.info(f"VM {vm_id} ({vm['state']}) has no user mapping, terminating it")
+                self.aws_manager.terminate_vm(vm_id)
+                actions.append(("terminate_orphan", vm_id))
+
+        for vm_id in list(self.unreachable_since):
+            if vm_id not in vms:
+                self.unreachable_since.pop(vm_id, None)
+                self.last_activity.pop(vm_id, None)
+        if actions:
+            logger.info(f"Reaper sweep: {actions}")
+        return actions
+
+    def _check_running(self, item, vm, now):
+        vm_id = vm["vm_id"]
+        try:
+            activity = get_vm_client(vm["ip"]).get_json("activity", timeout=5)
+        except (requests.RequestException, ValueError) as e:
+            since = self.unreachable_since.setdefault(vm_id, now)
+            if now - since < self.policy.unreachable_after:
+                return []
+            logger.warning(f"Agent on {vm_id} unreachable for {round(now - since)}s ({e}), stopping it")
+            return self._suspend(item, now, "unreachable")
+        self.unreachable_since.pop(vm_id, None)
+        self.last_activity[vm_id] = activity
+        if self.policy.is_active(activity):
+            return []
+        logger.info(f"VM {vm_id} of {item['user_id']} idle for {activity.get('idle_seconds')}s, stopping it")
+        return self._suspend(item, now, "idle")
+
+    def _check_stopped(self, item, vm, now):
+        if item.get("state") != "stopped":
+            # Stopped outside of a release (console, reaper on another host): record it
+            self._mark_stopped(item, now)
+            return [("mark_stopped", vm["vm_id"])]
+        if now - int(item.get("stopped_at", now)) < self.policy.stopped_retention:
+            return []
+        logger.info(f"VM {vm['vm_id']} of {item['user_id']} stopped since {item['stopped_at']}, terminating")
+        self.aws_manager.terminate_vm(vm["vm_id"])
+        self._delete_mapping(item)
+        return [("terminate_expired", vm["vm_id"])]
+
+    def _suspend(self, item, now, reason):
+        if not self.aws_manager.stop_vm(item["vm_id"]):
+            return []
+        self._mark_stopped(item, now)
+        self.unreachable_since.pop(item["vm_id"], None)
+        return [(f"stop_{reason}", item["vm_id"])]
+
+    def _mappings(self):
+        items = []
+        scan_kwargs = {}
+        while True:
+            page = self.table.scan(**scan_kwargs)
+            items.extend(page.get("Items", []))
+            if "LastEvaluatedKey" not in page:
+                return items
+            scan_kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    def _mark_stopped(self, item, now):
+        # A stopped VM gives up its public IP
+        evict_vm_client(item.get("vm_ip"))
+        try:
+            self.table.update_item(
+                Key={"user_id": item["user_id"]},
+                UpdateExpression="SET #state = :stopped, stopped_at = :now",
+                ConditionExpression=Attr("vm_id").eq(item["vm_id"]),
+                ExpressionAttributeNames={"#state": "state"},
+                ExpressionAttributeValues={":stopped": "stopped", ":now": int(now)},
+            )
+        except ClientError as e:
+            logger.error(f"Could not mark {item['vm_id']} stopped: {e}")
+
+    def _delete_mapping(self, item):
+        evict_vm_client(item.get("vm_ip"))
+        try:
+            # Only if it still points at this VM: the user may have been given a new one meanwhile
+            self.table.delete_item(Key={"user_id": item["user_id"]}, ConditionExpression=Attr("vm_id").eq(item["vm_id"]))
+        except ClientError as e:
+            logger.error(f"Could not delete mapping for {item['user_id']}: {e}")
+
+    def start(self):
+        """Sweep every interval seconds in the background"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    with background():
+                        self.sweep()
+                except Exception as e:
+                    logger.error(f"Reaper sweep failed: {e}")
+                self._stop.wait(self.interval)
+
+        self._thread = threading.Thread(target=run, daemon=True, name="vm-reaper")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,212 @@
+import os
+import sys
+import time
+import threading
+import subprocess
+import itertools
+import logging
+from multiprocessing.connection import Listener, Client
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# The launcher and the agent talk over localhost only, authenticated with a shared key file
+LAUNCHER_HOST = "127.0.0.1"
+LAUNCHER_PORT = int(os.getenv("CLOUD_RAM_LAUNCHER_PORT", "5050"))
+AGENT_DIR = os.getenv("CLOUD_RAM_AGENT_DIR", "C:\\CloudRAM" if os.name == "nt" else os.path.dirname(os.path.abspath(__file__)))
+KEY_PATH = os.path.join(AGENT_DIR, "launcher.key")
+READY_TIMEOUT = 10
+POLL_INTERVAL = 0.05
+
+
+class LauncherUnavailable(Exception):
+    pass
+
+
+def load_authkey(create=False):
+    """Shared secret for the IPC channel; the launcher creates it on first start"""
+    if create and not os.path.exists(KEY_PATH):
+        os.makedirs(AGENT_DIR, exist_ok=True)
+        with open(KEY_PATH, "wb") as f:
+            f.write(os.urandom(32))
+    with open(KEY_PATH, "rb") as f:
+        return f.read()
+
+
+def _window_pids():
+    """PIDs owning a visible top-level window, or None if windows cannot be enumerated here"""
+    if os.name != "nt":
+        return None
+    try:
+        import win32gui
+        import win32process
+    except ImportError:
+        return None
+    pids = set()
+
+    def enum_windows_callback(hwnd, _):
+        if win32gui.IsWindowVisible(hwnd) and win32gui.GetWindowText(hwnd):
+            pids.add(win32process.GetWindowThreadProcessId(hwnd)[1])
+    win32gui.EnumWindows(enum_windows_callback, None)
+    return pids
+
+
+def _processes_named(image_name):
+    name = image_name.lower()
+    pids = set()
+    for proc in psutil.process_iter(['pid', 'name', 'status']):
+        if (proc.info['name'] or '').lower() == name and proc.info['status'] != psutil.STATUS_ZOMBIE:
+            pids.add(proc.info['pid'])
+    return pids
+
+
+def launch_and_wait(command, image_name, timeout=READY_TIMEOUT):
+    """
+    Start command and return once the app is up: a process of image_name with a
+    visible window where windows can be enumerated, else a running process.
+    Single-instance apps may hand the launch to a window that is already open;
+    that window's PID is returned then.
+    """
+    started = time.perf_counter()
+    known = _processes_named(image_name)
+    child = subprocess.Popen(command)
+    deadline = started + timeout
+    pid, ready = None, None
+    while time.perf_counter() < deadline:
+        candidates = (_processes_named(image_name) - known) | ({child.pid} if child.poll() is None else set())
+        windows = _window_pids()
+        if windows is None:
+            if candidates:
+                pid, ready = min(candidates), "process"
+                break
+        else:
+            with_window = candidates & windows
+            if with_window:
+                pid, ready = min(with_window), "window"
+                break
+            if child.poll() is not None and known & windows:
+                # Handed over to the running instance
+                pid, ready = min(known & windows), "window"
+                break
+        time.sleep(POLL_INTERVAL)
+    else:
+        # The app started but never showed a window in time; report what is running
+        running = (_processes_named(image_name) - known) or known
+        if running:
+            pid, ready = min(running), "timeout"
+    return {
+        "ok": pid is not None,
+        "pid": pid,
+        "ready": ready,
+        "elapsed": round(time.perf_counter() - started, 3),
+    }
+
+
+class LauncherServer:
+    """
+    Long-lived launcher that runs inside the interactive desktop session, so apps
+    it starts are visible over VNC. Requests arrive as dicts over a local
+    multiprocessing connection:
+      {"op": "ping"}
+      {"op": "launch", "command": [...], "image": "notepad++.exe", "timeout": 10}
+    """
+
+    def __init__(self, host=LAUNCHER_HOST, port=LAUNCHER_PORT):
+        self.address = (host, port)
+        self.authkey = load_authkey(create=True)
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            logger.info(f"App launcher listening on {self.address[0]}:{self.address[1]}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    logger.warning(f"Rejected launcher connection: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            try:
+                request = conn.recv()
+                conn.send(self.handle_request(request))
+            except EOFError:
+                pass
+            except Exception as e:
+                logger.error(f"Launcher request failed: {e}")
+
+    def handle_request(self, request):
+        op = request.get("op")
+        if op == "ping":
+            return {"ok": True, "pid": os.getpid()}
+        if op == "launch":
+            try:
+                result = launch_and_wait(request["command"], request["image"], request.get("timeout", READY_TIMEOUT))
+            except OSError as e:
+                return {"ok": False, "error": str(e)}
+            logger.info(f"Launched {request['image']}: {result}")
+            return result
+        return {"ok": False, "error": f"Unknown op: {op}"}
+
+
+class LauncherClient:
+    """Agent side of the launcher channel; one short connection per request."""
+
+    def __init__(self, host=LAUNCHER_HOST, port=LAUNCHER_PORT):
+        self.address = (host, port)
+
+    def _call(self, request, timeout):
+        try:
+            conn = Client(self.address, authkey=load_authkey())
+        except (OSError, EOFError) as e:
+            raise LauncherUnavailable(f"App launcher not reachable: {e}")
+        with conn:
+            conn.send(request)
+            if not conn.poll(timeout):
+                raise LauncherUnavailable(f"App launcher did not answer within {timeout}s")
+            return conn.recv()
+
+    def ping(self, timeout=2):
+        return self._call({"op": "ping"}, timeout)
+
+    def launch(self, command, image_name, timeout=READY_TIMEOUT):
+        """Returns {"ok", "pid", "ready", "elapsed"} (or {"ok": False, "error"})"""
+        return self._call({"op": "launch", "command": command, "image": image_name, "timeout": timeout}, timeout + 5)
+
+
+class StubLauncher:
+    """In-process stand-in for tests: records launches and hands out fake PIDs."""
+
+    def __init__(self, fail_images=()):
+        self.fail_images = {image.lower() for image in fail_images}
+        self.launches = []
+        self._pids = itertools.count(20000)
+
+    def ping(self, timeout=2):
+        return {"ok": True, "pid": os.getpid()}
+
+    def launch(self, command, image_name, timeout=READY_TIMEOUT):
+        self.launches.append((list(command), image_name))
+        if image_name.lower() in self.fail_images:
+            return {"ok": False, "error": f"{image_name} not installed"}
+        return {"ok": True, "pid": next(self._pids), "ready": "stub", "elapsed": 0.0}
+
+
+def get_launcher(kind=None):
+    """The launcher client to use: "stub" via CLOUD_RAM_LAUNCHER, else the real one"""
+    kind = kind or os.getenv("CLOUD_RAM_LAUNCHER", "ipc")
+    return StubLauncher() if kind == "stub" else LauncherClient()
+
+
+if __name__ == "__main__":
+    os.makedirs(AGENT_DIR, exist_ok=True)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        handlers=[
+            logging.FileHandler(os.path.join(AGENT_DIR, "app_launcher.log")),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+    LauncherServer().serve_forever()
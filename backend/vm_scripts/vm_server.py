@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 import os
 import psutil
 import subprocess
@@ -11,13 +11,39 @@ import threading
 import sys
 import logging
 import requests
+import json
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Shared agent modules are deployed next to this script; in the repo they live in backend/
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from process_snapshot import ProcessSnapshotService
+from app_launcher import get_launcher, LauncherUnavailable
+import metrics
+import tracing
+
+tracing.SERVICE = "vm-agent"
+
+# The same agent serves Windows Server and Linux (Xvfb + x11vnc) VMs
+IS_WINDOWS = os.name == "nt"
+if IS_WINDOWS:
+    AGENT_DIR = "C:\\CloudRAM"
+    USER_HOME = "C:\\Users\\vm_user"
+else:
+    AGENT_DIR = os.getenv("CLOUD_RAM_AGENT_DIR", os.path.dirname(os.path.abspath(__file__)))
+    USER_HOME = os.path.expanduser("~")
+    # Apps are shown on the virtual display that x11vnc/noVNC export
+    DISPLAY = os.getenv("DISPLAY", ":1")
+os.makedirs(AGENT_DIR, exist_ok=True)
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s',
     handlers=[
-        logging.FileHandler("C:\\CloudRAM\\vm_server.log"),
+        logging.FileHandler(os.path.join(AGENT_DIR, "vm_server.log")),
         logging.StreamHandler()
     ]
 )
@@ -25,9 +51,52 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+HTTP_LATENCY = metrics.histogram(
+    "cloud_ram_agent_http_request_duration_seconds", "Agent API requests by route, method and status",
+    labels=("method", "route", "status")
+)
+SYNC_QUEUE = metrics.gauge("cloud_ram_sync_queue_depth", "Files queued or in flight to or from S3", labels=("queue",))
+WATCHER_EVENTS = metrics.counter(
+    "cloud_ram_watcher_events_total", "File change events seen by the watcher, by what was done with them",
+    labels=("side", "outcome")
+)
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    # Only calls made inside a backend trace are traced here; polling by the reaper and such is not
+    parent = tracing.extract(request.headers.get(tracing.HEADER))
+    if parent:
+        rule = request.url_rule.rule if request.url_rule else "unmatched"
+        g.trace_span = tracing.start_span(f"{request.method} {rule}", parent=parent)
+        g.trace_token = tracing.attach(g.trace_span)
+
+@app.after_request
+def time_request(response):
+    # Streaming responses (/batch) are timed to their first byte
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_LATENCY.observe(
+        time.perf_counter() - g.get("started", time.perf_counter()),
+        method=request.method, route=rule, status=response.status_code
+    )
+    return response
+
+@app.teardown_request
+def end_trace(error=None):
+    token = g.pop("trace_token", None)
+    if token is not None:
+        tracing.detach(token)
+    # /batch takes its span along when it streams, and ends it after the last result
+    span = g.pop("trace_span", None)
+    if span is not None:
+        span.end(error)
+
 # AWS + Local Paths using environment variable credentials
 BUCKET_NAME = 'notepadfiles'
-SYNCED_DIR = "C:\\Users\\vm_user\\SyncedNotepadFiles"
+SYNCED_DIR = os.path.join(USER_HOME, "SyncedNotepadFiles")
+# Bookkeeping objects written by the backend; never synced as user files
+CONTROL_PREFIX = "_cloudram/"
+WORKING_SET_MANIFEST_KEY = CONTROL_PREFIX + "working_set.json"
 
 # Load credentials from environment variables (Machine-level)
 session = boto3.Session(
@@ -42,24 +111,181 @@ if credentials is None:
 else:
     logger.info("AWS credentials loaded from environment.")
 
-s3 = session.client('s3')
+s3 = metrics.instrument_boto_client(session.client('s3'))
 
-# Notepad++ possible paths
-NOTEPAD_PATHS = [
-    r"C:\\Program Files\\Notepad++\\notepad++.exe",
-    r"C:\\Program Files (x86)\\Notepad++\\notepad++.exe"
-]
+if IS_WINDOWS:
+    # Notepad++ possible paths
+    NOTEPAD_PATHS = [
+        r"C:\\Program Files\\Notepad++\\notepad++.exe",
+        r"C:\\Program Files (x86)\\Notepad++\\notepad++.exe"
+    ]
+    CODE_PATHS = [
+        r"C:\\Program Files\\Microsoft VS Code\\Code.exe",
+        r"C:\\Users\\vm_user\\AppData\\Local\\Programs\\Microsoft VS Code\\Code.exe"
+    ]
+    CHROME_PATHS = [
+        r"C:\\Program Files\\Google\\Chrome\\Application\\chrome.exe",
+        r"C:\\Program Files (x86)\\Google\\Chrome\\Application\\chrome.exe"
+    ]
+else:
+    # Linux stand-ins; Notepad++ files open in a native editor
+    NOTEPAD_PATHS = ["/usr/bin/mousepad", "/usr/bin/gedit"]
+    CODE_PATHS = ["/snap/bin/code", "/usr/bin/code"]
+    CHROME_PATHS = ["/usr/bin/google-chrome", "/usr/bin/google-chrome-stable", "/usr/bin/chromium"]
+APP_PATHS = {
+    "notepad++.exe": NOTEPAD_PATHS,
+    "code.exe": CODE_PATHS,
+    "chrome.exe": CHROME_PATHS,
+}
+# Images with apps installed elsewhere: {"code.exe": "/opt/code/code", ...}, tried first
+for app_name, app_path in json.loads(os.getenv("CLOUD_RAM_APP_PATHS", "{}")).items():
+    APP_PATHS[app_name.lower()] = [app_path] + APP_PATHS.get(app_name.lower(), [])
+
+# Where migrated app state lands; S3 keys carry the app prefix (see backend/app_adapters.py)
+WORKSPACES_DIR = os.path.join(USER_HOME, "Workspaces")
+CHROME_USER_DATA_DIR = os.path.join(USER_HOME, "ChromeProfile")
+APP_STATE_DIRS = {
+    "vscode/": WORKSPACES_DIR,
+    "chrome/": CHROME_USER_DATA_DIR,
+}
+LAUNCH_TIMEOUT = 10
+
+# Launches go through the long-lived launcher in the interactive session (app_launcher.py);
+# on Linux the agent already shares the display, unless a launcher is asked for explicitly
+launcher = get_launcher() if IS_WINDOWS or os.getenv("CLOUD_RAM_LAUNCHER") else None
 
 # In-memory task tracking
 running_tasks = {}
+# Process names the apps run under on Linux; the backend knows them by their Windows image names
+LINUX_PROCESS_NAMES = {
+    "notepad++.exe": ("mousepad", "gedit"),
+    "code.exe": ("code",),
+    "chrome.exe": ("chrome", "chromium"),
+}
+# Process table view shared by every endpoint; tasks are reported under the backend's image names
+processes = ProcessSnapshotService(aliases=None if IS_WINDOWS else LINUX_PROCESS_NAMES)
 # Track open files in Notepad++
 open_notepad_files = set()
-
-def get_notepad_exe():
-    for path in NOTEPAD_PATHS:
+# Prefetches run one at a time in the background; /run_task and sync_keys wait until none is pending
+prefetch_lock = threading.Lock()
+prefetch_idle = threading.Condition()
+prefetches_pending = 0
+PREFETCH_WAIT_SECONDS = 60
+# Activity signals for the backend's idle reaper: when each kind of activity was last seen
+AGENT_STARTED_AT = time.time()
+last_activity = {}
+VNC_PORTS = (5900, 8080)
+
+def mark_activity(kind):
+    last_activity[kind] = time.time()
+
+# Memory pressure history for the backend's right-sizing controller
+MEMORY_SAMPLE_SECONDS = 15
+memory_history = deque(maxlen=6 * 3600 // MEMORY_SAMPLE_SECONDS)
+
+def find_app_exe(task):
+    """Installed executable for a known app, or None"""
+    for path in APP_PATHS.get(task.lower(), []):
         if os.path.exists(path):
             return path
-    return "notepad++.exe"
+    return None
+
+def warm_app(task):
+    """Read the app's executable once so the launch hits a warm file cache"""
+    app_exe = find_app_exe(task) if task else None
+    if not app_exe:
+        return
+    try:
+        with open(app_exe, "rb") as f:
+            while f.read(1024 * 1024):
+                pass
+        logger.info(f"Warmed {app_exe}")
+    except OSError as e:
+        logger.warning(f"Could not warm {app_exe}: {e}")
+
+def local_path_for_key(s3_key):
+    """Local path for an S3 key: app state keeps its layout, everything else goes to SYNCED_DIR"""
+    for prefix, base_dir in APP_STATE_DIRS.items():
+        if s3_key.startswith(prefix):
+            local_path = os.path.normpath(os.path.join(base_dir, *s3_key[len(prefix):].split("/")))
+            if not local_path.startswith(base_dir + os.sep):
+                raise ValueError(f"S3 key escapes {base_dir}: {s3_key}")
+            return local_path
+    return os.path.join(SYNCED_DIR, os.path.basename(s3_key))
+
+def is_app_state_key(s3_key):
+    return s3_key.startswith(tuple(APP_STATE_DIRS))
+
+def download_keys(keys):
+    """Download the given S3 keys to their local paths; returns the local paths that made it"""
+    os.makedirs(SYNCED_DIR, exist_ok=True)
+    local_paths = []
+    SYNC_QUEUE.inc(len(keys), queue="download")
+    for s3_key in keys:
+        try:
+            local_path = local_path_for_key(s3_key)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with tracing.child_span("s3.download", key=s3_key):
+                s3.download_file(BUCKET_NAME, s3_key, local_path)
+            local_paths.append(local_path)
+            logger.info(f"Downloaded {s3_key}")
+            mark_activity("sync")
+        except Exception as e:
+            logger.error(f"Error downloading {s3_key}: {e}")
+        finally:
+            SYNC_QUEUE.dec(queue="download")
+    return local_paths
+
+def file_md5(file_path):
+    digest = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def prefetch_working_set():
+    """Pull the working set the backend staged while this VM was provisioning"""
+    try:
+        manifest = json.loads(s3.get_object(Bucket=BUCKET_NAME, Key=WORKING_SET_MANIFEST_KEY)["Body"].read())
+    except botocore.exceptions.ClientError as e:
+        logger.info(f"No staged working set to prefetch: {e}")
+        return []
+
+    stale = []
+    for entry in manifest.get("files", []):
+        local_path = os.path.join(SYNCED_DIR, os.path.basename(entry["key"]))
+        if not os.path.isfile(local_path) or file_md5(local_path) != entry.get("md5"):
+            stale.append(entry["key"])
+    logger.info(f"Working set manifest lists {len(manifest.get('files', []))} files, {len(stale)} to download")
+    return download_keys(stale)
+
+def begin_prefetch():
+    """Count a prefetch as pending from the moment it is accepted, before its thread runs"""
+    global prefetches_pending
+    with prefetch_idle:
+        prefetches_pending += 1
+
+def wait_for_prefetches(timeout=PREFETCH_WAIT_SECONDS):
+    """Block until no prefetch is pending; False if one still is after timeout"""
+    with prefetch_idle:
+        return prefetch_idle.wait_for(lambda: prefetches_pending == 0, timeout=timeout)
+
+def run_prefetch(tasks, keys, manifest=False):
+    global prefetches_pending
+    try:
+        # Two prefetches of the same key would race on its local copy
+        with prefetch_lock, tracing.child_span("prefetch", files=len(keys), tasks=",".join(tasks)):
+            if manifest:
+                prefetch_working_set()
+            download_keys(keys)
+            for task in tasks:
+                warm_app(task)
+    except Exception as e:
+        logger.error(f"Prefetch failed: {e}")
+    finally:
+        with prefetch_idle:
+            prefetches_pending -= 1
+            prefetch_idle.notify_all()
 
 @app.route("/")
 def home():
@@ -68,12 +294,7 @@ def home():
 
 @app.route("/list_tasks", methods=["GET"])
 def list_tasks():
-    target_tasks = ['notepad++.exe', 'chrome.exe', 'Code.exe']
-    task_list = []
-    for proc in psutil.process_iter(attrs=['pid', 'name']):
-        if proc.info['name'] in target_tasks:
-            task_list.append({"pid": proc.info['pid'], "name": proc.info['name']})
-    return jsonify({"tasks": task_list})
+    return jsonify({"tasks": processes.target_tasks()})
 
 @app.route("/terminate_task", methods=["POST"])
 def terminate_task():
@@ -94,204 +315,401 @@ def terminate_task():
 
 @app.route("/ram_usage", methods=["GET"])
 def ram_usage():
+    return jsonify(ram_usage_info())
+
+@app.route("/activity", methods=["GET"])
+def activity():
+    return jsonify(activity_report())
+
+def vnc_connection_count():
+    """Viewers connected over VNC or noVNC; noVNC's own hop to 5900 is local and not counted"""
+    try:
+        connections = psutil.net_connections(kind="tcp")
+    except (psutil.AccessDenied, OSError) as e:
+        logger.warning(f"Cannot list connections: {e}")
+        return None
+    return sum(
+        1 for conn in connections
+        if conn.status == psutil.CONN_ESTABLISHED and conn.laddr and conn.laddr.port in VNC_PORTS
+        and conn.raddr and not conn.raddr.ip.startswith(("127.", "::1", "::ffff:127."))
+    )
+
+def activity_report():
+    """What the reaper needs to decide whether this VM is still in use"""
+    vnc_connections = vnc_connection_count()
+    if vnc_connections:
+        mark_activity("vnc")
+    now = time.time()
+    last_seen = max([AGENT_STARTED_AT] + list(last_activity.values()))
+    return {
+        "tasks": processes.target_tasks(),
+        "memory_percent": psutil.virtual_memory().percent,
+        "vnc_connections": vnc_connections,
+        # Seconds since each kind of activity, measured here so clock skew does not matter
+        "seconds_since": {kind: round(now - seen) for kind, seen in last_activity.items()},
+        "idle_seconds": round(now - last_seen),
+        "uptime_seconds": round(now - AGENT_STARTED_AT),
+    }
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+metrics.gauge(
+    "cloud_ram_task_rss_bytes", "Resident memory of each app launched on this VM", labels=("task", "pid"),
+    fn=lambda: {(task["task"], task["pid"]): task["rss"] for task in launched_tasks()}
+)
+metrics.gauge(
+    "cloud_ram_vm_memory_bytes", "Memory of this VM", labels=("kind",),
+    fn=lambda: {(kind,): value for kind, value in psutil.virtual_memory()._asdict().items()
+                if kind in ("total", "available", "used")}
+)
+
+@app.route("/traces/<trace_id>", methods=["GET"])
+def trace_spans(trace_id):
+    """This agent's spans of a backend trace; the backend merges them into its waterfall"""
+    return jsonify({"spans": tracing.STORE.get(trace_id)})
+
+@app.route("/memory_history", methods=["GET"])
+def memory_history_endpoint():
+    body, status = memory_history_report({"since": request.args.get("since", type=int)})
+    return jsonify(body), status
+
+def sample_memory():
     ram_info = psutil.virtual_memory()
-    return jsonify({
+    swap_info = psutil.swap_memory()
+    memory_history.append((round(time.time()), ram_info.percent, ram_info.total - ram_info.available, swap_info.used))
+
+def start_memory_sampler():
+    def run():
+        while True:
+            try:
+                sample_memory()
+            except Exception as e:
+                logger.error(f"Memory sample failed: {e}")
+            time.sleep(MEMORY_SAMPLE_SECONDS)
+    threading.Thread(target=run, daemon=True, name="memory-sampler").start()
+
+def memory_history_report(args):
+    """Samples from the last `since` seconds (all kept ones by default), oldest first"""
+    since = args.get("since")
+    now = time.time()
+    samples = [
+        {"seconds_ago": round(now - at), "percent_used": percent, "used_ram": used, "swap_used": swap}
+        for at, percent, used, swap in list(memory_history)
+        if since is None or now - at <= since
+    ]
+    return {
+        "total_ram": psutil.virtual_memory().total,
+        "interval": MEMORY_SAMPLE_SECONDS,
+        "samples": samples,
+    }, 200
+
+def launched_tasks():
+    """Apps started through /run_task that are still running, with what they were restored from and their RSS"""
+    tasks = []
+    for pid, info in list(running_tasks.items()):
+        try:
+            rss = psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            running_tasks.pop(pid, None)
+            continue
+        tasks.append({
+            "pid": pid, "task": info["name"], "files": info["files"], "restore": info.get("restore") or {}, "rss": rss
+        })
+    return tasks
+
+def ram_usage_info():
+    ram_info = psutil.virtual_memory()
+    return {
         "total_ram": ram_info.total,
         "used_ram": ram_info.used,
         "available_ram": ram_info.available,
         "percent_used": ram_info.percent
-    })
+    }
+
+@app.route("/prefetch", methods=["POST"])
+def prefetch():
+    """Start pulling files from S3 and warming the app ahead of /run_task"""
+    body, status = start_prefetch(request.get_json())
+    return jsonify(body), status
+
+def start_prefetch(data):
+    tasks = data.get("tasks") or [t for t in [data.get("task")] if t]
+    keys = data.get("files", [])
+    manifest = data.get("manifest", False)
+    # Returns at once; a prefetch already running is queued behind, not waited for here
+    begin_prefetch()
+    # Bound to the caller's trace, so the downloads show up next to the migration that asked for them
+    threading.Thread(target=tracing.wrap(run_prefetch), args=(tasks, keys, manifest), daemon=True).start()
+    logger.info(f"Prefetching {len(keys)} files for {tasks}")
+    return {"message": "Prefetch started", "file_count": len(keys)}, 200
+
+def sync_keys(data):
+    """Re-download the given keys, e.g. files changed at cutover; returns (body, status)"""
+    keys = data.get("keys", [])
+    timings = {}
+    # A prefetch still in flight could otherwise overwrite the fresh copies with older ones
+    started = time.perf_counter()
+    with tracing.child_span("prefetch_wait"):
+        wait_for_prefetches()
+    timings["prefetch_wait"] = round(time.perf_counter() - started, 3)
+    started = time.perf_counter()
+    with tracing.child_span("delta_download", files=len(keys)):
+        local_paths = download_keys(keys)
+    timings["delta_download"] = round(time.perf_counter() - started, 3)
+    return {"file_count": len(local_paths), "failed": len(keys) - len(local_paths), "timings": timings}, 200
+
+def notepad_restore_command(app_exe, file_paths, restore):
+    return [app_exe] + file_paths
+
+def vscode_restore_command(app_exe, file_paths, restore):
+    workspaces = [os.path.join(WORKSPACES_DIR, name) for name in restore.get("workspaces", [])]
+    return [app_exe] + [path for path in workspaces if os.path.isdir(path)]
+
+def chrome_restore_command(app_exe, file_paths, restore):
+    return [
+        app_exe,
+        f"--user-data-dir={CHROME_USER_DATA_DIR}",
+        f"--profile-directory={restore.get('profile', 'Default')}",
+        "--restore-last-session"
+    ]
+
+# task -> (command builder, fallback image); anything else is launched without state
+APP_RESTORERS = {
+    "notepad++.exe": (notepad_restore_command, "notepad.exe" if IS_WINDOWS else None),
+    "code.exe": (vscode_restore_command, None),
+    "chrome.exe": (chrome_restore_command, None),
+}
+
+def get_active_session_id():
+    """Session ID of the active console/VNC session, for logging"""
+    try:
+        session_check = subprocess.run(
+            ["qwinsta"], capture_output=True, text=True
+        )
+        logger.info(f"Active sessions: {session_check.stdout}")
+        for line in session_check.stdout.splitlines():
+            parts = line.split()
+            if len(parts) >= 4 and parts[3] == "Active" and ("console" in line.lower() or "rdp-tcp" in line.lower()):
+                return parts[2]  # Session ID is the third column
+    except Exception as e:
+        logger.error(f"Failed to get active session: {e}")
+    return None
+
+def wait_for_launched_process(image_name, known_pids, timeout=LAUNCH_TIMEOUT):
+    """PID of a new image_name process, or of the running instance that took over the launch"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for info in processes.find(image_name, max_age=0):
+            if info["pid"] not in known_pids:
+                return info["pid"]
+        time.sleep(0.2)
+    # Single-instance apps hand the launch to the window that is already open
+    matches = processes.find(image_name, max_age=0)
+    return matches[0]["pid"] if matches else None
+
+def launch_in_session(command, image_name):
+    """
+    Run command in the interactive session through a one-off scheduled task
+    (the agent itself runs as a service in session 0). Returns the PID, or None.
+    Slow (several subprocesses per launch); only used when the launcher is down.
+    """
+    # Log current session info for debugging
+    try:
+        session_info = subprocess.run(
+            ["wmic", "process", "where", f"ProcessID={os.getpid()}", "get", "SessionId"],
+            capture_output=True, text=True
+        )
+        logger.info(f"Flask app running in session: {session_info.stdout}")
+    except Exception as e:
+        logger.error(f"Failed to get session info: {e}")
+    logger.info(f"Detected active session ID: {get_active_session_id()}")
+
+    task_name = f"CloudRAMLaunch_{os.path.splitext(image_name)[0]}"
+    cmd = " ".join(f'"{arg}"' for arg in command)
+    logger.info(f"Preparing to launch {image_name} with schtasks command: {cmd}")
+    known_pids = {info["pid"] for info in processes.find(image_name, max_age=0)}
+
+    # Delete existing task if it exists
+    delete_result = subprocess.run(
+        ["schtasks", "/delete", "/tn", task_name, "/f"],
+        capture_output=True, text=True
+    )
+    logger.info(f"schtasks delete output: {delete_result.stdout}")
+
+    # Create a scheduled task to run immediately under the Administrator user
+    create_result = subprocess.run(
+        ["schtasks", "/create", "/tn", task_name, "/tr", cmd,
+         "/sc", "once", "/st", "00:00", "/ru", "Administrator", "/it", "/f"],
+        capture_output=True, text=True
+    )
+    logger.info(f"schtasks create output: {create_result.stdout}")
+    if create_result.stderr:
+        logger.error(f"schtasks create error: {create_result.stderr}")
+
+    # Run the task immediately
+    run_result = subprocess.run(
+        ["schtasks", "/run", "/tn", task_name],
+        capture_output=True, text=True
+    )
+    logger.info(f"schtasks run output: {run_result.stdout}")
+    if run_result.stderr:
+        logger.error(f"schtasks run error: {run_result.stderr}")
+
+    return wait_for_launched_process(image_name, known_pids)
+
+def launch_on_display(command, image_name):
+    """Start command on the Xvfb display; the agent shares the user's session, so no detour is needed"""
+    logger.info(f"Launching {image_name} on display {DISPLAY}: {command}")
+    proc = subprocess.Popen(
+        command,
+        env=dict(os.environ, DISPLAY=DISPLAY),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+    return proc.pid
+
+def launch_app(command, image_name):
+    """Start an app where the user can see it; returns the PID once it is up, or None"""
+    if launcher is None:
+        return launch_on_display(command, image_name)
+    try:
+        result = launcher.launch(command, image_name, timeout=LAUNCH_TIMEOUT)
+    except LauncherUnavailable as e:
+        if not IS_WINDOWS:
+            logger.warning(f"{e}; launching directly on the display")
+            return launch_on_display(command, image_name)
+        logger.warning(f"{e}; falling back to schtasks")
+        return launch_in_session(command, image_name)
+    if not result.get("ok"):
+        logger.warning(f"Launcher could not start {image_name}: {result.get('error', result)}")
+        return None
+    logger.info(f"Launcher started {image_name} (PID {result['pid']}, {result['ready']}) in {result['elapsed']}s")
+    return result["pid"]
 
 @app.route("/run_task", methods=["POST"])
 def run_task():
+    logger.info("/run_task endpoint called")
+    body, status = start_task(request.get_json())
+    return jsonify(body), status
+
+def start_task(data):
+    """Restore and launch one app; returns (response body, HTTP status)"""
     try:
-        logger.info("/run_task endpoint called")
-        data = request.get_json()
         task = data.get("task")
+        restore = data.get("restore") or {}
+        timings = {}
 
         if not task:
-            return jsonify({"error": "Task name required"}), 400
+            return {"error": "Task name required"}, 400
 
-        if task != "notepad++.exe":
-            return jsonify({"error": f"Unsupported task: {task}"}), 400
+        restore_command, fallback_image = APP_RESTORERS.get(task.lower(), (None, None))
+        is_notepad = task.lower() == "notepad++.exe"
 
         # Ensure directories exist
         os.makedirs(SYNCED_DIR, exist_ok=True)
-        os.makedirs("C:\\CloudRAM", exist_ok=True)
+        os.makedirs(AGENT_DIR, exist_ok=True)
+
+        requested_keys = data.get("files")
+        if requested_keys is not None:
+            # Pipelined migration: most files were prefetched already, only pull
+            # the cutover deltas and anything the prefetch did not get to
+            started = time.perf_counter()
+            with tracing.child_span("prefetch_wait", task=task):
+                wait_for_prefetches()
+            timings["prefetch_wait"] = round(time.perf_counter() - started, 3)
+
+            started = time.perf_counter()
+            refresh = set(data.get("refresh", []))
+            local_paths = {}
+            for s3_key in requested_keys:
+                try:
+                    local_paths[s3_key] = local_path_for_key(s3_key)
+                except ValueError as e:
+                    logger.error(str(e))
+            missing = [k for k, path in local_paths.items() if k in refresh or not os.path.isfile(path)]
+            with tracing.child_span("delta_download", task=task, files=len(missing)):
+                download_keys(missing)
+            # Only Notepad++ is handed individual files; other apps get their state dirs
+            file_paths = [
+                path for k, path in local_paths.items()
+                if not is_app_state_key(k) and os.path.isfile(path)
+            ]
+            timings["delta_download"] = round(time.perf_counter() - started, 3)
+        elif is_notepad:
+            # Sync files from S3
+            try:
+                sync_notepad_files()
+            except Exception as sync_error:
+                logger.error(f"Sync error: {sync_error}")
+
+            # Gather file paths
+            file_paths = [
+                os.path.join(SYNCED_DIR, f)
+                for f in os.listdir(SYNCED_DIR)
+                if os.path.isfile(os.path.join(SYNCED_DIR, f)) and f.endswith(('.txt', '.cpp', '.py', '.html'))
+            ]
+        else:
+            file_paths = []
 
-        # Sync files from S3
-        try:
-            sync_notepad_files()
-        except Exception as sync_error:
-            logger.error(f"Sync error: {sync_error}")
-
-        # Gather file paths
-        file_paths = [
-            os.path.join(SYNCED_DIR, f)
-            for f in os.listdir(SYNCED_DIR)
-            if os.path.isfile(os.path.join(SYNCED_DIR, f)) and f.endswith(('.txt', '.cpp', '.py', '.html'))
-        ]
-
-        if not file_paths:
+        if is_notepad and not file_paths:
             logger.info("No files found to open")
-            return jsonify({"message": "No files found to open", "file_count": 0})
-
-        # Get Notepad++ executable path
-        notepad_exe = get_notepad_exe()
-        if not os.path.exists(notepad_exe):
-            logger.error(f"Notepad++ executable not found at {notepad_exe}")
-            return jsonify({"error": "Notepad++ executable not found"}), 500
-
-        # Log current session info for debugging
-        try:
-            session_info = subprocess.run(
-                ["wmic", "process", "where", f"ProcessID={os.getpid()}", "get", "SessionId"],
-                capture_output=True, text=True
-            )
-            logger.info(f"Flask app running in session: {session_info.stdout}")
-        except Exception as e:
-            logger.error(f"Failed to get session info: {e}")
-
-        # Get the active session ID (VNC session)
+            return {"message": "No files found to open", "file_count": 0}, 200
+
+        app_exe = find_app_exe(task)
+        if task.lower() in APP_PATHS and not app_exe:
+            logger.error(f"{task} executable not found")
+            return {"error": f"{task} executable not found"}, 500
+        if restore_command:
+            command = restore_command(app_exe, file_paths, restore)
+        else:
+            # Unknown apps are expected on PATH and start without state
+            command = [app_exe or task]
+
+        launch_started = time.perf_counter()
         try:
-            session_check = subprocess.run(
-                ["qwinsta"], capture_output=True, text=True
-            )
-            logger.info(f"Active sessions: {session_check.stdout}")
-            active_session_id = None
-            for line in session_check.stdout.splitlines():
-                parts = line.split()
-                if len(parts) >= 4 and parts[3] == "Active" and ("console" in line.lower() or "rdp-tcp" in line.lower()):
-                    active_session_id = parts[2]  # Session ID is the third column
-                    break
-            logger.info(f"Detected active session ID: {active_session_id}")
-        except Exception as e:
-            logger.error(f"Failed to get active session: {e}")
-            active_session_id = None
-
-        # Use schtasks to launch Notepad++ in the active session
-        task_name = "LaunchNotepad"
-        cmd = f'"{notepad_exe}" {" ".join([f"\"{path}\"" for path in file_paths])}'
-        logger.info(f"Preparing to launch Notepad++ with schtasks command: {cmd}")
-
-        try:
-            # Delete existing task if it exists
-            delete_result = subprocess.run(
-                ["schtasks", "/delete", "/tn", task_name, "/f"],
-                capture_output=True, text=True
-            )
-            logger.info(f"schtasks delete output: {delete_result.stdout}")
-            if delete_result.stderr:
-                logger.error(f"schtasks delete error: {delete_result.stderr}")
-
-            # Create a scheduled task to run immediately under the Administrator user
-            create_task_cmd = [
-                "schtasks", "/create", "/tn", task_name, "/tr", cmd,
-                "/sc", "once", "/st", "00:00", "/ru", "Administrator", "/it"
-            ]
-            create_result = subprocess.run(
-                create_task_cmd, capture_output=True, text=True
-            )
-            logger.info(f"schtasks create output: {create_result.stdout}")
-            if create_result.stderr:
-                logger.error(f"schtasks create error: {create_result.stderr}")
-
-            # Check if task was created
-            query_task = subprocess.run(
-                ["schtasks", "/query", "/tn", task_name],
-                capture_output=True, text=True
-            )
-            logger.info(f"schtasks query output: {query_task.stdout}")
-            if query_task.stderr:
-                logger.error(f"schtasks query error: {query_task.stderr}")
-
-            # Run the task immediately
-            run_task_cmd = ["schtasks", "/run", "/tn", task_name]
-            run_result = subprocess.run(
-                run_task_cmd, capture_output=True, text=True
-            )
-            logger.info(f"schtasks run output: {run_result.stdout}")
-            if run_result.stderr:
-                logger.error(f"schtasks run error: {run_result.stderr}")
-
-            # Check if Notepad++ is running
-            time.sleep(2)  # Give it a moment to start
-            task_check = subprocess.run(
-                ["tasklist", "/FI", "IMAGENAME eq notepad++.exe", "/V"],
-                capture_output=True, text=True
-            )
-            logger.info(f"Tasklist output for Notepad++: {task_check.stdout}")
-
-            # Extract PID if Notepad++ is running
-            pid = None
-            for line in task_check.stdout.splitlines():
-                if "notepad++.exe" in line.lower():
-                    parts = line.split()
-                    pid = parts[1]  # PID is the second column
-                    break
-
-            if not pid:
-                logger.warning("Notepad++ not found in tasklist, trying notepad.exe as fallback")
-                # Fallback: Create and run a task for notepad.exe
-                cmd_fallback = f'"notepad.exe" {" ".join([f"\"{path}\"" for path in file_paths])}'
-                create_task_cmd = [
-                    "schtasks", "/create", "/tn", task_name, "/tr", cmd_fallback,
-                    "/sc", "once", "/st", "00:00", "/ru", "Administrator", "/it"
-                ]
-                create_result = subprocess.run(
-                    create_task_cmd, capture_output=True, text=True
-                )
-                logger.info(f"schtasks create (fallback) output: {create_result.stdout}")
-                if create_result.stderr:
-                    logger.error(f"schtasks create (fallback) error: {create_result.stderr}")
-
-                run_result = subprocess.run(
-                    ["schtasks", "/run", "/tn", task_name],
-                    capture_output=True, text=True
-                )
-                logger.info(f"schtasks run (fallback) output: {run_result.stdout}")
-                if run_result.stderr:
-                    logger.error(f"schtasks run (fallback) error: {run_result.stderr}")
-
-                time.sleep(2)
-                task_check = subprocess.run(
-                    ["tasklist", "/FI", "IMAGENAME eq notepad.exe", "/V"],
-                    capture_output=True, text=True
-                )
-                logger.info(f"Tasklist output for notepad.exe: {task_check.stdout}")
-
-                for line in task_check.stdout.splitlines():
-                    if "notepad.exe" in line.lower():
-                        parts = line.split()
-                        pid = parts[1]
-                        break
-
-            opened_files = file_paths
-            if pid:
-                running_tasks[pid] = {"name": task, "files": file_paths}
-                return jsonify({
-                    "message": "Launched with files",
-                    "file_count": len(opened_files),
-                    "files": opened_files,
-                    "pid": pid
-                })
-            else:
-                return jsonify({"error": "Failed to launch application"}), 500
-
-        except subprocess.SubprocessError as e:
+            image_name = os.path.basename(command[0])
+            with tracing.child_span("launch", task=task, image=image_name) as span:
+                pid = launch_app(command, image_name)
+
+                if not pid and fallback_image:
+                    logger.warning(f"{image_name} not found after launch, trying {fallback_image} as fallback")
+                    pid = launch_app([fallback_image] + command[1:], fallback_image)
+                if span is not None:
+                    span.set(pid=pid)
+        except (subprocess.SubprocessError, OSError) as e:
             logger.error(f"Failed to launch: {e}")
-            return jsonify({"error": f"Failed to launch: {str(e)}"}), 500
+            return {"error": f"Failed to launch: {str(e)}"}, 500
+
+        timings["launch"] = round(time.perf_counter() - launch_started, 3)
+        if not pid:
+            return {"error": "Failed to launch application"}, 500
+
+        running_tasks[pid] = {"name": task, "files": file_paths, "restore": restore}
+        mark_activity("launch")
+        return {
+            "message": "Launched with files" if file_paths else f"Launched {task}",
+            "file_count": len(file_paths),
+            "files": file_paths,
+            "pid": pid,
+            "timings": timings
+        }, 200
 
     except Exception as e:
         error_msg = f"Error in /run_task: {str(e)}"
         logger.error(error_msg, exc_info=True)
-        return jsonify({"error": error_msg}), 500
+        return {"error": error_msg}, 500
 
 @app.route("/sync_notepad_files", methods=["POST"])
 def sync_notepad_files_endpoint():
-    data = request.get_json()
+    body, status = sync_files(request.get_json())
+    return jsonify(body), status
+
+def sync_files(data):
     specific_file = data.get("file")
-    
+
     if specific_file:
         logger.info(f"Syncing specific file: {specific_file}")
         sync_specific_file(specific_file)
@@ -300,8 +718,8 @@ def sync_notepad_files_endpoint():
     else:
         logger.info("Syncing all Notepad++ files")
         sync_notepad_files()
-        
-    return jsonify({"message": "Notepad++ files synced with S3"})
+
+    return {"message": "Notepad++ files synced with S3"}, 200
 
 def sync_specific_file(filename):
     """Sync a specific file from S3"""
@@ -312,7 +730,8 @@ def sync_specific_file(filename):
         logger.info(f"Downloading {filename} to {local_path}")
         s3.download_file(BUCKET_NAME, filename, local_path)
         logger.info(f"Downloaded {filename}")
-        
+        mark_activity("sync")
+
         # If this file is open in Notepad++, refresh it
         if local_path in open_notepad_files:
             logger.info(f"File {filename} is open in Notepad++")
@@ -324,8 +743,9 @@ def sync_notepad_files():
     logger.info(f"Syncing from S3 bucket: {BUCKET_NAME}")
 
     try:
-        response = s3.list_objects_v2(Bucket=BUCKET_NAME)
-        objects = response.get('Contents', [])
+        # One listing returns at most 1,000 keys
+        paginator = s3.get_paginator('list_objects_v2')
+        objects = [obj for page in paginator.paginate(Bucket=BUCKET_NAME) for obj in page.get('Contents', [])]
 
         if not objects:
             logger.info("No files found in S3 bucket")
@@ -333,6 +753,8 @@ def sync_notepad_files():
 
         for obj in objects:
             s3_key = obj['Key']
+            if s3_key.startswith(CONTROL_PREFIX) or is_app_state_key(s3_key):
+                continue
             filename = os.path.basename(s3_key)
             local_path = os.path.join(SYNCED_DIR, filename)
 
@@ -340,6 +762,7 @@ def sync_notepad_files():
                 logger.info(f"Downloading {s3_key} to {local_path}")
                 s3.download_file(BUCKET_NAME, s3_key, local_path)
                 logger.info(f"Downloaded {filename}")
+                mark_activity("sync")
             except Exception as e:
                 logger.error(f"Error downloading {s3_key}: {e}")
 
@@ -359,6 +782,7 @@ def upload_to_s3(file_path):
         logger.info(f"Uploading {filename} to S3")
         s3.upload_file(file_path, BUCKET_NAME, filename)
         logger.info(f"Uploaded {filename} to S3")
+        mark_activity("sync")
 
     except Exception as e:
         logger.error(f"Error uploading {file_path} to S3: {e}")
@@ -383,6 +807,123 @@ def upload_modified_file():
         logger.error(f"Error uploading file: {e}")
         return jsonify({"error": str(e)}), 500
 
+# Operations /batch can run; each takes the op's args and returns (body, HTTP status)
+BATCH_OPS = {
+    "list_tasks": lambda args: ({"tasks": processes.target_tasks()}, 200),
+    "ram_usage": lambda args: (ram_usage_info(), 200),
+    "activity": lambda args: (activity_report(), 200),
+    "memory_history": memory_history_report,
+    "launched_tasks": lambda args: ({"tasks": launched_tasks()}, 200),
+    "prefetch": start_prefetch,
+    "sync_keys": sync_keys,
+    "sync_files": sync_files,
+    "run_task": start_task,
+}
+BATCH_WORKERS = 4
+
+def parse_batch(ops):
+    """Validate a batch; returns the ops with ids and dependencies filled in"""
+    if not isinstance(ops, list) or not ops:
+        raise ValueError("ops must be a non-empty list")
+    parsed, seen = [], set()
+    for index, op in enumerate(ops):
+        op_id = str(op.get("id", index))
+        if op.get("op") not in BATCH_OPS:
+            raise ValueError(f"Unknown op: {op.get('op')}")
+        if op_id in seen:
+            raise ValueError(f"Duplicate op id: {op_id}")
+        depends_on = [str(dep) for dep in op.get("depends_on", [])]
+        unknown = [dep for dep in depends_on if dep not in seen]
+        if unknown:
+            raise ValueError(f"Op {op_id} depends on ops that do not come before it: {unknown}")
+        seen.add(op_id)
+        parsed.append({"id": op_id, "op": op["op"], "args": op.get("args") or {}, "depends_on": depends_on})
+    return parsed
+
+def run_batch_op(op, dependencies, parent=None):
+    """Run one op once its dependencies are done; skipped if any of them did not succeed"""
+    failed = [dep_id for dep_id, future in dependencies.items() if future.result()["status"] != "ok"]
+    if failed:
+        return {"id": op["id"], "op": op["op"], "status": "skipped", "code": None,
+                "result": {"error": f"Dependencies did not succeed: {failed}"}, "elapsed": 0.0}
+    started = time.perf_counter()
+    with tracing.child_span(f"op {op['op']}", parent=parent, id=op["id"]) as span:
+        try:
+            body, code = BATCH_OPS[op["op"]](op["args"])
+        except Exception as e:
+            logger.error(f"Batch op {op['id']} ({op['op']}) failed: {e}", exc_info=True)
+            body, code = {"error": str(e)}, 500
+        if span is not None and code >= 400:
+            span.fail(body.get("error", code) if isinstance(body, dict) else code)
+    return {
+        "id": op["id"],
+        "op": op["op"],
+        "status": "ok" if code < 400 else "error",
+        "code": code,
+        "result": body,
+        "elapsed": round(time.perf_counter() - started, 3),
+    }
+
+def run_batch(ops, parent=None):
+    """
+    Run parsed ops and yield each result as it finishes. Ops start in the order
+    given and run concurrently unless they depend on each other; a dependency is
+    always an earlier op, so a worker only ever waits on work already started.
+    In a trace, each op is a span under parent.
+    """
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch") as executor:
+        futures = {}
+        for op in ops:
+            dependencies = {dep: futures[dep] for dep in op["depends_on"]}
+            futures[op["id"]] = executor.submit(run_batch_op, op, dependencies, parent)
+        for future in as_completed(futures.values()):
+            yield future.result()
+
+def batch_summary(results, started):
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+    for result in results:
+        counts[result["status"]] += 1
+    return dict(counts, done=True, elapsed=round(time.perf_counter() - started, 3))
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    """
+    Run several operations in one request:
+      {"ops": [{"id": "sync", "op": "sync_keys", "args": {"keys": [...]}},
+               {"id": "notepad", "op": "run_task", "args": {...}, "depends_on": ["sync"]}],
+       "stream": true}
+    With stream set, results come back as NDJSON lines in completion order,
+    followed by a summary line; otherwise as one JSON body in request order.
+    """
+    data = request.get_json() or {}
+    try:
+        ops = parse_batch(data.get("ops"))
+    except (ValueError, AttributeError, TypeError) as e:
+        return jsonify({"error": f"Invalid batch: {e}"}), 400
+    logger.info(f"Batch of {len(ops)} ops: {[op['op'] for op in ops]}")
+    started = time.perf_counter()
+    span = g.get("trace_span")
+
+    if data.get("stream"):
+        # The results are produced after this request's teardown, so the span is ended here instead
+        g.pop("trace_span", None)
+
+        def generate():
+            results = []
+            try:
+                for result in run_batch(ops, span):
+                    results.append(result)
+                    yield json.dumps(result) + "\n"
+                yield json.dumps(batch_summary(results, started)) + "\n"
+            finally:
+                if span is not None:
+                    span.end()
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    by_id = {result["id"]: result for result in run_batch(ops, span)}
+    results = [by_id[op["id"]] for op in ops]
+    return jsonify({"results": results, "summary": batch_summary(results, started)})
+
 def check_for_open_notepad_files():
     """Check if any notepad processes have the synced files open"""
     if not os.path.exists(SYNCED_DIR):
@@ -398,15 +939,14 @@ def check_for_open_notepad_files():
         return []
         
     open_files = []
-    for proc in psutil.process_iter(['pid', 'name']):
-        if proc.info['name'] == 'notepad++.exe':
-            try:
-                p = psutil.Process(proc.info['pid'])
-                for file in p.open_files():
-                    if file.path in synced_files:
-                        open_files.append(file.path)
-            except (psutil.AccessDenied, psutil.NoSuchProcess):
-                pass
+    for info in processes.find('notepad++.exe'):
+        try:
+            p = psutil.Process(info['pid'])
+            for file in p.open_files():
+                if file.path in synced_files:
+                    open_files.append(file.path)
+        except (psutil.AccessDenied, psutil.NoSuchProcess):
+            pass
     
     return open_files
 
@@ -427,19 +967,25 @@ class NotepadSyncHandler(FileSystemEventHandler):
             return
         if event.src_path.endswith(('.txt', '.cpp', '.py', '.html')):
             logger.info(f"Detected change on VM: {event.src_path}")
+            WATCHER_EVENTS.inc(side="vm", outcome="synced")
             # Upload to S3 when file changes
             upload_to_s3(event.src_path)
+        else:
+            WATCHER_EVENTS.inc(side="vm", outcome="ignored")
 
     def on_created(self, event):
         if event.is_directory:
             return
         if event.src_path.endswith(('.txt', '.cpp', '.py', '.html')):
             logger.info(f"New file created on VM: {event.src_path}")
+            WATCHER_EVENTS.inc(side="vm", outcome="synced")
             # Upload new file to S3
             upload_to_s3(event.src_path)
 
 def start_vm_file_watcher():
+    os.makedirs(SYNCED_DIR, exist_ok=True)
     event_handler = NotepadSyncHandler()
+    # watchdog picks the native backend: ReadDirectoryChangesW on Windows, inotify on Linux
     observer = Observer()
     observer.schedule(event_handler, SYNCED_DIR, recursive=True)
     observer.start()
@@ -453,6 +999,11 @@ def start_vm_file_watcher():
 
 if __name__ == "__main__":
     logger.info("Starting VM server...")
+    processes.start()
+    start_memory_sampler()
+    # Pull whatever the backend staged during provisioning before any migrate arrives
+    begin_prefetch()
+    threading.Thread(target=run_prefetch, args=([], [], True), daemon=True).start()
     watcher_thread = threading.Thread(target=start_vm_file_watcher, daemon=True)
     watcher_thread.start()
-    app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=int(os.getenv("CLOUD_RAM_AGENT_PORT", "5000")), debug=False, threaded=True)
\ No newline at end of file
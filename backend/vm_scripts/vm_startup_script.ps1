@@ -69,7 +69,7 @@ switch ($currentState) {
         try {
             Start-Process -FilePath "choco" -ArgumentList "install python python-pip -y" -Wait -NoNewWindow -PassThru
             $env:Path = [System.Environment]::GetEnvironmentVariable("Path", "Machine") + ";" + [System.Environment]::GetEnvironmentVariable("Path", "User")
-            Start-Process -FilePath "cmd.exe" -ArgumentList "/c pip install websockify flask flask-cors psutil boto3 watchdog" -Wait -NoNewWindow -PassThru
+            Start-Process -FilePath "cmd.exe" -ArgumentList "/c pip install websockify flask flask-cors psutil boto3 watchdog pywin32" -Wait -NoNewWindow -PassThru
         } catch {
             Write-EC2Log "ERROR: Failed to install Python or packages - $($_.Exception.Message)"
             exit 1
@@ -224,12 +224,14 @@ SingleApplicationName=
             exit 1
         }
 
-        # Download Flask server script from S3
+        # Download Flask server script and the modules it imports from S3
         try {
-            $s3Url = "https://cloud-ram-scripts.s3.us-east-1.amazonaws.com/vm_server.py"
-            Invoke-WebRequest -Uri $s3Url -OutFile "C:\CloudRAM\vm_server.py" -ErrorAction Stop
+            foreach ($agentFile in @("vm_server.py", "app_launcher.py", "process_snapshot.py", "metrics.py", "tracing.py")) {
+                $s3Url = "https://cloud-ram-scripts.s3.us-east-1.amazonaws.com/$agentFile"
+                Invoke-WebRequest -Uri $s3Url -OutFile "C:\CloudRAM\$agentFile" -ErrorAction Stop
+            }
         } catch {
-            Write-EC2Log "ERROR: Failed to download vm_server.py from S3 - $($_.Exception.Message)"
+            Write-EC2Log "ERROR: Failed to download agent scripts from S3 - $($_.Exception.Message)"
             exit 1
         }
 
@@ -274,6 +276,19 @@ python C:\CloudRAM\vm_server.py
             exit 1
         }
 
+        # Keep the app launcher running in the Administrator's interactive session, so the
+        # agent can start apps there without a scheduled task per launch
+        try {
+            $launcherAction = New-ScheduledTaskAction -Execute "pythonw.exe" -Argument "C:\CloudRAM\app_launcher.py"
+            $launcherTrigger = New-ScheduledTaskTrigger -AtLogOn -User "Administrator"
+            $launcherPrincipal = New-ScheduledTaskPrincipal -UserId "Administrator" -LogonType Interactive -RunLevel Highest
+            Register-ScheduledTask -Action $launcherAction -Trigger $launcherTrigger -Principal $launcherPrincipal -TaskName "CloudRAM-AppLauncher" -Description "Launch migrated apps in the interactive session" -Force
+            Start-ScheduledTask -TaskName "CloudRAM-AppLauncher"
+        } catch {
+            # Not fatal: the agent falls back to one-off scheduled tasks
+            Write-EC2Log "WARNING: Failed to register app launcher - $($_.Exception.Message)"
+        }
+
         # Start services now
         try {
             Start-Service -Name "uvnc_service" -ErrorAction Stop
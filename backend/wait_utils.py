@@ -0,0 +1,76 @@
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Deadline:
+    """An absolute point in time that several consecutive waits can share."""
+
+    def __init__(self, timeout):
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+
+def wait_until(predicate, timeout=5.0, interval=0.05, deadline=None):
+    """
+    Poll predicate until it returns something truthy or the time runs out.
+    Returns the predicate's last value, so callers can tell a hit from a timeout.
+    """
+    deadline = deadline or Deadline(timeout)
+    while True:
+        result = predicate()
+        if result or deadline.expired():
+            return result
+        time.sleep(min(interval, deadline.remaining()))
+
+
+def path_signature(path):
+    """(size, mtime_ns) of a file, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
+
+
+def _dir_signature(path):
+    try:
+        return tuple(sorted(
+            (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+            for entry in os.scandir(path) if entry.is_file()
+        ))
+    except OSError:
+        return None
+
+
+def _wait_stable(signature, path, quiet_period, timeout, interval, deadline):
+    deadline = deadline or Deadline(timeout)
+    last = signature(path)
+    stable_since = time.monotonic()
+    while not deadline.expired():
+        time.sleep(min(interval, deadline.remaining()))
+        current = signature(path)
+        if current != last:
+            last = current
+            stable_since = time.monotonic()
+        elif current is not None and time.monotonic() - stable_since >= quiet_period:
+            return True
+    logger.warning(f"{path} did not settle within the deadline")
+    return False
+
+
+def wait_for_file_stable(path, quiet_period=0.25, timeout=5.0, interval=0.05, deadline=None):
+    """Wait until a file exists and its size/mtime stop changing for quiet_period seconds"""
+    return _wait_stable(path_signature, path, quiet_period, timeout, interval, deadline)
+
+
+def wait_for_dir_stable(path, quiet_period=0.25, timeout=5.0, interval=0.05, deadline=None):
+    """Wait until no file in a directory is added, removed or rewritten for quiet_period seconds"""
+    return _wait_stable(_dir_signature, path, quiet_period, timeout, interval, deadline)
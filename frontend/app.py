@@ -1,11 +1,22 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, make_response
 import requests
+import hashlib
+import json
 
 import os
 import sys
 
+# The VM client is shared with the backend
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from vm_client import get_vm_client
+from single_flight import SingleFlight
+
 app = Flask(__name__)
 API_URL = "http://localhost:8000"
+# Every open status tab polls /dashboard; ticks within a second share one upstream fetch
+dashboard_flight = SingleFlight(max_age=1.0)
+# The page shows memory in GB with two decimals; finer changes would only defeat the ETag
+RAM_QUANTUM = 10 * 1024 * 1024
 
 @app.route("/")
 def index():
@@ -15,8 +26,9 @@ def index():
 def allocate():
     data = request.json
     ram_size = data.get("ram_size")
-    print(f"📌 Forwarding allocate request for {ram_size} GB to FastAPI")
-    response = requests.post(f"{API_URL}/allocate_ram/", json={"ram_size": ram_size})
+    platform = data.get("platform", "windows")
+    print(f"📌 Forwarding allocate request for {ram_size} GB ({platform}) to FastAPI")
+    response = requests.post(f"{API_URL}/allocate_ram/", json={"ram_size": ram_size, "platform": platform})
     print(f"FastAPI response: {response.status_code} - {response.text}")
     if response.status_code == 200:
         return jsonify(response.json())
@@ -33,8 +45,8 @@ def ram_usage():
     if not vm_ip:
         return jsonify({"error": "VM IP is required"}), 400
     try:
-        print(f"Fetching RAM usage from http://{vm_ip}:5000/ram_usage")
-        response = requests.get(f"http://{vm_ip}:5000/ram_usage", timeout=10)
+        print(f"Fetching RAM usage from VM {vm_ip}")
+        response = get_vm_client(vm_ip).get("ram_usage")
         print(f"Response status: {response.status_code}, content: {response.text}")
         if response.status_code == 200:
             return jsonify(response.json())
@@ -44,6 +56,53 @@ def ram_usage():
         print(f"Error connecting to VM: {str(e)}")
         return jsonify({"error": f"Failed to connect to VM: {str(e)}"}), 500
 
+def build_dashboard(vm_ip):
+    """VM memory and tasks (one /batch to the agent), local tasks and the VNC URL"""
+    dashboard = {
+        "vm_ip": vm_ip,
+        "vnc_url": f"http://{vm_ip}:8080/vnc.html?autoconnect=true&resize=scale",
+        "ram": None,
+        "vm_tasks": [],
+        "local_tasks": [],
+        "errors": {},
+    }
+    try:
+        ops = [{"id": "ram", "op": "ram_usage"}, {"id": "tasks", "op": "list_tasks"}]
+        for result in get_vm_client(vm_ip).batch(ops):
+            if result.get("id") == "ram" and result["status"] == "ok":
+                dashboard["ram"] = {
+                    key: (value // RAM_QUANTUM) * RAM_QUANTUM if key.endswith("_ram") else value
+                    for key, value in result["result"].items()
+                }
+            elif result.get("id") == "tasks" and result["status"] == "ok":
+                dashboard["vm_tasks"] = result["result"].get("tasks", [])
+    except (requests.RequestException, RuntimeError, ValueError) as e:
+        dashboard["errors"]["vm"] = f"Failed to connect to VM: {str(e)}"
+    try:
+        response = requests.get(f"{API_URL}/running_tasks/", timeout=5)
+        response.raise_for_status()
+        dashboard["local_tasks"] = response.json().get("tasks", [])
+    except (requests.RequestException, ValueError) as e:
+        dashboard["errors"]["local"] = f"Failed to fetch local tasks: {str(e)}"
+    return dashboard
+
+@app.route("/dashboard")
+def dashboard():
+    vm_ip = request.args.get("vm_ip")
+    if not vm_ip:
+        return jsonify({"error": "VM IP is required"}), 400
+    data = dashboard_flight.do(vm_ip, lambda: build_dashboard(vm_ip))
+    body = json.dumps(data, sort_keys=True)
+    etag = '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+    if etag in request.headers.get("If-None-Match", ""):
+        response = make_response("", 304)
+    else:
+        response = make_response(body)
+        response.mimetype = "application/json"
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
 @app.route("/sync_notepad/", methods=["POST"])
 def sync_notepad():
     data = request.json
@@ -103,6 +103,7 @@ async function register() {
 async function allocateRAM(event) {
     event.preventDefault();
     const ramSize = document.getElementById("ram").value;
+    const platform = document.getElementById("platform").value;
     const allocateBtn = document.getElementById("allocate-btn");
     const loadingText = document.getElementById("loading-text");
     const countdownElement = document.getElementById("countdown");
@@ -122,7 +123,7 @@ async function allocateRAM(event) {
                 "Content-Type": "application/json",
                 "Authorization": `Bearer ${token}`
             },
-            body: JSON.stringify({ ram_size: parseInt(ramSize) })
+            body: JSON.stringify({ ram_size: parseInt(ramSize), platform: platform })
         });
 
         if (!response.ok) {
@@ -149,25 +150,3 @@ async function allocateRAM(event) {
         }, 2000);
     }
 }
-
-window.addEventListener('beforeunload', async () => {
-    const vmId = localStorage.getItem("vm_id");
-    if (vmId) {
-        try {
-            const user = await Amplify.Auth.currentAuthenticatedUser();
-            const token = user.signInUserSession.idToken.jwtToken;
-            await fetch("/release_ram/", {
-                method: "POST",
-                headers: {
-                    "Content-Type": "application/json",
-                    "Authorization": `Bearer ${token}`
-                },
-                body: JSON.stringify({ vm_id: vmId })
-            });
-            localStorage.removeItem("vm_id");
-            localStorage.removeItem("vm_ip");
-        } catch (err) {
-            console.error("Error terminating VM:", err);
-        }
-    }
-});